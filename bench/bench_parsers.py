@@ -0,0 +1,403 @@
+#!/usr/bin/python
+#
+# This needs python-argparse, if used with python2.6.
+#
+# Benchmarks for the parsers in the nagios checks, run against generated
+# inputs much larger than what we usually see: haproxy stats with ten
+# thousand servers, /proc/drbd with hundreds of resources in resync, and
+# meminfo and vmstat as found on a big machine. For every benchmark the best
+# time out of --repeat runs and the peak memory it took are measured, each
+# benchmark in its own process so they don't add up.
+#
+# Times are kept relative to a calibration loop of the kind of work the
+# parsers do, timed between the runs of each benchmark, so that a faster or
+# slower machine doesn't look like a change in the code. Results are
+# compared to baseline.json next to this script, and anything that got more
+# than --tolerance slower relative to the calibration, or bigger, is measured
+# once more, and reported with a non-zero exit if it still is. After a
+# change that is meant to be slower, make a new baseline with --save.
+#
+#   python bench/bench_parsers.py [--save] [-k haproxy]
+
+import sys
+import os
+import gc
+import json
+import time
+import random
+import shutil
+import tempfile
+import resource
+import traceback
+import argparse
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import check_cache
+import check_drbd_status
+import check_haproxy
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+# Ignore differences smaller than these, they are noise
+MIN_SECONDS = 0.001
+MIN_KB = 1024
+
+# Numbers to split, convert and put in a dict, over and over
+CALIBRATION = ' '.join(['%d' % (i * 7919) for i in range(200)])
+
+HAPROXY_COLUMNS = ('pxname,svname,qcur,qmax,scur,smax,slim,stot,bin,bout,'
+    'dreq,dresp,ereq,econ,eresp,wretr,wredis,status,weight,act,bck,chkfail,'
+    'chkdown,lastchg,downtime,qlimit,pid,iid,sid,throttle,lbtot,tracked,type,'
+    'rate,rate_lim,rate_max,check_status,check_code,check_duration,hrsp_1xx,'
+    'hrsp_2xx,hrsp_3xx,hrsp_4xx,hrsp_5xx,hrsp_other,hanafail,req_rate,'
+    'req_rate_max,req_tot,cli_abrt,srv_abrt,comp_in,comp_out,comp_byp,'
+    'comp_rsp,lastsess,last_chk,last_agt,qtime,ctime,rtime,ttime').split(',')
+
+MEMINFO_KEYS = ('MemTotal MemFree MemAvailable Buffers Cached SwapCached '
+    'Active Inactive Active(anon) Inactive(anon) Active(file) Inactive(file) '
+    'Unevictable Mlocked SwapTotal SwapFree Dirty Writeback AnonPages Mapped '
+    'Shmem KReclaimable Slab SReclaimable SUnreclaim KernelStack PageTables '
+    'NFS_Unstable Bounce WritebackTmp CommitLimit Committed_AS VmallocTotal '
+    'VmallocUsed VmallocChunk Percpu HardwareCorrupted AnonHugePages '
+    'ShmemHugePages ShmemPmdMapped FileHugePages FilePmdMapped CmaTotal '
+    'CmaFree Hugepagesize Hugetlb DirectMap4k DirectMap2M DirectMap1G').split()
+
+VMSTAT_KEYS = ('nr_free_pages nr_zone_inactive_anon nr_zone_active_anon '
+    'nr_zone_inactive_file nr_zone_active_file nr_zone_unevictable '
+    'nr_zone_write_pending nr_mlock nr_bounce nr_free_cma numa_hit numa_miss '
+    'numa_foreign numa_interleave numa_local numa_other nr_inactive_anon '
+    'nr_active_anon nr_inactive_file nr_active_file nr_unevictable '
+    'nr_slab_reclaimable nr_slab_unreclaimable nr_isolated_anon '
+    'nr_isolated_file workingset_nodes workingset_refault_anon '
+    'workingset_refault_file workingset_activate_anon '
+    'workingset_activate_file workingset_restore_anon workingset_restore_file '
+    'workingset_nodereclaim nr_anon_pages nr_mapped nr_file_pages nr_dirty '
+    'nr_writeback nr_writeback_temp nr_shmem nr_shmem_hugepages '
+    'nr_shmem_pmdmapped nr_file_hugepages nr_file_pmdmapped '
+    'nr_anon_transparent_hugepages nr_vmscan_write nr_vmscan_immediate_reclaim '
+    'nr_dirtied nr_written nr_kernel_misc_reclaimable nr_foll_pin_acquired '
+    'nr_foll_pin_released nr_kernel_stack nr_page_table_pages nr_swapcached '
+    'nr_dirty_threshold nr_dirty_background_threshold pgpgin pgpgout pswpin '
+    'pswpout pgfree pgactivate pgdeactivate pglazyfree pgfault pgmajfault '
+    'pglazyfreed pgrefill pgreuse pgsteal_kswapd pgsteal_direct '
+    'pgsteal_khugepaged pgscan_kswapd pgscan_direct pgscan_khugepaged '
+    'pgscan_direct_throttle pgscan_anon pgscan_file pgsteal_anon pgsteal_file '
+    'zone_reclaim_failed pginodesteal slabs_scanned kswapd_inodesteal '
+    'kswapd_low_wmark_hit_quickly kswapd_high_wmark_hit_quickly pageoutrun '
+    'pgrotated drop_pagecache drop_slab oom_kill numa_pte_updates '
+    'numa_huge_pte_updates numa_hint_faults numa_hint_faults_local '
+    'numa_pages_migrated pgmigrate_success pgmigrate_fail '
+    'compact_migrate_scanned compact_free_scanned compact_isolated '
+    'compact_stall compact_fail compact_success compact_daemon_wake '
+    'unevictable_pgs_culled unevictable_pgs_scanned unevictable_pgs_rescued '
+    'unevictable_pgs_mlocked unevictable_pgs_munlocked '
+    'unevictable_pgs_cleared unevictable_pgs_stranded thp_fault_alloc '
+    'thp_fault_fallback thp_collapse_alloc thp_collapse_alloc_failed '
+    'thp_file_alloc thp_file_mapped thp_split_page thp_split_page_failed '
+    'thp_deferred_split_page thp_split_pmd thp_zero_page_alloc '
+    'thp_zero_page_alloc_failed thp_swpout thp_swpout_fallback swap_ra '
+    'swap_ra_hit').split()
+
+# Older kernels break some counters down by zone
+ZONES = ('dma', 'dma32', 'normal', 'movable')
+ZONED = ('pgalloc', 'allocstall', 'pgskip', 'pgsteal_kswapd',
+    'pgsteal_direct', 'pgscan_kswapd', 'pgscan_direct')
+
+def haproxy_csv(directory, rows):
+    """ Stats for proxies of 50 servers each, until there are rows rows. """
+    rnd = random.Random(1)
+    path = os.path.join(directory, 'haproxy.csv')
+    fp = open(path, 'w')
+    fp.write('# ' + ','.join(HAPROXY_COLUMNS) + ',\n')
+    written = 0
+    proxy = 0
+    while written < rows:
+        pxname = 'proxy%d' % proxy
+        proxy += 1
+        servers = ['FRONTEND'] + ['srv%d' % i for i in range(48)] + ['BACKEND']
+        for svname in servers:
+            row = dict([(c, '') for c in HAPROXY_COLUMNS])
+            row.update({
+                'pxname': pxname,
+                'svname': svname,
+                'qcur': str(rnd.randint(0, 5)),
+                'scur': str(rnd.randint(0, 100)),
+                'slim': '2000',
+                'stot': str(rnd.randint(0, 10 ** 7)),
+                'status': rnd.random() < 0.02 and 'DOWN' or 'UP',
+                'rate': str(rnd.randint(0, 500)),
+                'qtime': str(rnd.randint(0, 50)),
+                'ctime': str(rnd.randint(0, 10)),
+                'rtime': str(rnd.randint(0, 800)),
+            })
+            if svname == 'FRONTEND':
+                row['status'] = 'OPEN'
+            fp.write(','.join([row[c] for c in HAPROXY_COLUMNS]) + ',\n')
+            written += 1
+    fp.close()
+    return path
+
+def proc_drbd(directory, resources):
+    """ /proc/drbd in the 8.4 format, with most resources resyncing. """
+    rnd = random.Random(2)
+    path = os.path.join(directory, 'drbd')
+    fp = open(path, 'w')
+    fp.write('version: 8.4.3 (api:1/proto:86-101)\n')
+    fp.write('srcversion: 1A9F77B1CA5FF92235C2213\n')
+    for minor in range(resources):
+        counters = 'ns:%d nr:%d dw:%d dr:%d al:%d bm:%d lo:%d pe:%d ua:%d ' \
+            'ap:%d ep:1 wo:f oos:%d' % tuple([rnd.randint(0, 10 ** 9)
+            for i in range(6)] + [rnd.randint(0, 20) for i in range(4)] +
+            [rnd.randint(0, 10 ** 8)])
+        if minor % 10 == 0:
+            fp.write(' %d: cs:Connected ro:Primary/Secondary '
+                'ds:UpToDate/UpToDate C r-----\n    %s\n' % (minor, counters))
+            continue
+        done = rnd.uniform(0, 100)
+        fp.write(' %d: cs:SyncSource ro:Primary/Secondary '
+            'ds:UpToDate/Inconsistent C r-----\n    %s\n' % (minor, counters))
+        fp.write("\t[%s>%s] sync'ed: %.1f%% (%d/%d)M\n" % (
+            '=' * int(done / 5), '.' * (19 - int(done / 5)), done,
+            rnd.randint(0, 10 ** 5), 10 ** 5))
+        fp.write('\tfinish: %d:%02d:%02d speed: %s (%s) want: 40,960 K/sec\n'
+            % (rnd.randint(0, 30), rnd.randint(0, 59), rnd.randint(0, 59),
+            '{:,}'.format(rnd.randint(1000, 100000)),
+            '{:,}'.format(rnd.randint(1000, 100000))))
+    fp.close()
+    return path
+
+def meminfo(directory):
+    rnd = random.Random(3)
+    path = os.path.join(directory, 'meminfo')
+    fp = open(path, 'w')
+    for key in MEMINFO_KEYS:
+        fp.write('%-16s%8d kB\n' % (key + ':', rnd.randint(0, 512 * 2 ** 20)))
+    fp.close()
+    return path
+
+def vmstat(directory):
+    rnd = random.Random(4)
+    path = os.path.join(directory, 'vmstat')
+    fp = open(path, 'w')
+    for key in VMSTAT_KEYS:
+        fp.write('%s %d\n' % (key, rnd.randint(0, 10 ** 12)))
+    for key in ZONED:
+        for zone in ZONES:
+            fp.write('%s_%s %d\n' % (key, zone, rnd.randint(0, 10 ** 12)))
+    fp.close()
+    return path
+
+def pressure(directory):
+    path = os.path.join(directory, 'pressure')
+    fp = open(path, 'w')
+    fp.write('some avg10=1.53 avg60=0.87 avg300=0.32 total=104739123\n')
+    fp.write('full avg10=0.41 avg60=0.22 avg300=0.08 total=38291738\n')
+    fp.close()
+    return path
+
+def bench_haproxy_read(path, args):
+    fp = open(path)
+    try:
+        check_haproxy.read_stats(fp)
+    finally:
+        fp.close()
+
+def bench_haproxy_collect(path, args):
+    """ Everything check_haproxy does with the stats once it has them. """
+    target = check_haproxy.Target(socket=path)
+    fp = open(path)
+    try:
+        target.fetch = lambda a: fp
+        target.collect(args.haproxy_args)
+    finally:
+        fp.close()
+    check_haproxy.report(target.data)
+
+def bench_drbd_parse(path, args):
+    check_drbd_status.read_devices(path)
+
+def bench_drbd_check(path, args):
+    check_drbd_status.PROC_DRBD = path
+    check_drbd_status.check(args.drbd_args)
+
+def bench_meminfo(path, args):
+    for i in range(args.loops):
+        check_cache.read_meminfo(path)
+
+def bench_vmstat(path, args):
+    for i in range(args.loops):
+        check_cache.read_vmstat(path)
+
+def bench_pressure(path, args):
+    for i in range(args.loops):
+        check_cache.read_pressure(path)
+
+def calibrate(path, args):
+    """ Plain python work, like parsing, that the others are measured
+        against. It runs between the runs of every benchmark, so that both
+        see the machine in the same state. """
+    for i in range(1000):
+        d = {}
+        for word in CALIBRATION.split():
+            d[word] = int(word)
+
+# name, fixture, benchmark
+BENCHMARKS = [
+    ('haproxy_read', lambda d, a: haproxy_csv(d, a.rows), bench_haproxy_read),
+    ('haproxy_collect', lambda d, a: haproxy_csv(d, a.rows),
+        bench_haproxy_collect),
+    ('drbd_parse', lambda d, a: proc_drbd(d, a.resources), bench_drbd_parse),
+    ('drbd_check', lambda d, a: proc_drbd(d, a.resources), bench_drbd_check),
+    ('cache_meminfo', lambda d, a: meminfo(d), bench_meminfo),
+    ('cache_vmstat', lambda d, a: vmstat(d), bench_vmstat),
+    ('cache_pressure', lambda d, a: pressure(d), bench_pressure),
+]
+
+def rss_kb():
+    """ Resident memory of this process right now. """
+    fp = open('/proc/self/statm')
+    try:
+        return int(fp.read().split()[1]) * resource.getpagesize() / 1024
+    finally:
+        fp.close()
+
+def measure(fn, path, args):
+    """ Run fn in a child process, returns the best time, the best time of
+        the calibration run between its runs, and the peak memory above what
+        the child started with, in KB. """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(r)
+        try:
+            gc.collect()
+            start = rss_kb()
+            best = {}
+            for i in range(args.repeat):
+                for key, f in (('calibration', calibrate), ('seconds', fn)):
+                    t = time.time()
+                    f(path, args)
+                    elapsed = time.time() - t
+                    best[key] = min(best.get(key, elapsed), elapsed)
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            best['peak_kb'] = max(peak - start, 0)
+            best['relative'] = best['seconds'] / best['calibration']
+            os.write(w, json.dumps(best))
+        except:
+            traceback.print_exc()
+            os._exit(1)
+        os._exit(0)
+    os.close(w)
+    data = ''
+    while True:
+        chunk = os.read(r, 4096)
+        if not chunk:
+            break
+        data += chunk
+    os.close(r)
+    status = os.waitpid(pid, 0)[1]
+    if status or not data:
+        raise RuntimeError("Benchmark failed")
+    return json.loads(data)
+
+def regressions(results, baseline, tolerance):
+    """ The names and descriptions of results that got worse. Times are
+        compared relative to the calibration, the baseline's times are what
+        they would be on this machine. """
+    worse = []
+    for name, result in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None or 'relative' not in base:
+            continue
+        expected = base['relative'] * result['calibration']
+        if result['seconds'] - expected > max(expected * tolerance,
+                MIN_SECONDS):
+            worse.append((name, "%s relative %.3f, was %.3f" % (name,
+                result['relative'], base['relative'])))
+        if result['peak_kb'] - base['peak_kb'] > max(
+                base['peak_kb'] * tolerance, MIN_KB):
+            worse.append((name, "%s peak_kb %d, was %d" % (name,
+                result['peak_kb'], base['peak_kb'])))
+    return worse
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-k", "--keyword",
+        help="Only run benchmarks with this in their name")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+        help="Runs of each benchmark, the best one counts")
+    parser.add_argument("--rows", type=int, default=10000,
+        help="Rows of haproxy stats")
+    parser.add_argument("--resources", type=int, default=500,
+        help="Resources in /proc/drbd")
+    parser.add_argument("--loops", type=int, default=1000,
+        help="Times to read the small files per run")
+    parser.add_argument("-b", "--baseline", default=BASELINE,
+        help="Baseline to compare with")
+    parser.add_argument("-t", "--tolerance", type=float, default=0.5,
+        help="Allowed fraction slower or bigger than the baseline")
+    parser.add_argument("--save", action='store_true',
+        help="Save the results as the new baseline")
+    args = parser.parse_args()
+
+    baseline = None
+    if not args.save and os.path.exists(args.baseline):
+        baseline = json.load(open(args.baseline))
+
+    directory = tempfile.mkdtemp(prefix='bench_parsers')
+    try:
+        args.haproxy_args = check_haproxy.parse_args(['-s', 'bench',
+            '-T', '*:rtime=500,1000', '--server-perfdata'])
+        args.drbd_args = check_drbd_status.parse_args(['--state-dir',
+            directory, '--events-state', os.path.join(directory, 'none')])
+        results = {}
+        benchmarks = {}
+        for name, fixture, fn in BENCHMARKS:
+            if args.keyword and args.keyword not in name:
+                continue
+            benchmarks[name] = (fn, fixture(directory, args))
+            results[name] = measure(fn, benchmarks[name][1], args)
+
+        # Measure what looks worse once more, the better result counts
+        if baseline is not None:
+            for name in set([name for name, w in regressions(results,
+                    baseline, args.tolerance)]):
+                again = measure(benchmarks[name][0], benchmarks[name][1], args)
+                peak = min(results[name]['peak_kb'], again['peak_kb'])
+                if again['relative'] < results[name]['relative']:
+                    results[name] = again
+                results[name]['peak_kb'] = peak
+    finally:
+        shutil.rmtree(directory)
+
+    for name, result in sorted(results.items()):
+        print "%-16s %10.4fs %8.3fx %8dKB" % (name, result['seconds'],
+            result['relative'], result['peak_kb'])
+
+    if args.save:
+        # Only what doesn't depend on the machine
+        baseline = {}
+        if os.path.exists(args.baseline):
+            baseline = json.load(open(args.baseline))
+        for name, result in results.items():
+            baseline[name] = {'relative': round(result['relative'], 3),
+                'peak_kb': result['peak_kb']}
+        fp = open(args.baseline, 'w')
+        json.dump(baseline, fp, indent=2, sort_keys=True,
+            separators=(',', ': '))
+        fp.write('\n')
+        fp.close()
+        return 0
+
+    if baseline is None:
+        print "No baseline in %s, make one with --save" % args.baseline
+        return 0
+    worse = regressions(results, baseline, args.tolerance)
+    for name, w in worse:
+        print "REGRESSION %s" % w
+    return worse and 1 or 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -6,15 +6,35 @@
 #    zeoctl="/home/zope/bin/zeoserver" \
 #    zeosock="/home/zope/var/zeo.sock" \
 #    zeouser="zope" \
+#    zeoaddress="127.0.0.1:8100" \
 #    op start   timeout="3600s" on-fail="stop" \
 #    op stop    timeout="60s" on-fail="block" \
 #    op monitor timeout="29s" interval="30s" on-fail="restart" \
+#    op monitor timeout="29s" interval="60s" on-fail="restart" \
+#       OCF_CHECK_LEVEL="10"
+#
+# The deep monitor (OCF_CHECK_LEVEL 10 or higher) connects to the storage
+# server on zeoaddress and times a lastTransaction call, which catches a
+# server that is alive according to zdrun but not answering clients.
+#
+# Several ZEO servers can be managed as a single resource by giving
+# space delimited lists for zeoctl, zeosock and zeoaddress. They are
+# queried, started and stopped in parallel (at most "parallel" at a time),
+# and the resource is only running when all of them are:
+#
+#  primitive zeos ocf:upfront:zeo  params \
+#    zeoctl="/home/zope/bin/zeo1 /home/zope/bin/zeo2" \
+#    zeosock="/home/zope/var/zeo1.sock /home/zope/var/zeo2.sock" \
+#    ...
 
 import sys
-import re
+import errno
+import signal
 import socket
+import time
+import threading
+import Queue
 import os
-import pickle
 import pwd
 import subprocess
 import shlex
@@ -22,6 +42,13 @@ import syslog
 from ctypes import cdll
 import logging
 
+# The storage probe is shared with check_zeo. The package installs it in
+# ../../lib/upfront, in a source checkout it is in ../nagios.
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path[:0] = [os.path.join(HERE, '..', '..', 'lib', 'upfront'),
+    os.path.join(HERE, '..', 'nagios')]
+from zeoprobe import ZEOProbe, ZEOProbeFailed
+
 # Set up logging to HAlogd
 class HALogStream(object):
     def __init__(self):
@@ -67,36 +94,15 @@ logger.addHandler(handler)
 
 logger.setLevel(logging.INFO)
 
-# Decorators for dropping privileges and forking
-def fork_and_exec(fn):
-    def _fork_and_run(*args, **kwargs):
-        readend, writeend = os.pipe()
-        readend = os.fdopen(readend, "r")
-        writeend = os.fdopen(writeend, "w")
-        pid = os.fork()
-        if pid==0:
-            # =-=-=-= Child process starts =-=-=-=
-            readend.close()
-            result = fn(*args, **kwargs)
-            pickle.dump(result, writeend)
-            writeend.flush()
-            os._exit(0)
-            # =-=-=-= Child process ends =-=-=-=
-        writeend.close()
-        result = pickle.load(readend)
-        pid, status = os.waitpid(pid, 0)
-        return result
-    return _fork_and_run
-
-def drop_privileges(user):
-    def _wrap(fn):
-        def _new(*args, **kwargs):
-            pw = pwd.getpwnam(user)
-            os.setregid(pw[3], pw[3])
-            os.setreuid(pw[2], pw[2])
-            return fn(*args, **kwargs)
-        return _new
-    return _wrap
+def demote(user):
+    """ Returns a function that drops privileges to user, meant to be used
+        as preexec_fn. The user is looked up here in the parent, the child
+        should do as little as possible. """
+    pw = pwd.getpwnam(user)
+    def _demote():
+        os.setregid(pw[3], pw[3])
+        os.setreuid(pw[2], pw[2])
+    return _demote
 
 class CommandFailed(Exception):
     def __init__(self, code, msg):
@@ -104,42 +110,295 @@ class CommandFailed(Exception):
         self.code = code
         self.msg = msg
 
-def sh(command):
+def sh(command, preexec_fn=None, deadline=None):
+    """ Run command, and return its output. If it is still running at
+        deadline it is killed. """
     p = subprocess.Popen(shlex.split(command),
-        stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+        preexec_fn=preexec_fn, close_fds=True)
+    while deadline is not None and p.poll() is None:
+        if time.time() >= deadline:
+            p.kill()
+            p.wait()
+            raise CommandFailed(p.returncode, "%s timed out" % command)
+        time.sleep(0.1)
     p.wait()
     response = p.stdout.read()
     if p.returncode != 0:
         raise CommandFailed(p.returncode, response)
     return response
 
+class DataObject(object):
+    """ An object holding data on its attributes. """
+    def __init__(self, **kwargs):
+        for k, v in kwargs.items():
+            setattr(self, k, v)
+
+def _zdrun_value(value):
+    # zdrun sends most values through repr()
+    for conv in (int, float):
+        try:
+            return conv(value)
+        except ValueError:
+            pass
+    if value[:1] in ("'", '"') and value[-1:] == value[:1]:
+        return value[1:-1]
+    return value
+
+def parse_zdrun_status(response):
+    """ Parse the key=value lines zdrun sends in reply to a status command
+        into a DataObject. pid is the application pid, 0 if it isn't
+        running. uptime is how long it has been up, and restarting is true
+        if zdrun wants it up but it isn't (it is in backoff). """
+    values = {}
+    for line in response.splitlines():
+        if '=' in line:
+            k, v = line.split('=', 1)
+            values[k.strip()] = _zdrun_value(v.strip())
+    pid = values.get('application') or 0
+    should_be_up = bool(values.get('should_be_up', 0))
+    uptime = 0
+    if pid and values.get('lasttime'):
+        now = values.get('now') or time.time()
+        uptime = max(now - values['lasttime'], 0)
+    return DataObject(
+        pid = pid,
+        should_be_up = should_be_up,
+        uptime = uptime,
+        backoff = values.get('backoff', 0),
+        delay = values.get('delay', 0),
+        restarting = should_be_up and not pid,
+        values = values)
+
+class ZdrunError(Exception):
+    """ zdrun has its socket open, but isn't answering properly. """
+
+class ZdrunClient(object):
+    """ Talks to the zdrun control socket. Every call is bounded by the
+        connect and read timeouts, so a wedged zdrun can't hang the agent
+        until pacemaker kills it. """
+
+    def __init__(self, sockname, connect_timeout=2, read_timeout=5):
+        self.sockname = sockname
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+
+    def send_action(self, action):
+        """ Send an action to the zdrun server and return the response.
+            Return None if the server is not up. Raises ZdrunError if it
+            is up but doesn't answer in time, or on any other error, so a
+            wedged zdrun is not mistaken for a stopped one. """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.settimeout(self.connect_timeout)
+                sock.connect(self.sockname)
+                deadline = time.time() + self.read_timeout
+                sock.settimeout(self.read_timeout)
+                sock.sendall(action + "\n")
+                sock.shutdown(1) # We're not writing any more
+                chunks = []
+                while 1:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise socket.timeout("read timed out")
+                    sock.settimeout(remaining)
+                    data = sock.recv(4096)
+                    if not data:
+                        break
+                    chunks.append(data)
+                return ''.join(chunks)
+            except socket.error, e:
+                if getattr(e, 'errno', None) in (errno.ENOENT,
+                        errno.ECONNREFUSED):
+                    return None # Nobody listening, zdrun is not running
+                logger.info("zdrun %s on %s failed: %s", action,
+                    self.sockname, e)
+                raise ZdrunError("zdrun %s failed: %s" % (action, e))
+        finally:
+            sock.close()
+
+    def status(self):
+        """ Returns the parsed status, or None if zdrun isn't running.
+            Raises ZdrunError if it isn't answering. """
+        resp = self.send_action("status")
+        if resp is None:
+            return None
+        if not resp:
+            raise ZdrunError("zdrun sent an empty status")
+        return parse_zdrun_status(resp)
+
 def send_zeo_action(sockname, action):
-    """Send an action to the zdrun server and return the response.
-       Return None if the server is not up or any other error happened. """
-    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-    try:
-        sock.connect(sockname)
-        sock.send(action + "\n")
-        sock.shutdown(1) # We're not writing any more
-        response = ""
-        while 1:
-            data = sock.recv(1000)
-            if not data:
-                break
-            response += data
-        sock.close()
-        return response
-    except socket.error, msg:
-        return None
+    return ZdrunClient(sockname).send_action(action)
 
 def get_zeo_status(sockname):
-    resp = send_zeo_action(sockname, "status")
-    if not resp:
+    status = ZdrunClient(sockname).status()
+    if status is None:
         return 0
-    m = re.search("(?m)^application=(\d+)$", resp)
-    if not m:
+    return status.pid
+
+def parallel(fn, items, concurrency):
+    """ Call fn for each of items using at most concurrency threads, and
+        return the results in the same order as items. """
+    results = [None] * len(items)
+    queue = Queue.Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            results[i] = fn(item)
+
+    threads = [threading.Thread(target=worker)
+        for i in range(max(min(concurrency, len(items)), 1))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+def wait_for_exit(pid, deadline, interval=0.1, maxinterval=2.0):
+    """ Wait for pid to go away, polling with exponential backoff. Returns
+        False if it is still there at deadline. """
+    while pid_exists(pid):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 2, maxinterval)
+    return True
+
+class ZEOInstance(object):
+    """ One ZEO server managed by the agent. The methods return OCF exit
+        codes. """
+
+    def __init__(self, zeoctl, zeosock, zeoaddress, settings):
+        self.zeoctl = zeoctl
+        self.zeosock = zeosock
+        self.zeoaddress = zeoaddress
+        self.settings = settings
+        self.zdrun = ZdrunClient(zeosock,
+            min(settings.zdruntimeout, 2), settings.zdruntimeout)
+
+    def __str__(self):
+        return self.zeoctl
+
+    def _zeoctl(self, action, deadline=None):
+        cmd = "%s %s" % (self.zeoctl, action)
+        logger.info("calling %s", cmd)
+        try:
+            sh(cmd, preexec_fn=demote(self.settings.zeouser),
+                deadline=deadline)
+        except CommandFailed, e:
+            logger.info(e)
+            return 1
+        return 0
+
+    def status(self):
+        return self.zdrun.status()
+
+    def start(self, deadline=None):
+        """ Start the server, giving up shortly before deadline, when
+            pacemaker times out the start of the whole resource. """
+        optimeout = self.settings.optimeout
+        deadline = deadline or time.time() + optimeout
+        try:
+            status = self.status()
+        except ZdrunError, e:
+            logger.info("%s: %s, not starting it", self, e)
+            return 1
+        if status is None or not status.pid:
+            if time.time() >= deadline - optimeout * 0.05:
+                logger.info("%s: no time left to start it", self)
+                return 1
+            return self._zeoctl('start', deadline - optimeout * 0.05)
         return 0
-    return int(m.group(1))
+
+    def stop(self, deadline=None):
+        """ Stop the server before deadline, when pacemaker times out the
+            stop of the whole resource. Instances that wait for a worker
+            get less time, not a timeout of their own. """
+        started = time.time()
+        optimeout = self.settings.optimeout
+        deadline = deadline or started + optimeout
+        try:
+            status = self.status()
+        except ZdrunError, e:
+            # We can't tell if ZEO is still running, so the stop has to
+            # fail and leave it to pacemaker's on-fail.
+            logger.info("%s: %s, cannot stop it", self, e)
+            return 1
+        if status is None or not status.pid:
+            return 0
+
+        self._zeoctl('stop')
+
+        # A ZEO server that is killed before it writes out its index has to
+        # rebuild it on the next start, which takes a long time on a big
+        # storage. So give it most of the op timeout to exit by itself, and
+        # only kill it if pacemaker would otherwise time us out.
+        if wait_for_exit(status.pid, deadline - optimeout * 0.2):
+            logger.info("ZEO pid %d exited after %.1fs", status.pid,
+                time.time() - started)
+            return 0
+
+        logger.info("ZEO pid %d still running after %.1fs, killing it",
+            status.pid, time.time() - started)
+        try:
+            os.kill(status.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        if wait_for_exit(status.pid, deadline - optimeout * 0.05):
+            logger.info("ZEO pid %d killed after %.1fs, its index will be "
+                "rebuilt on the next start", status.pid, time.time() - started)
+            return 0
+        return 1
+
+    def _probe(self):
+        """ Deep check, make sure the storage server answers clients. """
+        try:
+            connect, rtt = ZEOProbe(self.zeoaddress, self.settings.zeostorage,
+                self.settings.zeolatency).probe()
+        except ZEOProbeFailed, e:
+            logger.info("ZEO storage probe on %s failed: %s",
+                self.zeoaddress, e)
+            return False
+        logger.info("ZEO storage %s connect %.3fs, lastTransaction %.3fs",
+            self.zeoaddress, connect, rtt)
+        return rtt <= self.settings.zeolatency
+
+    def monitor(self):
+        try:
+            status = self.status()
+        except ZdrunError, e:
+            logger.info("%s: %s", self, e)
+            return 1 # OCF_ERR_GENERIC, it is not cleanly stopped
+        if status is None:
+            return 7
+        if status.pid > 0:
+            if self.settings.checklevel >= 10 and self.zeoaddress:
+                if not self._probe():
+                    return 1
+            return 0
+        if status.restarting:
+            # zdrun wants it up, but it keeps dying. Don't report it as
+            # cleanly stopped.
+            logger.info("%s is restarting (backoff %s)", self,
+                status.backoff)
+            return 1
+        return 7
 
 class ResourceAgent(object):
     def __init__(self):
@@ -152,42 +411,68 @@ class ResourceAgent(object):
             'methods': self.methods
         }
         self.resourcename = os.environ.get('OCF_RESOURCE_INSTANCE', 'zeo'),
+        # zeoctl, zeosock and zeoaddress may be space delimited lists to
+        # manage several ZEO servers as one resource, paired up by position.
         self.zeoctl = os.environ.get('OCF_RESKEY_zeoctl', '/home/zope/bin/zeoserver')
         self.zeosock = os.environ.get('OCF_RESKEY_zeosock', '/home/zope/var/zeo.sock')
         self.zeouser = os.environ.get('OCF_RESKEY_zeouser', 'zope')
-
-    def _zeoctl(self, action):
-        cmd = "%s %s" % (self.zeoctl, action)
-        logger.info("calling %s", cmd)
-        try:
-            sh(cmd)
-        except CommandFailed, e:
-            logger.info(e)
-            return 1
-        return 0
-
-    def _status(self):
-        return get_zeo_status(self.zeosock) > 0
+        self.zeoaddress = os.environ.get('OCF_RESKEY_zeoaddress', '')
+        self.zeostorage = os.environ.get('OCF_RESKEY_zeostorage', '1')
+        self.zeolatency = float(os.environ.get('OCF_RESKEY_zeolatency', '5'))
+        self.zdruntimeout = float(
+            os.environ.get('OCF_RESKEY_zdruntimeout', '5'))
+        self.parallel = int(os.environ.get('OCF_RESKEY_parallel', '4'))
+        self.checklevel = int(os.environ.get('OCF_CHECK_LEVEL', '0'))
+        # Pacemaker passes the operation timeout in milliseconds
+        self.optimeout = int(
+            os.environ.get('OCF_RESKEY_CRM_meta_timeout', '60000')) / 1000.0
+
+        zeoctls = self.zeoctl.split()
+        zeosocks = self.zeosock.split()
+        zeoaddresses = self.zeoaddress.split()
+        zeoaddresses += [''] * (len(zeoctls) - len(zeoaddresses))
+        if len(zeoctls) == len(zeosocks):
+            self.instances = [ZEOInstance(c, s, a, self)
+                for c, s, a in zip(zeoctls, zeosocks, zeoaddresses)]
+        else:
+            self.instances = None
+
+    def _each(self, fn, *args):
+        """ Call fn on all instances in parallel, return the results. """
+        def _call(instance):
+            try:
+                return fn(instance, *args)
+            except Exception:
+                logger.exception("%s failed on %s", fn.__name__, instance)
+                return 1
+        return parallel(_call, self.instances, self.parallel)
+
+    def _report(self, action, results):
+        if len(self.instances) > 1:
+            for instance, result in zip(self.instances, results):
+                logger.info("%s %s: %d", action, instance, result)
 
     def start(self):
-        if not self._status():
-            _c = drop_privileges(self.zeouser)(self._zeoctl)
-            _c = fork_and_exec(_c)
-            return _c('start')
-        return 0
+        # One deadline for all instances, however many wait for a worker
+        deadline = time.time() + self.optimeout
+        results = self._each(ZEOInstance.start, deadline)
+        self._report('start', results)
+        return max(results)
 
     def stop(self):
-        if self._status():
-            _c = drop_privileges(self.zeouser)(self._zeoctl)
-            fork_and_exec(_c)('stop')
-        if self._status():
-            return 7
-        return 0
+        deadline = time.time() + self.optimeout
+        results = self._each(ZEOInstance.stop, deadline)
+        self._report('stop', results)
+        return max(results)
 
     def monitor(self):
-        if self._status():
-            return 0
-        return 7
+        results = self._each(ZEOInstance.monitor)
+        self._report('monitor', results)
+        if len(set(results)) == 1:
+            # All running, or all cleanly stopped
+            return results[0]
+        # Partially running. That is a failure, not a stopped resource.
+        return 1
 
     def metadata(self):
         print """\
@@ -203,12 +488,14 @@ class ResourceAgent(object):
 
     <parameters>
         <parameter name="zeoctl" unique="0" required="0">
-            <longdesc lang="en">Path to zeoctl script.</longdesc>
+            <longdesc lang="en">Path to zeoctl script. A space delimited
+            list manages several ZEO servers as one resource.</longdesc>
             <shortdesc lang="en">zeoctl</shortdesc>
             <content type="string" default="{zeoctl}" />
         </parameter>
         <parameter name="zeosock" unique="0" required="0">
-            <longdesc lang="en">Path to unix socket for ZEO server.</longdesc>
+            <longdesc lang="en">Path to unix socket for ZEO server. A space
+            delimited list, one for each zeoctl.</longdesc>
             <shortdesc lang="en">zeosock</shortdesc>
             <content type="string" default="{zeosock}" />
         </parameter>
@@ -217,13 +504,44 @@ class ResourceAgent(object):
             <shortdesc lang="en">zeouser</shortdesc>
             <content type="string" default="{zeouser}" />
         </parameter>
+        <parameter name="zdruntimeout" unique="0" required="0">
+            <longdesc lang="en">Seconds to wait for zdrun to answer on
+            zeosock.</longdesc>
+            <shortdesc lang="en">zdruntimeout</shortdesc>
+            <content type="string" default="{zdruntimeout}" />
+        </parameter>
+        <parameter name="parallel" unique="0" required="0">
+            <longdesc lang="en">How many ZEO servers to start, stop or query
+            at the same time.</longdesc>
+            <shortdesc lang="en">parallel</shortdesc>
+            <content type="string" default="{parallel}" />
+        </parameter>
+        <parameter name="zeoaddress" unique="0" required="0">
+            <longdesc lang="en">Address (host:port or unix socket) the ZEO
+            server listens on, used by the deep monitor. A space delimited
+            list, one for each zeoctl.</longdesc>
+            <shortdesc lang="en">zeoaddress</shortdesc>
+            <content type="string" default="" />
+        </parameter>
+        <parameter name="zeostorage" unique="0" required="0">
+            <longdesc lang="en">Name of the storage to probe.</longdesc>
+            <shortdesc lang="en">zeostorage</shortdesc>
+            <content type="string" default="{zeostorage}" />
+        </parameter>
+        <parameter name="zeolatency" unique="0" required="0">
+            <longdesc lang="en">Seconds a lastTransaction call may take before
+            the deep monitor fails.</longdesc>
+            <shortdesc lang="en">zeolatency</shortdesc>
+            <content type="string" default="{zeolatency}" />
+        </parameter>
     </parameters>
 
     <actions>
         <action name="start" timeout="30" />
-        <action name="stop" timeout="30" />
+        <action name="stop" timeout="60" />
         <action name="status" timeout="10" />
         <action name="monitor" depth="0" timeout="10" interval="30"/>
+        <action name="monitor" depth="10" timeout="20" interval="60"/>
         <action name="meta-data" timeout="5" />
         <action name="methods" timeout="5" />
     </actions>
@@ -231,10 +549,25 @@ class ResourceAgent(object):
         return 0
 
     def status(self):
-        if self._status() :
-            print >>sys.stderr, "Zeo is up"
-        else:
-            print >>sys.stderr, "Zeo is down"
+        def _status(instance):
+            try:
+                return instance.status()
+            except ZdrunError, e:
+                return e
+        for instance, status in zip(self.instances,
+                parallel(_status, self.instances, self.parallel)):
+            if isinstance(status, ZdrunError):
+                print >>sys.stderr, "%s: %s" % (instance, status)
+            elif status is None:
+                print >>sys.stderr, "%s: zdrun is down" % instance
+            elif status.pid:
+                print >>sys.stderr, "%s: up, pid %d, uptime %ds" % (
+                    instance, status.pid, status.uptime)
+            elif status.restarting:
+                print >>sys.stderr, "%s: restarting, backoff %s" % (
+                    instance, status.backoff)
+            else:
+                print >>sys.stderr, "%s: down" % instance
         return 0
 
     def methods(self):
@@ -244,6 +577,9 @@ class ResourceAgent(object):
         logger.info("Calling action %s on %s", a, self.resourcename)
         action = self._actions.get(a, None)
         assert action is not None, "Invalid method"
+        if self.instances is None and a not in ('meta-data', 'methods'):
+            logger.info("zeoctl and zeosock lists differ in length")
+            return 6 # OCF_ERR_CONFIGURED
         result = action()
         logger.info("result: %d", result)
         return result
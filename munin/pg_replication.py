@@ -0,0 +1,299 @@
+#!/usr/bin/python
+#
+# Munin plugin that graphs how far behind the postgresql replicas are, in
+# bytes of WAL not yet received and not yet replayed. There is one graph
+# with the replay lag of every standby, and a graph for each standby with
+# both its receive and replay lag.
+#
+# Give the DSN of every node in the plugin configuration, the master is
+# found by asking each of them whether it is in recovery. The part of the
+# name after dsn_ names the node on the graphs.
+#
+#   [pg_replication]
+#   env.dsn_db1 host=10.0.0.11 port=5432 dbname=template1 user=monitor
+#   env.dsn_db2 host=10.0.0.12 port=5432 dbname=template1 user=monitor
+#   env.timeout 5
+#
+# Passwords belong in ~/.pgpass of the user munin runs the plugin as.
+#
+# To sample more often than munin polls, set env.update_rate (in seconds)
+# and run "pg_replication acquire" that often, from munin-asyncd or cron.
+# Samples are spooled in $MUNIN_PLUGSTATE and handed to munin with their
+# timestamps on the next fetch.
+#
+# This is a multigraph plugin, it needs munin 1.4 or later on both the node
+# and the master. On a node that doesn't announce multigraph support it says
+# so instead of sending output the master can't parse.
+#
+#%# family=auto
+#%# capabilities=autoconf multigraph
+
+import sys
+import os
+import re
+import time
+import fcntl
+import threading
+
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..', 'nagios'))
+import pglsn
+
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+def clean_fieldname(name):
+    name = re.sub('[^A-Za-z0-9_]', '_', name)
+    if not name or name[0].isdigit():
+        name = '_' + name
+    return name
+
+def get_dsns():
+    """ The configured nodes as (name, dsn) tuples, sorted by name. """
+    return sorted([(k[4:], v) for k, v in os.environ.items()
+        if k.startswith('dsn_') and v])
+
+class Node(object):
+    def __init__(self, name, dsn, timeout):
+        self.name = name
+        self.dsn = dsn
+        self.timeout = timeout
+        self.db = None
+        self.recovery = None
+        self.receive = None
+        self.replay = None
+        self.current = None
+
+    def connect(self):
+        try:
+            self.db = psycopg2.connect("%s connect_timeout=%d "
+                "options='-c statement_timeout=%d'" % (
+                self.dsn, self.timeout, self.timeout * 1000))
+        except psycopg2.Error:
+            self.db = None
+
+    def query_standby(self):
+        if self.db is None:
+            return
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT pg_is_in_recovery(), %(receive)s(), "
+                "%(replay)s()" % pglsn.functions(self.db.server_version))
+            self.recovery, self.receive, self.replay = c.fetchone()
+        except psycopg2.Error:
+            self.close()
+
+    def query_master(self):
+        if self.db is None:
+            return
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT %(current)s()" % \
+                pglsn.functions(self.db.server_version))
+            self.current = c.fetchone()[0]
+        except psycopg2.Error:
+            self.close()
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+def in_parallel(nodes, fn):
+    threads = [threading.Thread(target=fn, args=(node,)) for node in nodes]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def sample(dsns, timeout):
+    """ Returns the time and a (receive, replay) tuple for every standby
+        name. Lag is None if it could not be determined. """
+    nodes = [Node(name, dsn, timeout) for name, dsn in dsns]
+    try:
+        in_parallel(nodes, Node.connect)
+        in_parallel(nodes, Node.query_standby)
+        # Take the master's position last, so no standby can be in front
+        masters = [n for n in nodes if n.db is not None and not n.recovery]
+        in_parallel(masters, Node.query_master)
+    finally:
+        for node in nodes:
+            node.close()
+
+    now = int(time.time())
+    master = None
+    if len(masters) == 1 and masters[0].current is not None:
+        master = masters[0].current
+
+    result = {}
+    for node in nodes:
+        if node in masters:
+            continue
+        if master is None or node.receive is None or node.replay is None:
+            result[node.name] = (None, None)
+        else:
+            result[node.name] = tuple(
+                pglsn.lags(master, [node.receive, node.replay]))
+    return now, result
+
+def standby_names(dsns):
+    """ Every node may become a standby, so all of them get graphed. """
+    return [name for name, dsn in dsns]
+
+def format_value(value, timestamp=None):
+    if value is None:
+        value = 'U'
+    if timestamp is None:
+        return str(value)
+    return '%d:%s' % (timestamp, value)
+
+def print_values(dsns, samples, with_time):
+    names = standby_names(dsns)
+    print "multigraph pg_replication"
+    for timestamp, lags in samples:
+        for name in names:
+            receive, replay = lags.get(name, (None, None))
+            print "%s.value %s" % (clean_fieldname(name),
+                format_value(replay, with_time and timestamp or None))
+    for name in names:
+        print "multigraph pg_replication.%s" % clean_fieldname(name)
+        for timestamp, lags in samples:
+            receive, replay = lags.get(name, (None, None))
+            ts = with_time and timestamp or None
+            print "receive.value %s" % format_value(receive, ts)
+            print "replay.value %s" % format_value(replay, ts)
+
+def print_config(dsns, update_rate):
+    names = standby_names(dsns)
+    rate = ''
+    if update_rate:
+        rate = "update_rate %d\ngraph_data_size custom 1d, %ds for 1w, " \
+            "5m for 1t, 1h for 1y\n" % (update_rate, update_rate * 6)
+    print "multigraph pg_replication"
+    print "graph_title PostgreSQL replication lag"
+    print "graph_vlabel bytes"
+    print "graph_args --base 1024 -l 0"
+    print "graph_category postgresql"
+    print "graph_info Bytes of WAL each standby still has to replay"
+    sys.stdout.write(rate)
+    for name in names:
+        field = clean_fieldname(name)
+        print "%s.label %s" % (field, name)
+        print "%s.min 0" % field
+    for name in names:
+        print "multigraph pg_replication.%s" % clean_fieldname(name)
+        print "graph_title PostgreSQL replication lag on %s" % name
+        print "graph_vlabel bytes"
+        print "graph_args --base 1024 -l 0"
+        print "graph_category postgresql"
+        sys.stdout.write(rate)
+        print "receive.label receive"
+        print "receive.info Bytes of WAL not yet received"
+        print "receive.min 0"
+        print "replay.label replay"
+        print "replay.info Bytes of WAL not yet replayed"
+        print "replay.min 0"
+
+class Spool(object):
+    """ Samples taken by acquire, waiting for the next fetch. """
+
+    def __init__(self):
+        state = os.environ.get('MUNIN_PLUGSTATE', '/var/lib/munin-node/plugin-state')
+        self.path = os.path.join(state, 'pg_replication.spool')
+
+    def add(self, timestamp, lags):
+        fp = open(self.path, 'a')
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            for name, (receive, replay) in lags.items():
+                fp.write("%d %s %s %s\n" % (timestamp, name,
+                    format_value(receive), format_value(replay)))
+        finally:
+            fp.close()
+
+    def take(self):
+        """ Return all spooled samples, oldest first, and empty the spool. """
+        try:
+            fp = open(self.path, 'r+')
+        except IOError:
+            return []
+        try:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+            lines = fp.readlines()
+            fp.seek(0)
+            fp.truncate()
+        finally:
+            fp.close()
+        samples = {}
+        for line in lines:
+            try:
+                timestamp, name, receive, replay = line.split()
+                timestamp = int(timestamp)
+            except ValueError:
+                continue
+            samples.setdefault(timestamp, {})[name] = tuple([
+                None if v == 'U' else int(v) for v in (receive, replay)])
+        return sorted(samples.items())
+
+def need_multigraph(command):
+    """ Like need_multigraph in Munin::Plugin. Returns True if the node
+        supports multigraph, otherwise prints what munin should see
+        instead and returns False. """
+    if os.environ.get('MUNIN_CAP_MULTIGRAPH') == '1':
+        return True
+    if command == 'autoconf':
+        print "no (no multigraph support)"
+    elif command == 'config':
+        print "graph_title This plugin needs multigraph support"
+        print "multigraph.label No multigraph here"
+        print "multigraph.info This node does not support multigraph plugins"
+    else:
+        print "multigraph.value 0"
+    return False
+
+def main():
+    dsns = get_dsns()
+    timeout = int(os.environ.get('timeout', '5'))
+    update_rate = int(os.environ.get('update_rate', '0'))
+    command = len(sys.argv) > 1 and sys.argv[1] or 'fetch'
+
+    # acquire runs outside of munin, and doesn't talk to it
+    if command != 'acquire' and not need_multigraph(command):
+        return 0
+
+    if command == 'autoconf':
+        if psycopg2 is None:
+            print "no (python-psycopg2 not installed)"
+        elif not dsns:
+            print "no (no env.dsn_* configured)"
+        else:
+            print "yes"
+        return 0
+
+    if psycopg2 is None:
+        print >>sys.stderr, "python-psycopg2 not installed"
+        return 1
+    if not dsns:
+        print >>sys.stderr, "No env.dsn_* configured"
+        return 1
+
+    if command == 'config':
+        print_config(dsns, update_rate)
+        return 0
+
+    if command == 'acquire':
+        Spool().add(*sample(dsns, timeout))
+        return 0
+
+    if update_rate:
+        samples = Spool().take()
+        if samples:
+            print_values(dsns, samples, True)
+            return 0
+    print_values(dsns, [sample(dsns, timeout)], False)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
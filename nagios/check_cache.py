@@ -6,23 +6,67 @@
 # caching. A linux host performs best if it has a healthy amount of memory
 # allocated to caching, and when you squeeze out caching memory the host
 # generally starts to thrash. This plugin checks for healthy amounts of cache.
+#
+# Because the amount of cache alone doesn't tell you whether the host is
+# actually thrashing, it also looks at the signs of it: time tasks spend
+# stalled on memory from /proc/pressure/memory (kernel 4.20 and later), and
+# the rate of major faults and of pages scanned and stolen by reclaim from
+# /proc/vmstat. The rates are worked out from the previous sample, which is
+# kept in --state-dir.
+#
+# Services sharing a host can squeeze each other's cache while the host as a
+# whole looks fine, so with --cgroup it also looks at the memory accounting
+# of a cgroup or systemd unit: how much of its memory is page cache, and
+# whether it hit its high or max limit or had processes OOM killed since the
+# last check. Both cgroup v1 and v2 (unified) hierarchies are understood.
+#
+# On machines with more than one NUMA node a single node can run out of free
+# and cache memory, causing remote allocations and zone reclaim, while the
+# host totals look fine. With --numa the cache and free thresholds are also
+# applied to every node, nodes that are far apart are flagged, and the rate
+# of allocations that missed their preferred node is checked.
 
 import sys
 import os
+import re
+import glob
+import time
 import argparse
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("-w", "--warning", type=float,
-        help="Warning memory percentage", default=1.0)
-    parser.add_argument("-c", "--critical", type=float,
-        help="Critical memory percentage", default=0.5)
-    args = parser.parse_args()
+from checklib import State, evaluate, deltas, rates, from_runner
+
+GOOD = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+status_text = {
+    GOOD: 'OK',
+    WARNING: 'WARNING',
+    CRITICAL: 'CRITICAL',
+    UNKNOWN: 'UNKNOWN'
+}
+
+MEMINFO = '/proc/meminfo'
+PRESSURE = '/proc/pressure/memory'
+VMSTAT = '/proc/vmstat'
+CGROUP_ROOT = '/sys/fs/cgroup'
+NODE_ROOT = '/sys/devices/system/node'
+
+# Scanned and stolen pages are broken down by who did the reclaim (and on
+# older kernels by zone), and also by anon/file. Only add up the former.
+RECLAIM_RE = re.compile(r'^pg(scan|steal)_(kswapd|direct|khugepaged|proactive)'
+    r'(_(dma|dma32|normal|movable|high))?$')
+
+class CheckError(Exception):
+    pass
 
+def read_meminfo(path=MEMINFO):
+    """ Returns total, cached and free memory in kB. """
     total = None
     cache = None
     free = None
-    fp = open('/proc/meminfo', 'r')
+    fp = open(path, 'r')
     for l in fp.readlines():
         if l.startswith('Cached:'):
             cache = [x.strip() for x in l.strip().split(':')][1]
@@ -30,33 +74,402 @@ def main():
             free = [x.strip() for x in l.strip().split(':')][1]
         elif l.startswith('MemTotal:'):
             total = [x.strip() for x in l.strip().split(':')][1]
+    fp.close()
 
     if cache is None:
-        print "Could not parse Cached from /proc/meminfo"
-        sys.exit(3)
+        raise CheckError("Could not parse Cached from %s" % path)
     if free is None:
-        print "Could not parse MemFree from /proc/meminfo"
-        sys.exit(3)
+        raise CheckError("Could not parse MemFree from %s" % path)
     if total is None:
-        print "Could not parse MemTotal from /proc/meminfo"
-        sys.exit(3)
+        raise CheckError("Could not parse MemTotal from %s" % path)
 
-    cache = int(cache.split()[0])
-    free = int(free.split()[0])
-    total = int(total.split()[0])
+    return (int(total.split()[0]), int(cache.split()[0]),
+        int(free.split()[0]))
+
+def read_pressure(path=PRESSURE):
+    """ Returns the memory stall averages as a dict keyed on some and full,
+        then avg10, avg60 and avg300. None if the kernel doesn't have PSI. """
+    try:
+        fp = open(path, 'r')
+    except IOError:
+        return None
+    pressure = {}
+    try:
+        for line in fp:
+            fields = line.split()
+            if not fields:
+                continue
+            pressure[fields[0]] = dict([(k, float(v)) for k, v in
+                [f.split('=', 1) for f in fields[1:]] if k.startswith('avg')])
+    finally:
+        fp.close()
+    return pressure
+
+def read_vmstat(path=VMSTAT):
+    """ Returns the major fault, pages scanned and pages stolen counters. """
+    counters = {'pgmajfault': 0, 'pgscan': 0, 'pgsteal': 0}
+    fp = open(path, 'r')
+    try:
+        for line in fp:
+            name, value = line.split()
+            if name == 'pgmajfault':
+                counters['pgmajfault'] = int(value)
+            else:
+                m = RECLAIM_RE.match(name)
+                if m is not None:
+                    counters['pg' + m.group(1)] += int(value)
+    finally:
+        fp.close()
+    return counters
+
+def numa_nodes(root=NODE_ROOT):
+    """ The NUMA node directories, in node order. """
+    nodes = [(int(os.path.basename(p)[4:]), p) for p in
+        glob.glob(os.path.join(root, 'node[0-9]*'))]
+    return [p for n, p in sorted(nodes)]
+
+def read_node_meminfo(path):
+    """ Returns total, cached and free memory in kB for the node in path.
+        Per node there is no Cached, FilePages is the closest. """
+    values = {}
+    fp = open(os.path.join(path, 'meminfo'), 'r')
+    try:
+        for line in fp:
+            # Lines look like: Node 0 MemFree:  3233560 kB
+            fields = line.split()
+            if len(fields) >= 4:
+                values[fields[2].rstrip(':')] = int(fields[3])
+    finally:
+        fp.close()
+    try:
+        return values['MemTotal'], values['FilePages'], values['MemFree']
+    except KeyError, e:
+        raise CheckError("Could not parse %s from %s" % (e, path))
+
+def read_numastat(path):
+    """ Returns the allocation counters of the node in path, in pages. """
+    counters = {}
+    fp = open(os.path.join(path, 'numastat'), 'r')
+    try:
+        for line in fp:
+            name, value = line.split()
+            counters[name] = int(value)
+    finally:
+        fp.close()
+    return counters
+
+class CgroupSpec(object):
+    def __init__(self, spec):
+        """ spec looks like name or name:warning,critical, where the levels
+            are the lowest percentage of the cgroup's memory that should be
+            page cache. """
+        self.warning = self.critical = None
+        self.name = spec
+        if ':' in spec:
+            self.name, levels = spec.rsplit(':', 1)
+            try:
+                self.warning, self.critical = [float(x) for x in
+                    levels.split(',')]
+            except ValueError:
+                raise argparse.ArgumentTypeError(
+                    "Cgroup must look like name or name:warning,critical")
+        self.name = self.name.strip('/')
+        if not self.name:
+            raise argparse.ArgumentTypeError("Cgroup name is empty")
+
+class Cgroup(object):
+    """ The memory accounting of one cgroup, v1 or v2. """
+
+    def __init__(self, path, version):
+        self.path = path
+        self.version = version
+
+    @classmethod
+    def find(cls, name, root=None):
+        """ Find a cgroup by its path below the root of the hierarchy, or
+            by its last component, which is what a systemd unit is called. """
+        root = root or CGROUP_ROOT
+        if os.path.exists(os.path.join(root, 'cgroup.controllers')):
+            version, top = 2, root
+        else:
+            version, top = 1, os.path.join(root, 'memory')
+        path = os.path.join(top, name)
+        if os.path.isdir(path):
+            return cls(path, version)
+        if '/' not in name:
+            for dirpath, dirnames, filenames in os.walk(top):
+                if name in dirnames:
+                    return cls(os.path.join(dirpath, name), version)
+        return None
+
+    def _read(self, name):
+        values = {}
+        fp = open(os.path.join(self.path, name), 'r')
+        try:
+            for line in fp:
+                fields = line.split()
+                if len(fields) == 2:
+                    values[fields[0]] = int(fields[1])
+        finally:
+            fp.close()
+        return values
+
+    def stat(self):
+        """ Bytes of file, anon, active_file and inactive_file memory. """
+        stat = self._read('memory.stat')
+        if self.version == 1:
+            stat['file'] = stat.get('cache', 0)
+            stat['anon'] = stat.get('rss', 0)
+        return dict([(k, stat.get(k, 0)) for k in
+            ('file', 'anon', 'active_file', 'inactive_file')])
+
+    def events(self):
+        """ Counts of times the cgroup went over its high and max limits
+            and of OOMs. v1 only has the equivalent of max, in failcnt, and
+            of oom_kill. """
+        if self.version == 2:
+            events = self._read('memory.events')
+            # oom_kill only exists since linux 4.13
+            return dict([(k, events[k]) for k in
+                ('high', 'max', 'oom', 'oom_kill') if k in events])
+        events = {}
+        fp = open(os.path.join(self.path, 'memory.failcnt'), 'r')
+        try:
+            events['max'] = int(fp.read().strip())
+        finally:
+            fp.close()
+        oom = self._read('memory.oom_control')
+        if 'oom_kill' in oom:
+            events['oom_kill'] = oom['oom_kill']
+        return events
+
+def check_cgroup(spec, args):
+    """ Returns the status, message and perfdata for one cgroup. """
+    cgroup = Cgroup.find(spec.name)
+    if cgroup is None:
+        return UNKNOWN, "%s: no such cgroup" % spec.name, []
+    try:
+        stat = cgroup.stat()
+        events = cgroup.events()
+    except (IOError, ValueError), e:
+        return UNKNOWN, "%s: %s" % (spec.name, e), []
+
+    if spec.warning is None:
+        warning, critical = args.cgroup_warning, args.cgroup_critical
+    else:
+        warning, critical = spec.warning, spec.critical
+    used = stat['file'] + stat['anon']
+    if used:
+        pfile = stat['file'] * 100.0 / used
+    else:
+        pfile = 100.0 # Nothing in use, nothing to complain about
+    if pfile < critical:
+        status = CRITICAL
+    elif pfile < warning:
+        status = WARNING
+    else:
+        status = GOOD
+    message = "%s cached: %.0f%%" % (spec.name, pfile)
+
+    perfdata = ["'%s cached'=%.1f%%;%s;%s;0;100" % (spec.name, pfile, warning,
+        critical)]
+    for k in ('file', 'anon', 'active_file', 'inactive_file'):
+        perfdata.append("'%s %s'=%dB;;;0" % (spec.name, k, stat[k]))
+    for k in sorted(events):
+        perfdata.append("'%s %s'=%dc;;;0" % (spec.name, k, events[k]))
+
+    sample = (time.time(), events)
+    state = State(args.state_dir, 'check_cache.' + re.sub('[^A-Za-z0-9_.-]',
+        '_', spec.name))
+    d = deltas(state.swap(sample), sample)
+    if d is not None:
+        counts = d[1]
+        # On v2 an OOM kill also counts as an oom event, count it once.
+        # oom_kill is missing on older kernels, fall back to oom there.
+        if 'oom_kill' in counts:
+            ooms = counts['oom_kill']
+        else:
+            ooms = counts.get('oom', 0)
+        if ooms:
+            status = CRITICAL
+            message += ", %d OOM since last check" % ooms
+        elif counts.get('max', 0):
+            status = max(status, WARNING)
+            message += ", hit limit %d times since last check" % counts['max']
+
+    return status, message, perfdata
+
+def memory_status(pcache, pfree, warning, critical):
+    """ Memory is healthy while enough of it is either cache or free. """
+    if max(pfree, pcache) < critical:
+        return CRITICAL
+    if max(pfree, pcache) < warning:
+        return WARNING
+    return GOOD
+
+def check_numa(args):
+    """ Returns the status, messages and perfdata for the NUMA nodes. """
+    nodes = numa_nodes(NODE_ROOT)
+    if not nodes:
+        return UNKNOWN, ["no NUMA nodes in %s" % NODE_ROOT], []
+    status = GOOD
+    messages = []
+    perfdata = []
+    available = []
+    counters = {}
+    for path in nodes:
+        node = os.path.basename(path)
+        try:
+            total, cache, free = read_node_meminfo(path)
+            for k, v in read_numastat(path).items():
+                counters[node + ' ' + k] = v
+        except (IOError, ValueError, CheckError), e:
+            return UNKNOWN, ["%s: %s" % (node, e)], []
+        pcache = (cache * 100) / total
+        pfree = (free * 100) / total
+        available.append((pcache + pfree, node))
+        s = memory_status(pcache, pfree, args.warning, args.critical)
+        if s != GOOD:
+            messages.append("%s cached: %d%%, free: %d%%" % (node, pcache,
+                pfree))
+        status = max(status, s)
+        perfdata.append("'%s cached'=%d%%;%s;%s;0;100" % (node, pcache,
+            args.warning, args.critical))
+        perfdata.append("'%s free'=%d%%;%s;%s;0;100" % (node, pfree,
+            args.warning, args.critical))
+
+    lowest, highest = min(available), max(available)
+    if highest[0] - lowest[0] >= args.numa_imbalance:
+        status = max(status, WARNING)
+        messages.append("%s has %d%% cached or free, %s has %d%%" % (
+            lowest[1], lowest[0], highest[1], highest[0]))
+
+    sample = (time.time(), counters)
+    r = rates(State(args.state_dir, 'check_cache.numa').swap(sample), sample)
+    if r is not None:
+        for path in nodes:
+            node = os.path.basename(path)
+            miss = r.get(node + ' numa_miss', 0)
+            foreign = r.get(node + ' numa_foreign', 0)
+            s = evaluate(miss, args.numa_miss_warning, args.numa_miss_critical)
+            if s != GOOD:
+                messages.append("%s numa_miss: %.0f/s" % (node, miss))
+            status = max(status, s)
+            perfdata.append("'%s numa_miss'=%.1f;%s;%s;0" % (node, miss,
+                args.numa_miss_warning, args.numa_miss_critical))
+            perfdata.append("'%s numa_foreign'=%.1f;;;0" % (node, foreign))
+
+    if not messages:
+        messages.append("%d NUMA nodes" % len(nodes))
+    return status, messages, perfdata
+
+def check(args):
+    try:
+        total, cache, free = read_meminfo()
+    except (IOError, CheckError), e:
+        return UNKNOWN, str(e)
 
     pfree = (free * 100) / total
     pcache = (cache * 100) / total
 
-    if max(pfree, pcache) < args.critical:
-        print "CACHE CRITICAL - cached: %d%%, free: %d%%" % (pcache, pfree)
-        sys.exit(2)
-    elif max(pfree, pcache) < args.warning:
-        print "CACHE WARNING - cached: %d%%, free: %d%%" % (pcache, pfree)
-        sys.exit(1)
-    else:
-        print "CACHE OK - cached: %d%%, free: %d%%" % (pcache, pfree)
-        sys.exit(0)
+    status = memory_status(pcache, pfree, args.warning, args.critical)
+    messages = ["cached: %d%%, free: %d%%" % (pcache, pfree)]
+    perfdata = ["cached=%d%%;%s;%s;0;100" % (pcache, args.warning,
+            args.critical),
+        "free=%d%%;%s;%s;0;100" % (pfree, args.warning, args.critical)]
+
+    pressure = read_pressure()
+    if pressure is not None:
+        for kind in ('some', 'full'):
+            for avg in ('avg10', 'avg60'):
+                if avg in pressure.get(kind, {}):
+                    perfdata.append("psi_%s_%s=%.2f%%;%s;%s;0;100" % (
+                        kind, avg, pressure[kind][avg], args.psi_warning,
+                        args.psi_critical))
+        stall = pressure.get('some', {}).get('avg10')
+        if stall is not None:
+            status = max(status, evaluate(stall, args.psi_warning,
+                args.psi_critical))
+            messages.append("stalled: %.1f%%" % stall)
+
+    try:
+        counters = read_vmstat()
+    except (IOError, ValueError):
+        counters = None
+    if counters is not None:
+        sample = (time.time(), counters)
+        r = rates(State(args.state_dir, 'check_cache').swap(sample), sample)
+        if r is not None:
+            status = max(status, evaluate(r['pgmajfault'],
+                args.majfault_warning, args.majfault_critical))
+            messages.append("major faults: %.0f/s" % r['pgmajfault'])
+            perfdata.append("pgmajfault=%.1f;%s;%s;0" % (r['pgmajfault'],
+                args.majfault_warning, args.majfault_critical))
+            perfdata.append("pgscan=%.1f;;;0" % r['pgscan'])
+            perfdata.append("pgsteal=%.1f;;;0" % r['pgsteal'])
+
+    if args.numa:
+        s, m, p = check_numa(args)
+        status = max(status, s)
+        messages.extend(m)
+        perfdata.extend(p)
+
+    for spec in args.cgroup:
+        s, message, p = check_cgroup(spec, args)
+        status = max(status, s)
+        messages.append(message)
+        perfdata.extend(p)
+
+    return status, "CACHE %s - %s | %s" % (status_text[status],
+        ', '.join(messages), ' '.join(perfdata))
+
+def parse_args(argv=None):
+    """ Parse the arguments in argv, or on the command line. """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-w", "--warning", type=float,
+        help="Warning memory percentage", default=1.0)
+    parser.add_argument("-c", "--critical", type=float,
+        help="Critical memory percentage", default=0.5)
+    parser.add_argument("--psi-warning", type=float, default=10,
+        help="Warning level for percentage of time stalled on memory")
+    parser.add_argument("--psi-critical", type=float, default=25,
+        help="Critical level for percentage of time stalled on memory")
+    parser.add_argument("--majfault-warning", type=float, default=500,
+        help="Warning level for major faults per second")
+    parser.add_argument("--majfault-critical", type=float, default=2000,
+        help="Critical level for major faults per second")
+    parser.add_argument("-g", "--cgroup", action='append', type=CgroupSpec,
+        default=[], help="Also check a cgroup or systemd unit, as "
+        "name[:warning,critical], can be given more than once")
+    parser.add_argument("--cgroup-warning", type=float, default=20,
+        help="Warning level for percentage of a cgroup's memory that is cache")
+    parser.add_argument("--cgroup-critical", type=float, default=5,
+        help="Critical level for percentage of a cgroup's memory that is cache")
+    parser.add_argument("-N", "--numa", action='store_true',
+        help="Also check cache and free memory on every NUMA node")
+    parser.add_argument("--numa-imbalance", type=float, default=50,
+        help="Warn when the percentage of memory cached or free on two "
+        "nodes differs by this much")
+    parser.add_argument("--numa-miss-warning", type=float, default=1000,
+        help="Warning level for pages allocated off their preferred node "
+        "per second")
+    parser.add_argument("--numa-miss-critical", type=float, default=10000,
+        help="Critical level for pages allocated off their preferred node "
+        "per second")
+    parser.add_argument("--state-dir", default='/var/cache/siyavula-ha-scripts',
+        help="Where to keep the previous sample")
+    args = parser.parse_args(argv)
+
+    return args
+
+def main():
+    # The runner may already have the answer
+    result = from_runner('check_cache')
+    if result is None:
+        result = check(parse_args())
+    status, output = result
+    print output
+    sys.exit(status)
 
 if __name__ == "__main__":
     main()
@@ -4,40 +4,293 @@
 #
 # This is a simple disk space plugin, except that file systems that are not
 # mounted are deemed to be OK - They are mounted somewhere else.
+#
+# Any number of file systems can be checked at once, and with --drbd every
+# drbd device mounted here is found in /proc/mounts and checked too. Free
+# space is what is available to ordinary users (f_bavail), so the space
+# reserved for root doesn't hide a full file system, and free inodes are
+# checked as well. A history of samples is kept for each file system in
+# --history-dir, and from how fast it is filling up the time until it is
+# full is forecast, which has its own thresholds in hours.
+#
+# A degraded replication link shows up as slow fsyncs long before anything
+# else notices. With --probe a small file is written and fsynced on every
+# mounted file system, bypassing the page cache with O_DIRECT where the file
+# system allows it, a few times with a pause in between, and the median
+# latency is checked. To keep the probe from adding load it runs at most
+# every --probe-every seconds, in between the last result is reported.
 
 import sys
 import os
+import re
+import time
+import mmap
+import errno
 import argparse
 
-def main():
+from checklib import History, evaluate, from_runner
+
+GOOD = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+status_text = {
+    GOOD: 'OK',
+    WARNING: 'WARNING',
+    CRITICAL: 'CRITICAL',
+    UNKNOWN: 'UNKNOWN'
+}
+
+MOUNTS = '/proc/mounts'
+PROBE_FILE = '.check_drbd_diskspace.probe'
+PROBE_SIZE = 4096 # One block, O_DIRECT needs aligned sizes
+
+def drbd_mounts(path=None):
+    """ Mount points of drbd devices, from /proc/mounts. """
+    result = []
+    fp = open(path or MOUNTS, 'r')
+    try:
+        for line in fp:
+            fields = line.split()
+            if len(fields) > 1 and fields[0].startswith('/dev/drbd'):
+                # Spaces and such are escaped as octal, eg. \040
+                result.append(fields[1].decode('string_escape'))
+    finally:
+        fp.close()
+    return result
+
+class SpaceHistory(History):
+    """ Samples of a file system. For diskspace these are (time, bytes
+        available, inodes available), for fsync (time, latencies). """
+
+    def __init__(self, directory, name, size, kind='diskspace'):
+        History.__init__(self, directory, name, size, kind)
+
+    def time_to_full(self):
+        """ Seconds until either space or inodes run out at the rate they
+            were used over the whole history. None if they are not running
+            out, or there isn't enough history. """
+        if len(self.samples) < 2:
+            return None
+        first, last = self.samples[0], self.samples[-1]
+        elapsed = last[0] - first[0]
+        if elapsed <= 0:
+            return None
+        result = None
+        for i in (1, 2):
+            rate = float(first[i] - last[i]) / elapsed
+            if rate > 0:
+                seconds = last[i] / rate
+                if result is None or seconds < result:
+                    result = seconds
+        return result
+
+def probe(directory, samples, pause):
+    """ Returns the seconds each of samples writes and fsyncs of a block
+        to a file in directory took. """
+    path = os.path.join(directory, PROBE_FILE)
+    flags = os.O_WRONLY | os.O_CREAT
+    try:
+        fd = os.open(path, flags | getattr(os, 'O_DIRECT', 0), 0600)
+    except OSError, e:
+        if e.errno != errno.EINVAL:
+            raise
+        fd = os.open(path, flags, 0600) # tmpfs and friends can't O_DIRECT
+    # An anonymous map is page aligned, as O_DIRECT wants the buffer to be
+    block = mmap.mmap(-1, PROBE_SIZE)
+    block.write('x' * PROBE_SIZE)
+    latencies = []
+    try:
+        for i in range(samples):
+            if i:
+                time.sleep(pause)
+            start = time.time()
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.write(fd, block)
+            os.fsync(fd)
+            latencies.append(time.time() - start)
+    finally:
+        block.close()
+        os.close(fd)
+        os.unlink(path)
+    return latencies
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) / 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+def check_latency(filesystem, args):
+    """ Returns status, message and perfdata for the fsync latency of a
+        mounted file system, probing it if the last probe is old enough. """
+    history = SpaceHistory(args.history_dir, filesystem, 1, kind='fsync')
+    history.load()
+    if history.samples and \
+            time.time() - history.samples[-1][0] < args.probe_every:
+        latencies = history.samples[-1][1]
+    else:
+        try:
+            latencies = probe(os.path.join(filesystem, args.probe_dir),
+                args.probe_samples, args.probe_pause)
+        except (IOError, OSError), e:
+            return UNKNOWN, "cannot probe %s: %s" % (filesystem,
+                e.strerror), []
+        history.add((time.time(), latencies))
+        history.save()
+
+    low, middle, high = [x * 1000 for x in (min(latencies),
+        median(latencies), max(latencies))]
+    status = evaluate(middle, args.latency_warning, args.latency_critical)
+    message = "fsync %.1f/%.1f/%.1fms" % (low, middle, high)
+    perfdata = [
+        "'%s fsync_min'=%.3fms;;;0" % (filesystem, low),
+        "'%s fsync_median'=%.3fms;%s;%s;0" % (filesystem, middle,
+            args.latency_warning, args.latency_critical),
+        "'%s fsync_max'=%.3fms;;;0" % (filesystem, high),
+    ]
+    return status, message, perfdata
+
+def evaluate_low(value, warning, critical):
+    """ Status of a value where lower is worse. """
+    if value < critical:
+        return CRITICAL
+    if value < warning:
+        return WARNING
+    return GOOD
+
+def check_filesystem(filesystem, args):
+    """ Returns status, message and perfdata for one file system. """
+    if not os.path.ismount(filesystem):
+        return GOOD, "%s not mounted" % filesystem, []
+
+    try:
+        stats = os.statvfs(filesystem)
+    except OSError, e:
+        return UNKNOWN, "%s: %s" % (filesystem, e.strerror), []
+    if stats.f_blocks == 0:
+        return UNKNOWN, "%s has no blocks" % filesystem, []
+
+    free = (stats.f_bavail * 100) / stats.f_blocks
+    status = evaluate_low(free, args.warning, args.critical)
+    message = "%s %d%%" % (filesystem, free)
+    perfdata = ["'%s free'=%d%%;%s;%s;0;100" % (filesystem, free,
+        args.warning, args.critical)]
+
+    # Some file systems, like btrfs, don't have a fixed number of inodes
+    if stats.f_files > 0:
+        inodes = (stats.f_favail * 100) / stats.f_files
+        status = max(status, evaluate_low(inodes, args.inode_warning,
+            args.inode_critical))
+        message += ", inodes %d%%" % inodes
+        perfdata.append("'%s inodes'=%d%%;%s;%s;0;100" % (filesystem, inodes,
+            args.inode_warning, args.inode_critical))
+
+    history = SpaceHistory(args.history_dir, filesystem, args.samples)
+    history.load()
+    history.add((time.time(), stats.f_bavail * stats.f_frsize,
+        stats.f_favail))
+    history.save()
+    seconds = history.time_to_full()
+    if seconds is not None:
+        hours = seconds / 3600
+        status = max(status, evaluate_low(hours, args.full_warning,
+            args.full_critical))
+        message += ", full in %.1fh" % hours
+        perfdata.append("'%s hours_to_full'=%.1f;%s;%s;0" % (filesystem,
+            hours, args.full_warning, args.full_critical))
+
+    if args.probe:
+        s, m, p = check_latency(filesystem, args)
+        status = max(status, s)
+        message += ", " + m
+        perfdata.extend(p)
+
+    return status, message, perfdata
+
+def check(args):
+    filesystems = list(args.filesystem)
+    if args.drbd:
+        try:
+            for mount in drbd_mounts():
+                if mount not in filesystems:
+                    filesystems.append(mount)
+        except IOError, e:
+            return UNKNOWN, "Cannot read mounts: %s" % e
+    if not filesystems:
+        return GOOD, "N/A - no drbd file systems mounted"
+
+    status = GOOD
+    messages = []
+    perfdata = []
+    for filesystem in filesystems:
+        s, message, p = check_filesystem(filesystem, args)
+        status = max(status, s)
+        messages.append(message)
+        perfdata.extend(p)
+
+    output = "DISK %s - free space: %s" % (status_text[status],
+        ', '.join(messages))
+    if perfdata:
+        output += " | " + ' '.join(perfdata)
+    return status, output
+
+def parse_args(argv=None):
+    """ Parse the arguments in argv, or on the command line. """
     parser = argparse.ArgumentParser()
     parser.add_argument("-w", "--warning", type=int,
         help="Warning disk space percentage", default=10)
     parser.add_argument("-c", "--critical", type=int,
         help="Critical disk space percentage", default=5)
-    parser.add_argument("filesystem", help="The filesystem to check")
-    args = parser.parse_args()
-
-    if os.path.ismount(args.filesystem):
-        stats = os.statvfs(args.filesystem)
-        assert stats.f_blocks > 0, "A file system with zero blocks? Surely you jest?"
-        percentage = (stats.f_bfree * 100) / stats.f_blocks
-
-        if percentage < args.critical:
-            print "DISK CRITICAL - free space: %s %d%%" % (args.filesystem,
-                percentage)
-            sys.exit(2)
-        elif percentage < args.warning:
-            print "DISK WARNING - free space: %s %d%%" % (args.filesystem,
-                percentage)
-            sys.exit(1)
-        else:
-            print "DISK OK - free space: %s %d%%" % (args.filesystem,
-                percentage)
-            sys.exit(0)
-    else:
-        print "N/A - %s not mounted" % args.filesystem
-        sys.exit(0)
+    parser.add_argument("-W", "--inode-warning", type=int,
+        help="Warning free inode percentage", default=10)
+    parser.add_argument("-C", "--inode-critical", type=int,
+        help="Critical free inode percentage", default=5)
+    parser.add_argument("--full-warning", type=float, default=48,
+        help="Warning level for hours until full")
+    parser.add_argument("--full-critical", type=float, default=12,
+        help="Critical level for hours until full")
+    parser.add_argument("-d", "--drbd", action='store_true',
+        help="Also check every mounted drbd device")
+    parser.add_argument("-p", "--probe", action='store_true',
+        help="Also check write and fsync latency")
+    parser.add_argument("--latency-warning", type=float, default=200,
+        help="Warning level for median fsync latency in ms")
+    parser.add_argument("--latency-critical", type=float, default=1000,
+        help="Critical level for median fsync latency in ms")
+    parser.add_argument("--probe-samples", type=int, default=5,
+        help="Number of writes per probe")
+    parser.add_argument("--probe-pause", type=float, default=0.2,
+        help="Seconds to wait between writes")
+    parser.add_argument("--probe-every", type=int, default=300,
+        help="Probe at most this often, in seconds")
+    parser.add_argument("--probe-dir", default='',
+        help="Directory below the mount point to probe in, the user running "
+        "the check must be able to write there")
+    parser.add_argument("--history-dir",
+        default='/var/cache/siyavula-ha-scripts',
+        help="Where to keep the history of samples")
+    parser.add_argument("--samples", type=int, default=12,
+        help="Number of samples to forecast from")
+    parser.add_argument("filesystem", nargs='*',
+        help="The filesystems to check")
+    args = parser.parse_args(argv)
+
+    if not (args.filesystem or args.drbd):
+        parser.error("Give the filesystems to check, or --drbd")
+
+    return args
+
+def main():
+    # The runner may already have the answer
+    result = from_runner('check_drbd_diskspace')
+    if result is None:
+        result = check(parse_args())
+    status, output = result
+    print output
+    sys.exit(status)
 
 if __name__ == "__main__":
     main()
@@ -2,44 +2,300 @@
 #
 # This needs python-argparse, if used with python2.6.
 #
-# This plugin simply checks /proc/drbd to ensure the drbd resources are
-# up to date.
+# This plugin checks /proc/drbd to ensure the drbd resources are up to date.
+# Every device is reported on, with its own severity. A device that is
+# resyncing is a warning rather than critical, as long as the resync is going
+# fast enough to be done within --resync-finish seconds. Out of sync data and
+# resync speed are emitted as perfdata.
+#
+# Slow replication shows up in the counters line as growing queues of
+# requests pending on the peer (pe), unacknowledged (ua) and pending from
+# the application (ap), which have thresholds, and as falling network and
+# disk throughput. Throughput is worked out from the previous sample, kept
+# in --state-dir, and emitted as perfdata in KB/sec.
+#
+# When drbd_events is running it keeps the state of every device in a state
+# file, which is read instead of /proc/drbd. That also tells about brief
+# disconnects that came and went between polls, which are a warning. If the
+# watcher is not running, or its state file is stale, /proc/drbd is used.
 
 import sys
 import os
 import re
+import errno
+import time
+import cPickle
+import argparse
 
-R = re.compile(' ([0-9]+): cs:([^ ]+) ro:([^ ]+) ds:([^ ]+)')
+from checklib import State, evaluate, rates, from_runner
 
-def main():
-    if not os.path.exists('/proc/drbd'):
-        print "DRBD not installed"
-        sys.exit(3)
+GOOD = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+status_text = {
+    GOOD: 'OK',
+    WARNING: 'WARNING',
+    CRITICAL: 'CRITICAL',
+    UNKNOWN: 'UNKNOWN'
+}
+
+PROC_DRBD = '/proc/drbd'
+EVENTS_STATE = '/var/cache/siyavula-ha-scripts/drbd_events.pickle'
+
+# drbd 8.3 calls the roles st:, 8.4 calls them ro:
+R = re.compile(r' *([0-9]+): cs:(\S+)(?: (?:ro|st):(\S+) ds:(\S+))?')
+COUNTER_R = re.compile(r'([a-z]+):([0-9]+)')
+SYNCED_R = re.compile(r"sync'ed: *([0-9.]+)%")
+FINISH_R = re.compile(r'finish: ([0-9]+):([0-9]+):([0-9]+)')
+SPEED_R = re.compile(r'speed: ([0-9,]+)')
+
+SYNCING = ('SyncSource', 'SyncTarget')
 
-    fp = open('/proc/drbd')
+# Counters of KB sent and received over the network and written and read on
+# the local disk, and the queue lengths that have thresholds.
+THROUGHPUT = ('ns', 'nr', 'dw', 'dr')
+QUEUES = ('pe', 'ua', 'ap')
+
+class Device(object):
+    def __init__(self, minor, cs, ro, ds):
+        self.minor = minor
+        self.cs = cs
+        self.ro = ro
+        self.ds = ds
+        self.counters = {}
+        self.synced = None # percentage
+        self.finish = None # seconds
+        self.speed = None # K/sec
+        self.flaps = None # brief disconnects, only known to drbd_events
+
+    @property
+    def oos(self):
+        """ Out of sync data in KB. """
+        return self.counters.get('oos')
+
+def parse_proc_drbd(fp):
+    """ Returns a Device for every configured device in fp, with its
+        counters and the progress of a resync if there is one. """
     devices = []
+    device = None
     for line in fp:
         m = R.match(line)
-        if m is None:
+        if m is not None:
+            minor, cs, ro, ds = m.groups()
+            if cs == 'Unconfigured':
+                device = None
+            else:
+                device = Device(minor, cs, ro, ds)
+                devices.append(device)
+            continue
+        if device is None:
             continue
+        if 'ns:' in line:
+            device.counters = dict([(k, int(v)) for k, v in
+                COUNTER_R.findall(line)])
+            continue
+        m = SYNCED_R.search(line)
+        if m is not None:
+            device.synced = float(m.group(1))
+        m = FINISH_R.search(line)
+        if m is not None:
+            h, mi, s = [int(x) for x in m.groups()]
+            device.finish = h * 3600 + mi * 60 + s
+        m = SPEED_R.search(line)
+        if m is not None:
+            device.speed = int(m.group(1).replace(',', ''))
+    return devices
+
+def read_devices(path=None):
+    fp = open(path or PROC_DRBD, 'r')
+    try:
+        return parse_proc_drbd(fp)
+    finally:
+        fp.close()
 
-        device, cs, ro, ds = m.groups()
-        if cs != 'Connected':
-            print "Device %s is unconnected" % device
-            sys.exit(2)
-        if ds != 'UpToDate/UpToDate':
-            print "Device %s is out of date (%s)" % (device, ds)
-            sys.exit(2)
+def pid_exists(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM # Running as someone else
+    return True
 
+def read_events_state(path):
+    """ Returns the devices in the state file of drbd_events, or None if
+        the watcher isn't running or hasn't written in a while. A replay
+        (drbd_events --input) has no watcher, only its age counts. """
+    try:
+        fp = open(path, 'rb')
+        try:
+            state = cPickle.load(fp)
+        finally:
+            fp.close()
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+        return None
+    if state['pid'] is not None and not pid_exists(state['pid']):
+        return None
+    if time.time() - state['updated'] > 3 * state['interval']:
+        return None
+    devices = []
+    for minor, d in sorted(state['devices'].items(), key=lambda x: int(x[0])):
+        device = Device(minor, d['cs'], d['ro'], d['ds'])
+        device.counters = d['counters']
+        device.synced = d['synced']
+        device.flaps = d['flaps']
         devices.append(device)
-    fp.close()
+    return devices
+
+def estimate_resync(device, previous):
+    """ The events don't say how fast a resync goes, work it out from how
+        much less is out of sync than at the previous (time, counters)
+        sample. """
+    if device.oos is None or previous is None or 'oos' not in previous[1]:
+        return
+    elapsed = time.time() - previous[0]
+    done = previous[1]['oos'] - device.oos
+    if elapsed > 0 and done > 0:
+        device.speed = int(done / elapsed)
+        device.finish = int(device.oos / (done / elapsed))
+
+def device_status(device, args):
+    """ Returns the status of a device and a message describing it. """
+    if device.cs in SYNCING:
+        if device.finish is None or device.speed is None:
+            return CRITICAL, "%s: %s, no progress" % (device.minor, device.cs)
+        message = "%s: %s %.1f%% done, %d:%02d:%02d left at %d K/sec" % (
+            device.minor, device.cs, device.synced or 0,
+            device.finish / 3600, device.finish / 60 % 60, device.finish % 60,
+            device.speed)
+        if device.speed >= args.resync_speed and \
+                device.finish <= args.resync_finish:
+            return WARNING, message
+        return CRITICAL, message
+    if device.cs != 'Connected' and not device.cs.startswith('Verify'):
+        return CRITICAL, "%s: %s" % (device.minor, device.cs)
+    if device.ds != 'UpToDate/UpToDate':
+        return CRITICAL, "%s: out of date (%s)" % (device.minor, device.ds)
+    return GOOD, "%s: OK" % device.minor
+
+def evaluate_queues(device, args):
+    """ Returns the status of the request queues of a device and a message
+        for each queue that is too long. """
+    status = GOOD
+    messages = []
+    for queue in QUEUES:
+        value = device.counters.get(queue)
+        if value is None:
+            continue
+        s = evaluate(value, *getattr(args, queue + '_levels'))
+        if s == GOOD:
+            continue
+        status = max(status, s)
+        messages.append("%s: %d" % (queue, value))
+    return status, messages
+
+def perfdata(device, args, throughput):
+    result = []
+    if device.oos is not None:
+        result.append("'drbd%s oos'=%dKB;;;0" % (device.minor, device.oos))
+    result.append("'drbd%s speed'=%d;;;0" % (device.minor, device.speed or 0))
+    for queue in QUEUES:
+        if queue in device.counters:
+            warning, critical = getattr(args, queue + '_levels')
+            result.append("'drbd%s %s'=%d;%d;%d;0" % (device.minor, queue,
+                device.counters[queue], warning, critical))
+    if device.flaps is not None:
+        result.append("'drbd%s flaps'=%dc;;;0" % (device.minor, device.flaps))
+    if throughput is not None:
+        for k in THROUGHPUT:
+            result.append("'drbd%s %s'=%.1f;;;0" % (device.minor, k,
+                throughput[k]))
+    return result
+
+def check(args):
+    devices = read_events_state(args.events_state)
+    if devices is None:
+        if not os.path.exists(PROC_DRBD):
+            return UNKNOWN, "DRBD not installed"
+        try:
+            devices = read_devices()
+        except IOError, e:
+            return UNKNOWN, str(e)
 
     if len(devices) == 0:
-        print "No DRBD devices detected"
-        sys.exit(2)
+        return CRITICAL, "No DRBD devices detected"
 
-    print "DRBD devices [%s] OK" % ", ".join(devices)
-    sys.exit(0)
+    now = time.time()
+    samples = {}
+    for d in devices:
+        counters = dict(d.counters)
+        if d.flaps is not None:
+            counters['flaps'] = d.flaps
+        samples[d.minor] = (now, counters)
+    previous = State(args.state_dir, 'check_drbd_status').swap(samples) or {}
+
+    status = GOOD
+    messages = []
+    data = []
+    for device in devices:
+        if device.cs in SYNCING and device.speed is None:
+            estimate_resync(device, previous.get(device.minor))
+        s, message = device_status(device, args)
+        qs, notes = evaluate_queues(device, args)
+        s = max(s, qs)
+        last = previous.get(device.minor, (0, {}))[1].get('flaps')
+        if None not in (device.flaps, last) and device.flaps > last:
+            s = max(s, WARNING)
+            notes.append("%d brief disconnects" % (device.flaps - last))
+        status = max(status, s)
+        if notes:
+            message += ", " + ", ".join(notes)
+        if s != GOOD:
+            message += " (%s)" % status_text[s]
+        messages.append(message)
+        data.extend(perfdata(device, args,
+            rates(previous.get(device.minor), samples[device.minor],
+                THROUGHPUT)))
+
+    return status, "DRBD %s - %s | %s" % (status_text[status],
+        ', '.join(messages), ' '.join(data))
+
+def levels(spec):
+    try:
+        warning, critical = [int(x) for x in spec.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Levels must look like warning,critical")
+    return warning, critical
+
+def parse_args(argv=None):
+    """ Parse the arguments in argv, or on the command line. """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--resync-speed", type=int, default=1024,
+        help="Lowest resync speed in K/sec that is only a warning")
+    parser.add_argument("--resync-finish", type=int, default=4 * 3600,
+        help="Longest time in seconds a resync may take and only be a warning")
+    for queue, what in (('pe', 'requests pending on the peer'),
+            ('ua', 'requests not yet acknowledged to the peer'),
+            ('ap', 'application requests pending')):
+        parser.add_argument("--%s" % queue, dest='%s_levels' % queue,
+            type=levels, default=(100, 1000), metavar='WARNING,CRITICAL',
+            help="Levels for %s" % what)
+    parser.add_argument("--events-state", default=EVENTS_STATE,
+        help="State file kept by drbd_events")
+    parser.add_argument("--state-dir", default='/var/cache/siyavula-ha-scripts',
+        help="Where to keep the previous sample")
+    args = parser.parse_args(argv)
+
+    return args
+
+def main():
+    # The runner may already have the answer
+    result = from_runner('check_drbd_status')
+    if result is None:
+        result = check(parse_args())
+    status, output = result
+    print output
+    sys.exit(status)
 
 if __name__ == "__main__":
     main()
@@ -1,35 +1,154 @@
 #!/usr/bin/python
 #
 # Python nagios plugin to check an haproxy status page and ensure that all is
-# well.
+# well. The stats can be fetched from the status url, or read directly from
+# the haproxy stats socket, which does not go through the frontend that is
+# being monitored:
+#
+#   global
+#     stats socket /var/run/haproxy.sock mode 600 level user
+#
+# Besides the percentage of live backends, thresholds can be set on queue
+# length, session usage, session rate and timings, per proxy name pattern.
+# These are given as pattern:metric=warning,critical, for example
+#
+#   -T 'app*:qcur=10,50' -T '*:rtime=500,2000' -T '*:sessions=80,95'
+#
+# where sessions is scur as a percentage of slim, and qtime, ctime and rtime
+# are in milliseconds. They apply to the backend and to each of its servers.
+# The first matching pattern for a metric wins.
+#
+# When there is one nagios service per backend, use --cache-ttl so that the
+# stats are fetched once and shared by all the checks for that long, and
+# --proxy to pick out the backend for each service. The cache directory
+# must be writable by the nagios user, and not by anyone else.
+#
+# -u and -s can be given more than once to check several load balancers.
+# They are fetched concurrently, and a proxy is OK when it is healthy on at
+# least --min-healthy of them (all of them by default), WARNING while it
+# is healthy on at least one. Use --per-instance to report on each load
+# balancer separately instead.
 
 import sys
+import os
+import re
 import argparse
+import fnmatch
+import fcntl
 import urllib2
+import httplib
+import socket
+import time
 import csv
+import threading
+from urlparse import urlparse
 from collections import defaultdict
 
+from checklib import evaluate, from_runner, _load, _save
+
 GOOD = 0
 WARNING = 1
 CRITICAL = 2
+UNKNOWN = 3
 
 status_text = {
     GOOD: 'OK',
     WARNING: 'WARNING',
-    CRITICAL: 'CRITICAL'
+    CRITICAL: 'CRITICAL',
+    UNKNOWN: 'UNKNOWN'
 }
 
+METRICS = ('qcur', 'sessions', 'rate', 'qtime', 'ctime', 'rtime')
+
+UNITS = {
+    'sessions': '%',
+    'qtime': 'ms',
+    'ctime': 'ms',
+    'rtime': 'ms'
+}
+
+class Threshold(object):
+    def __init__(self, spec):
+        """ spec looks like pattern:metric=warning,critical """
+        try:
+            self.pattern, rest = spec.rsplit(':', 1)
+            self.metric, levels = rest.split('=', 1)
+            self.warning, self.critical = [float(x) for x in levels.split(',')]
+        except ValueError:
+            raise argparse.ArgumentTypeError(
+                "Threshold must look like pattern:metric=warning,critical")
+        if self.metric not in METRICS:
+            raise argparse.ArgumentTypeError("Unknown metric %s, use one of %s" % (
+                self.metric, ', '.join(METRICS)))
+
+    def matches(self, pxname):
+        return fnmatch.fnmatchcase(pxname, self.pattern)
+
+def row_metrics(row):
+    """ Pull the values we can put thresholds on out of a stats row. Columns
+        that are empty for this kind of row are left out. """
+    values = {}
+    for metric in ('qcur', 'rate', 'qtime', 'ctime', 'rtime'):
+        value = row.get(metric)
+        if value:
+            values[metric] = int(value)
+    scur, slim = row.get('scur'), row.get('slim')
+    if scur and slim and int(slim) > 0:
+        values['sessions'] = float(scur) * 100 / int(slim)
+    return values
+
+def format_perfdata(label, value, threshold=None):
+    unit = UNITS.get(label.rsplit('.', 1)[-1], '')
+    if threshold is None:
+        return "'%s'=%s%s;;;0" % (label, value, unit)
+    return "'%s'=%s%s;%s;%s;0" % (label, value, unit,
+        threshold.warning, threshold.critical)
+
 class Status(object):
-    def __init__(self, warning, critical):
+    def __init__(self, warning, critical, thresholds=(), server_perfdata=False,
+            prefix=''):
+        self.prefix = prefix
         self.warning = warning
         self.critical = critical
+        self.all_thresholds = thresholds
+        self.server_perfdata = server_perfdata
+        self.thresholds = None
         self.name = None
         self.backends = 0
         self.healthy = 0
         self.up = False
+        self.alerts = []
+        self.perfdata = []
+
+    def add_metrics(self, svname, values):
+        """ Evaluate the metrics for the proxy itself (svname is BACKEND or
+            FRONTEND) or one of its servers against the thresholds for
+            this proxy. """
+        if self.thresholds is None:
+            self.thresholds = {}
+            for threshold in self.all_thresholds:
+                if threshold.matches(self.name):
+                    self.thresholds.setdefault(threshold.metric, threshold)
+        proxy = svname in ('FRONTEND', 'BACKEND')
+        for metric in METRICS:
+            if metric not in values:
+                continue
+            value = values[metric]
+            threshold = self.thresholds.get(metric)
+            if threshold is not None:
+                status = evaluate(value, threshold.warning,
+                    threshold.critical)
+                if status != GOOD:
+                    self.alerts.append((status, '{} {} {:g}{}'.format(
+                        svname, metric, value, UNITS.get(metric, ''))))
+            if proxy or self.server_perfdata:
+                if isinstance(value, float):
+                    value = '%.1f' % value
+                self.perfdata.append(format_perfdata('%s%s.%s.%s' % (
+                    self.prefix, self.name, svname, metric), value, threshold))
 
     @property
-    def status(self):
+    def health(self):
         if self.up and self.backends > 0:
             p = (float(self.healthy)*100)/self.backends
             if p < self.critical:
@@ -39,55 +158,350 @@ class Status(object):
             return GOOD
         return CRITICAL
 
+    @property
+    def status(self):
+        return max([self.health] + [a[0] for a in self.alerts])
+
     def __repr__(self):
-        return '{}: {} {}/{}'.format(
+        r = '{}: {} {}/{}'.format(
             self.name, status_text[self.status], self.healthy, self.backends)
+        if self.alerts:
+            r += ' ({})'.format(', '.join([a[1] for a in self.alerts]))
+        return r
+
+class StatsUnavailable(Exception):
+    pass
 
-def get_csv(url):
+def get_csv(url, timeout=10):
     req = urllib2.Request(url + ';csv')
-    response = urllib2.urlopen(req)
+    try:
+        response = urllib2.urlopen(req, timeout=timeout)
+    except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+        raise StatsUnavailable(str(e) or e.__class__.__name__)
     if response.code == 200:
         return response
-    return None
+    raise StatsUnavailable("HTTP %s" % response.code)
 
-def main():
+def read_lines(sock, deadline):
+    """ Yield lines from sock as they arrive, giving up at deadline. """
+    pending = ''
+    while True:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise StatsUnavailable("timed out reading stats")
+        sock.settimeout(remaining)
+        try:
+            data = sock.recv(65536)
+        except socket.error, e:
+            raise StatsUnavailable(str(e))
+        if not data:
+            break
+        lines = (pending + data).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line
+    if pending:
+        yield pending
+
+def get_socket_csv(path, timeout=10):
+    """ Ask the haproxy stats socket at path for its stats. """
+    deadline = time.time() + timeout
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall("show stat\n")
+    except socket.error, e:
+        sock.close()
+        raise StatsUnavailable(str(e))
+    try:
+        for line in read_lines(sock, deadline):
+            yield line
+    finally:
+        sock.close()
+
+def parse_csv(lines):
+    """ Parse haproxy csv stats incrementally, yielding the column names from
+        the "# pxname,svname,..." header along with every row, so we don't
+        depend on where haproxy puts its columns. """
+    header = None
+    for row in csv.reader(lines):
+        if not row:
+            continue
+        if row[0].startswith('#'):
+            header = [row[0].lstrip('# ')] + row[1:]
+            continue
+        if header is None:
+            raise StatsUnavailable("No header in haproxy stats")
+        yield header, row
+
+def parse_stats(lines):
+    """ Yield a dict for every row, keyed on column name. """
+    for header, row in parse_csv(lines):
+        yield dict(zip(header, row))
+
+def read_stats(lines):
+    """ Read all the stats into a compact (header, rows) tuple. """
+    header = []
+    rows = []
+    for header, row in parse_csv(lines):
+        rows.append(row)
+    return header, rows
+
+def stats_rows(stats):
+    header, rows = stats
+    for row in rows:
+        yield dict(zip(header, row))
+
+class StatsCache(object):
+    """ Keeps the parsed stats for a source in a pickle for ttl seconds.
+        Fetching is done under a lock, so when many checks find the cache
+        stale at the same time, only one of them fetches and the others
+        use its result. """
+
+    def __init__(self, directory, source, ttl):
+        self.directory = directory
+        self.ttl = ttl
+        name = re.sub('[^A-Za-z0-9]+', '_', source).strip('_')
+        self.path = os.path.join(directory, 'haproxy-%s.pickle' % name)
+
+    def load(self):
+        """ Return the cached stats if they are fresh enough. """
+        try:
+            if time.time() - os.stat(self.path).st_mtime > self.ttl:
+                return None
+        except OSError:
+            return None
+        return _load(self.path)
+
+    def save(self, stats):
+        # Written to the side and renamed into place, readers don't lock
+        _save(self.path, stats)
+
+    def get(self, fetch):
+        stats = self.load()
+        if stats is not None:
+            return stats
+        try:
+            lock = open(self.path + '.lock', 'a')
+        except IOError:
+            # Can't write to the cache, do without
+            return fetch()
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            # Someone else might have fetched it while we waited
+            stats = self.load()
+            if stats is None:
+                stats = fetch()
+                self.save(stats)
+            return stats
+        finally:
+            lock.close()
+
+class Target(object):
+    """ One haproxy instance, reached through its status url or its stats
+        socket. """
+
+    def __init__(self, url=None, socket=None):
+        self.url = url
+        self.socket = socket
+        self.data = None
+        self.error = None
+
+    @property
+    def source(self):
+        return self.socket or self.url
+
+    @property
+    def name(self):
+        if self.url:
+            return urlparse(self.url).netloc or self.url
+        return self.socket
+
+    def fetch(self, args):
+        if self.socket:
+            return get_socket_csv(self.socket, args.timeout)
+        return get_csv(self.url, args.timeout)
+
+    def rows(self, args):
+        if args.cache_ttl > 0:
+            cache = StatsCache(args.cache_dir, self.source, args.cache_ttl)
+            return stats_rows(cache.get(lambda: read_stats(self.fetch(args))))
+        return parse_stats(self.fetch(args))
+
+    def collect(self, args, prefix=''):
+        """ Fetch the stats and evaluate them into self.data, a Status for
+            every proxy. On failure self.error says what went wrong. """
+        data = defaultdict(lambda: Status(args.warning, args.critical,
+            args.threshold, args.server_perfdata, prefix))
+        try:
+            for row in self.rows(args):
+                pxname = row['pxname']
+                svname = row['svname']
+                status = row['status']
+
+                if args.proxy and not [p for p in args.proxy
+                        if fnmatch.fnmatchcase(pxname, p)]:
+                    continue
+
+                data[pxname].name = pxname
+                data[pxname].add_metrics(svname, row_metrics(row))
+                if svname == 'BACKEND' and status == 'UP':
+                    data[pxname].up = True
+                elif svname not in ('FRONTEND', 'BACKEND'):
+                    data[pxname].backends += 1
+                    if status == 'UP': data[pxname].healthy += 1
+        except (StatsUnavailable, httplib.HTTPException, socket.error), e:
+            # The response can still be cut short while we read it
+            self.error = str(e) or e.__class__.__name__
+            return
+        except (KeyError, ValueError, csv.Error), e:
+            self.error = "Couldn't figure out haproxy output: %s" % e
+            return
+        except Exception, e:
+            # This runs in a thread, anything we don't catch is lost and
+            # leaves the target without data or an error.
+            self.error = "%s: %s" % (e.__class__.__name__, e)
+            return
+        self.data = data
+
+def collect_all(targets, args):
+    """ Collect from all targets at once, so that the check takes as long as
+        the slowest one rather than the sum of them. """
+    multiple = len(targets) > 1
+    threads = []
+    for target in targets:
+        prefix = multiple and target.name + '/' or ''
+        t = threading.Thread(target=target.collect, args=(args, prefix))
+        t.daemon = True
+        t.start()
+        threads.append(t)
+    deadline = time.time() + args.timeout + 1
+    for target, t in zip(targets, threads):
+        t.join(max(deadline - time.time(), 0))
+        if t.isAlive():
+            target.error = "timed out"
+        elif target.data is None and target.error is None:
+            target.error = "failed"
+
+def report(data):
+    """ The output line and status for one set of proxies. """
+    status = max([s.status for s in data.values()])
+    perfdata = [p for s in data.values() for p in s.perfdata]
+    return status, ', '.join([str(s) for s in data.values()]), perfdata
+
+def aggregate(targets, args):
+    """ Merge the results by proxy name. A proxy is OK if it is healthy on
+        at least min_healthy of the load balancers. """
+    reachable = [t for t in targets if t.data is not None]
+    min_healthy = args.min_healthy or len(targets)
+    names = sorted(set([n for t in reachable for n in t.data]))
+    results = []
+    for name in names:
+        healthy = len([t for t in reachable
+            if name in t.data and t.data[name].status == GOOD])
+        if healthy >= min_healthy:
+            status = GOOD
+        elif healthy > 0:
+            status = WARNING
+        else:
+            status = CRITICAL
+        results.append((status, '{}: {} {}/{}'.format(
+            name, status_text[status], healthy, len(targets))))
+    for t in targets:
+        if t.data is None:
+            results.append((WARNING, '{}: {}'.format(t.name,
+                t.error or 'failed')))
+    perfdata = [p for t in reachable for s in t.data.values()
+        for p in s.perfdata]
+    return max([r[0] for r in results]), \
+        ', '.join([r[1] for r in results]), perfdata
+
+def parse_args(argv=None):
+    """ Parse the arguments in argv, or on the command line. """
     parser = argparse.ArgumentParser()
-    parser.add_argument("-u", "--url", help="Haproxy status url")
+    parser.add_argument("-u", "--url", action='append', default=[],
+        help="Haproxy status url, may be given more than once")
+    parser.add_argument("-s", "--socket", action='append', default=[],
+        help="Haproxy stats socket, may be given more than once")
+    parser.add_argument("-t", "--timeout", type=float,
+        help="Timeout in seconds for fetching stats", default=10)
     parser.add_argument("-w", "--warning", type=int,
         help="Warning level as percentage of live backends", default=75)
     parser.add_argument("-c", "--critical", type=int,
         help="Critical level as percentage of live backends", default=50)
-    args = parser.parse_args()
-    if not args.url:
-        parser.error('You must provide a haproxy status url')
-
-    response = get_csv(args.url)
-    data = defaultdict(lambda: Status(args.warning, args.critical))
-    if response is not None:
-        for row in csv.reader(response):
-            assert len(row) > 17, "Malformed row in csv response"
-            if row[0].startswith('#'): continue # Skip headings
-            pxname = row[0]
-            svname = row[1]
-            status = row[17]
-
-            data[pxname].name = pxname
-            if svname == 'BACKEND' and status == 'UP':
-                data[pxname].up = True
-            elif svname not in ('FRONTEND', 'BACKEND'):
-                data[pxname].backends += 1
-                if status == 'UP': data[pxname].healthy += 1
-
-        if len(data) == 0:
-            sys.exit(3) # Unknown
-
-        # Overal status
-        status = max([s.status for s in data.values()])
-        print ', '.join([str(s) for s in data.values()])
-        sys.exit(status)
-
-    print "Couldn't figure out haproxy output"
-    sys.exit(3) # Unknown
+    parser.add_argument("-T", "--threshold", type=Threshold, action='append',
+        default=[], help="Threshold as pattern:metric=warning,critical, "
+        "metric is one of %s" % ', '.join(METRICS))
+    parser.add_argument("--server-perfdata", action='store_true',
+        help="Also emit perfdata for each server, not just for each proxy")
+    parser.add_argument("-p", "--proxy", action='append', default=[],
+        help="Only check proxies matching this pattern")
+    parser.add_argument("--cache-ttl", type=float, default=0,
+        help="Share fetched stats between checks for this many seconds")
+    parser.add_argument("--cache-dir", default='/var/cache/siyavula-ha-scripts',
+        help="Where to keep shared stats")
+    parser.add_argument("-n", "--min-healthy", type=int, default=0,
+        help="With several load balancers, a proxy is OK if it is healthy "
+        "on this many of them (default all)")
+    parser.add_argument("--per-instance", action='store_true',
+        help="With several load balancers, report on each separately")
+    args = parser.parse_args(argv)
+    if not (args.url or args.socket):
+        parser.error('You must provide a haproxy status url or socket')
+    return args
+
+def check(args):
+    targets = [Target(socket=s) for s in args.socket] + \
+        [Target(url=u) for u in args.url]
+    collect_all(targets, args)
+
+    if len(targets) == 1:
+        target = targets[0]
+        if target.data is None:
+            return UNKNOWN, "HAPROXY UNKNOWN - %s: %s" % (target.name,
+                target.error or 'failed')
+        if len(target.data) == 0:
+            if args.proxy:
+                return UNKNOWN, "HAPROXY UNKNOWN - no proxies matching %s" % \
+                    ', '.join(args.proxy)
+            return UNKNOWN, "HAPROXY UNKNOWN - no proxies"
+        status, text, perfdata = report(target.data)
+    elif not [t for t in targets if t.data]:
+        return UNKNOWN, "HAPROXY UNKNOWN - %s" % ', '.join(['{}: {}'.format(
+            t.name, t.error or 'no proxies') for t in targets])
+    elif args.per_instance:
+        lines = []
+        perfdata = []
+        status = GOOD
+        for t in targets:
+            if t.data is None:
+                lines.append('{}: UNKNOWN {}'.format(t.name,
+                    t.error or 'failed'))
+                status = max(status, WARNING)
+            elif t.data:
+                s, text, p = report(t.data)
+                lines.append('{}: {}'.format(t.name, text))
+                perfdata.extend(p)
+                status = max(status, s)
+        text = '\n'.join(lines)
+    else:
+        status, text, perfdata = aggregate(targets, args)
+
+    if perfdata:
+        text = text.split('\n', 1)
+        text[0] += ' | ' + ' '.join(perfdata)
+        text = '\n'.join(text)
+    return status, text
+
+def main():
+    # The runner may already have the answer
+    result = from_runner('check_haproxy')
+    if result is None:
+        result = check(parse_args())
+    status, text = result
+    print text
+    sys.exit(status)
 
 if __name__ == '__main__':
     main()
@@ -3,29 +3,177 @@
 # Python nagios plugin to check if there is a master postgresql server on
 # host. Meant to be used with a floating ip address and high availability,
 # which is why it only implements connecting by tcp with user/password.
+#
+# With --extended it also checks that the master is healthy, not just up:
+# connections in use against max_connections, the age of the oldest open
+# transaction, the number of backends waiting for locks, how many
+# checkpoints were requested rather than timed, and the buffer cache hit
+# ratio. All of it comes from a single query.
+#
+# The checkpoint and buffer counters are totals since the statistics were
+# last reset, which hardly move on a server that has been up for a while.
+# So the previous sample is kept in --state-dir, and the requested
+# checkpoints and hit ratio are worked out from what happened since. On the
+# first run, or after a reset, the totals are used.
 
 import sys
+import re
+import time
 import argparse
 import psycopg2
 
-def status(host, port, db, user, password):
+from checklib import State, evaluate, deltas, from_runner
+
+GOOD = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+status_text = {
+    GOOD: 'OK',
+    WARNING: 'WARNING',
+    CRITICAL: 'CRITICAL',
+    UNKNOWN: 'UNKNOWN'
+}
+
+EXTENDED_QUERY = """\
+SELECT pg_is_in_recovery(),
+    (SELECT count(*) FROM pg_stat_activity),
+    current_setting('max_connections')::int,
+    (SELECT extract(epoch from max(now() - xact_start))
+        FROM pg_stat_activity),
+    (SELECT count(DISTINCT pid) FROM pg_locks WHERE NOT granted),
+    b.checkpoints_timed, b.checkpoints_req,
+    d.hit, d.read
+FROM pg_stat_bgwriter b,
+    (SELECT sum(blks_hit) AS hit, sum(blks_read) AS read
+        FROM pg_stat_database) d"""
+
+# Set by check_runner to keep connections open between runs
+connections = None
+
+def connect(host, port, db, user, password, timeout):
+    dsn = "host=%s port=%d dbname=%s user=%s password=%s " \
+        "connect_timeout=%d options='-c statement_timeout=%d'" % (
+        host, port, db, user, password, timeout, timeout * 1000)
+    if connections is None:
+        return psycopg2.connect(dsn)
+    return connections.get(dsn, psycopg2.connect)
+
+def release(db, failed=False):
+    """ Done with a connection from connect. """
+    if connections is None:
+        db.close()
+    elif failed:
+        connections.discard(db)
+
+def status(host, port, db, user, password, timeout=10):
     """ This does a check by connecting to the host via tcp. """
     try:
-        db = psycopg2.connect("host=%s port=%d dbname=%s user=%s password=%s" % (
-            host, port, db, user, password))
+        db = connect(host, port, db, user, password, timeout)
+    except psycopg2.OperationalError, e:
+        return UNKNOWN, str(e).strip()
+    try:
         cursor = db.cursor()
         cursor.execute("select pg_is_in_recovery()")
-        if cursor.fetchone()[0]:
-            print "Server is in recovery (slave)"
-            return 2 # Error, it is a slave
-        else:
-            print "Server is not in recovery (master)"
-            return 0 # master
-    except psycopg2.OperationalError, e:
-        print str(e)
-    return 3 # Unknown
+        recovery = cursor.fetchone()[0]
+    except psycopg2.Error, e:
+        release(db, True)
+        return UNKNOWN, str(e).strip()
+    release(db)
+    if recovery:
+        return CRITICAL, "Server is in recovery (slave)" # Error, it is a slave
+    return GOOD, "Server is not in recovery (master)"
 
-def main():
+def evaluate_low(value, warning, critical):
+    """ Like evaluate, for values where lower is worse. """
+    if value <= critical:
+        return CRITICAL
+    if value <= warning:
+        return WARNING
+    return GOOD
+
+def state_name(args):
+    return 'check_pg_master-%s' % re.sub('[^A-Za-z0-9]+', '_',
+        '%s:%d' % (args.host, args.port)).strip('_')
+
+def extended(args):
+    """ Check that the master is up and also not saturated. """
+    try:
+        db = connect(args.host, args.port, args.database, args.user,
+            args.password, args.timeout)
+    except psycopg2.Error, e:
+        return UNKNOWN, str(e).strip()
+    try:
+        cursor = db.cursor()
+        cursor.execute(EXTENDED_QUERY)
+        (recovery, backends, max_connections, oldest_xact, waiting,
+            timed, requested, hit, read) = cursor.fetchone()
+    except psycopg2.Error, e:
+        release(db, True)
+        return UNKNOWN, str(e).strip()
+    release(db)
+
+    if recovery:
+        return CRITICAL, "Server is in recovery (slave)"
+
+    oldest_xact = float(oldest_xact or 0)
+    used = backends * 100.0 / max_connections
+    sample = (time.time(), {'timed': int(timed),
+        'requested': int(requested), 'hit': int(hit or 0),
+        'read': int(read or 0)})
+    d = deltas(State(args.state_dir, state_name(args)).swap(sample), sample)
+    if d is None:
+        counters = sample[1] # First run, or the statistics were reset
+    else:
+        counters = d[1]
+    checkpoints = counters['timed'] + counters['requested']
+    if checkpoints:
+        req_pct = counters['requested'] * 100.0 / checkpoints
+    else:
+        req_pct = 0.0
+    blocks = counters['hit'] + counters['read']
+    if blocks:
+        hit_pct = counters['hit'] * 100.0 / blocks
+    else:
+        hit_pct = 100.0 # Nothing was read at all
+
+    results = [
+        (evaluate(used, args.connections_warning, args.connections_critical),
+            "connections %d/%d" % (backends, max_connections),
+            "connections=%d;%d;%d;0;%d" % (backends,
+                max_connections * args.connections_warning / 100,
+                max_connections * args.connections_critical / 100,
+                max_connections)),
+        (evaluate(oldest_xact, args.xact_warning, args.xact_critical),
+            "oldest transaction %.0fs" % oldest_xact,
+            "oldest_xact=%.3fs;%s;%s;0" % (oldest_xact, args.xact_warning,
+                args.xact_critical)),
+        (evaluate(waiting, args.waiting_warning, args.waiting_critical),
+            "%d waiting for locks" % waiting,
+            "waiting=%d;%d;%d;0" % (waiting, args.waiting_warning,
+                args.waiting_critical)),
+        (evaluate(req_pct, args.checkpoint_warning, args.checkpoint_critical),
+            "%.0f%% of checkpoints requested" % req_pct,
+            "checkpoints_req=%.1f%%;%s;%s;0;100" % (req_pct,
+                args.checkpoint_warning, args.checkpoint_critical)),
+        (evaluate_low(hit_pct, args.hit_warning, args.hit_critical),
+            "cache hit ratio %.1f%%" % hit_pct,
+            "hit_ratio=%.2f%%;%s;%s;0;100" % (hit_pct, args.hit_warning,
+                args.hit_critical)),
+    ]
+    result = max([r[0] for r in results])
+    return result, "MASTER %s - %s | %s" % (status_text[result],
+        ', '.join([r[1] for r in results]), ' '.join([r[2] for r in results]))
+
+def check(args):
+    if args.extended:
+        return extended(args)
+    return status(args.host, args.port, args.database, args.user,
+        args.password, args.timeout)
+
+def parse_args(argv=None):
+    """ Parse the arguments in argv, or on the command line. """
     parser = argparse.ArgumentParser()
     parser.add_argument("-p", "--port", type=int,
         help="Port for postgresql instance", default=5432)
@@ -37,14 +185,49 @@ def main():
         help="Username for connection")
     parser.add_argument("-P", "--password",
         help="Password for connection")
+    parser.add_argument("-t", "--timeout", type=int, default=10,
+        help="Connection and statement timeout in seconds")
+    parser.add_argument("-e", "--extended", action='store_true',
+        help="Also check connections, transactions, locks, checkpoints "
+        "and cache hit ratio")
+    parser.add_argument("--connections-warning", type=float, default=80,
+        help="Warning level for connections as percentage of max_connections")
+    parser.add_argument("--connections-critical", type=float, default=95,
+        help="Critical level for connections as percentage of max_connections")
+    parser.add_argument("--xact-warning", type=float, default=600,
+        help="Warning level for age of oldest transaction in seconds")
+    parser.add_argument("--xact-critical", type=float, default=3600,
+        help="Critical level for age of oldest transaction in seconds")
+    parser.add_argument("--waiting-warning", type=int, default=5,
+        help="Warning level for backends waiting for locks")
+    parser.add_argument("--waiting-critical", type=int, default=20,
+        help="Critical level for backends waiting for locks")
+    parser.add_argument("--checkpoint-warning", type=float, default=30,
+        help="Warning level for percentage of checkpoints requested")
+    parser.add_argument("--checkpoint-critical", type=float, default=60,
+        help="Critical level for percentage of checkpoints requested")
+    parser.add_argument("--hit-warning", type=float, default=95,
+        help="Warning level for buffer cache hit percentage")
+    parser.add_argument("--hit-critical", type=float, default=90,
+        help="Critical level for buffer cache hit percentage")
+    parser.add_argument("--state-dir", default='/var/cache/siyavula-ha-scripts',
+        help="Where to keep the previous sample of the counters")
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     if not (args.user and args.password):
         parser.error('You must provide a user and password for the connection')
 
-    sys.exit(status(args.host, args.port, args.database, args.user,
-        args.password))
+    return args
+
+def main():
+    # The runner may already have the answer
+    result = from_runner('check_pg_master')
+    if result is None:
+        result = check(parse_args())
+    status, output = result
+    print output
+    sys.exit(status)
 
 
 if __name__ == '__main__':
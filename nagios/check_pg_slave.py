@@ -1,64 +1,443 @@
 #!/usr/bin/python
 #
-# Python munin plugin to check how far behind a postgresql replica might be.
+# Python nagios plugin to check how far behind the postgresql replicas are.
+# Pass the DSN of every node with -d, the master is found by asking each of
+# them whether it is in recovery. The lag of every standby is measured in
+# bytes of WAL not yet received and not yet replayed, and in seconds since
+# the last replayed transaction, and each has warning and critical levels.
+#
+# Every run also records the master, receive and replay positions of each
+# standby in a small history in --history-dir. From it we work out how fast
+# the master generates WAL and how fast the standby replays it, and so
+# whether a lagging standby is catching up and how long that will take. A
+# standby that lags beyond the byte levels but is catching up is judged on
+# its time to catch up (--eta-warning, --eta-critical) instead, so a burst
+# of writes doesn't raise an alarm. A standby that replays clearly slower
+# than the master writes is a warning, even while its lag is still under
+# the byte levels.
+#
+# With --mode conflicts it checks the hot standbys for queries cancelled by
+# replay conflicts instead, as a rate per minute worked out from the
+# counters in pg_stat_database_conflicts and the previous sample in
+# --history-dir. It also warns when replay is paused, and when replay is
+# being held back by long running queries on the standby.
 
 import sys
+import os
+import re
+import time
 import argparse
+import threading
 import psycopg2
+import pglsn
 
-def CalculateNumericalOffset(stringofs):
-    pieces = stringofs.split('/')
-    assert(len(pieces)==2)
-    return 0xffffffff * int(pieces[0], 16) + int(pieces[1], 16)
+from checklib import History, evaluate, from_runner
 
-def main():
+GOOD = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+status_text = {
+    GOOD: 'OK',
+    WARNING: 'WARNING',
+    CRITICAL: 'CRITICAL',
+    UNKNOWN: 'UNKNOWN'
+}
+
+# Set by check_runner to keep connections open between runs
+connections = None
+
+class Node(object):
+    """ A postgresql node, connected to and queried in its own thread. """
+
+    def __init__(self, dsn, timeout):
+        self.dsn = dsn
+        self.timeout = timeout
+        self.db = None
+        self.error = None
+        self.recovery = None
+        self.address = None
+        self.receive = None
+        self.replay = None
+        self.replay_age = None
+        self.current = None
+        self.paused = None
+        self.oldest_xact = None
+        self.conflicts = None
+
+    @property
+    def name(self):
+        return self.address or "localhost"
+
+    def connect(self):
+        dsn = "%s connect_timeout=%d options='-c statement_timeout=%d'" % (
+            self.dsn, self.timeout, self.timeout * 1000)
+        try:
+            if connections is None:
+                self.db = psycopg2.connect(dsn)
+            else:
+                self.db = connections.get(dsn, psycopg2.connect)
+        except psycopg2.Error, e:
+            self.error = str(e).strip()
+
+    def query_standby(self):
+        """ Everything we need from a standby in one round-trip. """
+        if self.db is None:
+            return
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT pg_is_in_recovery(), inet_server_addr(), "
+                "%(receive)s(), %(replay)s(), "
+                "extract(epoch from now() - pg_last_xact_replay_timestamp())" % \
+                pglsn.functions(self.db.server_version))
+            (self.recovery, self.address, self.receive, self.replay,
+                self.replay_age) = c.fetchone()
+        except psycopg2.Error, e:
+            self.error = str(e).strip()
+
+    def query_conflicts(self):
+        """ Replay state, the age of the oldest transaction on the standby
+            and the conflict counters, in one round-trip. """
+        if self.db is None:
+            return
+        names = pglsn.functions(self.db.server_version)
+        # pg_stat_activity.pid was procpid before 9.2
+        names['pid'] = self.db.server_version < 90200 and 'procpid' or 'pid'
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT pg_is_in_recovery(), inet_server_addr(), "
+                "CASE WHEN pg_is_in_recovery() THEN %(paused)s() END, "
+                "%(receive)s(), %(replay)s(), "
+                "extract(epoch from now() - pg_last_xact_replay_timestamp()), "
+                "(SELECT extract(epoch from max(now() - xact_start)) "
+                "  FROM pg_stat_activity WHERE %(pid)s <> pg_backend_pid()), "
+                "c.* FROM (SELECT sum(confl_tablespace), sum(confl_lock), "
+                "  sum(confl_snapshot), sum(confl_bufferpin), "
+                "  sum(confl_deadlock) FROM pg_stat_database_conflicts) c" % \
+                names)
+            row = c.fetchone()
+            (self.recovery, self.address, self.paused, self.receive,
+                self.replay, self.replay_age, self.oldest_xact) = row[:7]
+            self.conflicts = tuple([int(x or 0) for x in row[7:]])
+        except psycopg2.Error, e:
+            self.error = str(e).strip()
+
+    def query_master(self):
+        if self.db is None:
+            return
+        try:
+            c = self.db.cursor()
+            c.execute("SELECT %(current)s()" % \
+                pglsn.functions(self.db.server_version))
+            self.current = c.fetchone()[0]
+        except psycopg2.Error, e:
+            self.error = str(e).strip()
+
+    def close(self):
+        if self.db is None:
+            return
+        if connections is None:
+            self.db.close()
+        elif self.error is not None:
+            connections.discard(self.db)
+        self.db = None
+
+class LagHistory(History):
+    """ Samples of the positions of a standby, (time, master, receive,
+        replay). """
+
+    def __init__(self, directory, name, size, kind='pg_slave'):
+        History.__init__(self, directory, name, size, kind)
+
+    def rates(self):
+        """ Returns the WAL generation rate on the master and the replay
+            rate on the standby in bytes per second over the whole history,
+            or None if there isn't enough of it. """
+        if len(self.samples) < 2:
+            return None
+        first, last = self.samples[0], self.samples[-1]
+        elapsed = last[0] - first[0]
+        if elapsed <= 0:
+            return None
+        return (float(last[1] - first[1]) / elapsed,
+            float(last[3] - first[3]) / elapsed)
+
+    def lag_growth(self):
+        """ Bytes the replay lag grew by over the whole history. """
+        if len(self.samples) < 2:
+            return 0
+        first, last = self.samples[0], self.samples[-1]
+        return (last[1] - last[3]) - (first[1] - first[3])
+
+# Replay has to be this much slower than the master before we call it
+# falling behind, the rates are never exactly equal.
+FALLING_MARGIN = 0.05
+
+def catch_up_time(lag, wal_rate, replay_rate):
+    """ Seconds until the standby has caught up at current rates, None if
+        it isn't catching up. """
+    if lag <= 0:
+        return 0.0
+    if replay_rate <= wal_rate:
+        return None
+    return lag / (replay_rate - wal_rate)
+
+def falling_behind(wal_rate, replay_rate, growth):
+    """ Whether a standby replays clearly slower than the master writes,
+        and its lag really grew. A standby keeping up with a small steady
+        lag is not falling behind. """
+    return growth > 0 and replay_rate < wal_rate * (1 - FALLING_MARGIN)
+
+CONFLICT_TYPES = ('tablespace', 'lock', 'snapshot', 'bufferpin', 'deadlock')
+
+def conflict_rates(history):
+    """ Cancellations per minute for each type of conflict since the
+        previous sample, None if there is no usable previous sample. """
+    if len(history.samples) < 2:
+        return None
+    (t0, c0), (t1, c1) = history.samples[-2:]
+    if t1 <= t0 or [1 for a, b in zip(c0, c1) if b < a]:
+        # Clock went backwards, or the counters were reset
+        return None
+    return [(b - a) * 60.0 / (t1 - t0) for a, b in zip(c0, c1)]
+
+def in_parallel(nodes, fn):
+    threads = [threading.Thread(target=fn, args=(node,)) for node in nodes]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def check_lag(args):
+    nodes = [Node(dsn, args.timeout) for dsn in args.dsn]
+    try:
+        in_parallel(nodes, Node.connect)
+        in_parallel(nodes, Node.query_standby)
+
+        # The master's position is taken only once the standbys have
+        # answered, so that a standby can never legitimately be in front.
+        masters = [n for n in nodes if n.error is None and not n.recovery]
+        in_parallel(masters, Node.query_master)
+    finally:
+        for node in nodes:
+            node.close()
+
+    failed = [n for n in nodes if n.error is not None]
+    if failed:
+        return UNKNOWN, "REPLICATION UNKNOWN - %s" % ', '.join(
+            [n.error for n in failed])
+
+    if len(masters) > 1:
+        return CRITICAL, "Multiple masters, potential split brain!"
+
+    if len(masters) == 0:
+        return CRITICAL, "No master server"
+
+    standbys = [n for n in nodes if n.recovery]
+    if len(standbys) == 0:
+        return UNKNOWN, "No slave servers to compare"
+
+    master_num = pglsn.parse(masters[0].current)
+    now = time.time()
+    status = GOOD
+    messages = []
+    perfdata = []
+    for standby in standbys:
+        if standby.receive is None or standby.replay is None:
+            # Recovering from the archive, not streaming
+            status = max(status, CRITICAL)
+            messages.append("%s is not streaming" % standby.name)
+            continue
+
+        receive_num = pglsn.parse(standby.receive)
+        replay_num = pglsn.parse(standby.replay)
+        receive_delay = master_num - receive_num
+        replay_delay = master_num - replay_num
+        if receive_delay < 0:
+            status = max(status, CRITICAL)
+            messages.append("%s is in front of master" % standby.name)
+            continue
+
+        # When everything is replayed, the time since the last transaction
+        # only tells us the master is idle.
+        if replay_delay == 0 or standby.replay_age is None:
+            replay_age = 0.0
+        else:
+            replay_age = max(float(standby.replay_age), 0.0)
+
+        history = LagHistory(args.history_dir, standby.name, args.samples)
+        history.load()
+        # A master position going backwards means a failover or restore,
+        # older samples don't tell us anything about the new timeline.
+        if history.samples and master_num < history.samples[-1][1]:
+            history.samples = []
+        history.add((now, master_num, receive_num, replay_num))
+        history.save()
+        rates = history.rates()
+
+        lag_status = max(evaluate(receive_delay, args.warning, args.critical),
+            evaluate(replay_delay, args.warning, args.critical))
+        trend = ''
+        if rates is not None:
+            wal_rate, replay_rate = rates
+            eta = catch_up_time(replay_delay, wal_rate, replay_rate)
+            if eta is not None:
+                trend = ' catching up in %.0fs' % eta
+                if lag_status != GOOD:
+                    lag_status = evaluate(eta, args.eta_warning,
+                        args.eta_critical)
+            elif falling_behind(wal_rate, replay_rate, history.lag_growth()):
+                trend = ' falling behind'
+                lag_status = max(lag_status, WARNING)
+            else:
+                trend = ' steady'
+            perfdata.append("'%s wal rate'=%.0fB;;;0" % (
+                standby.name, wal_rate))
+            perfdata.append("'%s replay rate'=%.0fB;;;0" % (
+                standby.name, replay_rate))
+            if eta is not None:
+                perfdata.append("'%s catch up'=%.0fs;%s;%s;0" % (
+                    standby.name, eta, args.eta_warning, args.eta_critical))
+
+        s = max(lag_status,
+            evaluate(replay_age, args.warning_seconds, args.critical_seconds))
+        status = max(status, s)
+        messages.append("%s %s receive %dB replay %dB %.0fs%s" % (
+            standby.name, status_text[s], receive_delay, replay_delay,
+            replay_age, trend))
+        perfdata.append("'%s receive'=%dB;%d;%d;0" % (
+            standby.name, receive_delay, args.warning, args.critical))
+        perfdata.append("'%s replay'=%dB;%d;%d;0" % (
+            standby.name, replay_delay, args.warning, args.critical))
+        perfdata.append("'%s replay age'=%.3fs;%s;%s;0" % (
+            standby.name, replay_age, args.warning_seconds,
+            args.critical_seconds))
+
+    return status, "REPLICATION %s - %s | %s" % (status_text[status],
+        ', '.join(messages), ' '.join(perfdata))
+
+
+def check_conflicts(args):
+    nodes = [Node(dsn, args.timeout) for dsn in args.dsn]
+    try:
+        in_parallel(nodes, Node.connect)
+        in_parallel(nodes, Node.query_conflicts)
+    finally:
+        for node in nodes:
+            node.close()
+
+    failed = [n for n in nodes if n.error is not None]
+    if failed:
+        return UNKNOWN, "CONFLICTS UNKNOWN - %s" % ', '.join(
+            [n.error for n in failed])
+
+    standbys = [n for n in nodes if n.recovery]
+    if len(standbys) == 0:
+        return UNKNOWN, "No slave servers to check"
+
+    now = time.time()
+    status = GOOD
+    messages = []
+    perfdata = []
+    for standby in standbys:
+        history = History(args.history_dir, standby.name, 2, 'pg_conflicts')
+        history.load()
+        history.add((now, standby.conflicts))
+        history.save()
+
+        s = GOOD
+        problems = []
+        rates = conflict_rates(history)
+        if rates is not None:
+            total = sum(rates)
+            s = evaluate(total, args.conflict_warning, args.conflict_critical)
+            problems.append("%.1f cancellations/min" % total)
+            perfdata.append("'%s cancellations'=%.2f;%s;%s;0" % (
+                standby.name, total, args.conflict_warning,
+                args.conflict_critical))
+            for kind, rate in zip(CONFLICT_TYPES, rates):
+                perfdata.append("'%s %s'=%.2f;;;0" % (standby.name, kind, rate))
+
+        if standby.paused:
+            s = max(s, WARNING)
+            problems.append("replay paused")
+
+        # WAL that has arrived but is not being replayed while a query has
+        # been running for longer than that means replay is waiting for the
+        # query (max_standby_streaming_delay).
+        held = 0.0
+        if not standby.paused and standby.receive and standby.replay and \
+                pglsn.diff(standby.receive, standby.replay) > 0 and \
+                standby.replay_age is not None and \
+                standby.oldest_xact is not None and \
+                standby.oldest_xact >= standby.replay_age:
+            held = max(float(standby.replay_age), 0.0)
+            if held > 0:
+                s = max(s, evaluate(held, args.warning_seconds,
+                    args.critical_seconds))
+                problems.append("replay held back %.0fs by queries" % held)
+        perfdata.append("'%s held back'=%.3fs;%s;%s;0" % (standby.name, held,
+            args.warning_seconds, args.critical_seconds))
+        perfdata.append("'%s oldest query'=%.3fs;;;0" % (standby.name,
+            float(standby.oldest_xact or 0)))
+
+        status = max(status, s)
+        messages.append("%s %s%s" % (standby.name, status_text[s],
+            problems and ' ' + ', '.join(problems) or ''))
+
+    return status, "CONFLICTS %s - %s | %s" % (status_text[status],
+        ', '.join(messages), ' '.join(perfdata))
+
+def check(args):
+    if args.mode == 'conflicts':
+        return check_conflicts(args)
+    return check_lag(args)
+
+def parse_args(argv=None):
+    """ Parse the arguments in argv, or on the command line. """
     parser = argparse.ArgumentParser()
 
     parser.add_argument('-d', '--dsn', action='append',
         help="DSN for a postgresql node",
         required=True)
-    args = parser.parse_args()
-
-    masterdata = []
-    slavedata = []
-    for dsn in args.dsn:
-        db = psycopg2.connect(dsn)
-        c = db.cursor()
-        c.execute("select pg_is_in_recovery(), inet_server_addr()")
-        if c.fetchone()[0]:
-            c.execute("SELECT pg_last_xlog_receive_location(),pg_last_xlog_replay_location(),inet_server_addr()")
-            slavedata.append(c.fetchone())
-        else:
-            c.execute("SELECT pg_current_xlog_location()")
-            masterdata.append(c.fetchone())
-        db.close()
-
-    if len(masterdata) > 1:
-        print "Multiple masters, potential split brain!"
-        sys.exit(2)
-
-    if len(masterdata) == 0:
-        print "No master server"
-        sys.exit(2)
-
-    if len(slavedata) == 0:
-        print "No slave servers to compare"
-        sys.exit(3)
-
-    master_num = CalculateNumericalOffset(masterdata[0][0])
-    for slave in slavedata:
-        receive_delay = master_num - CalculateNumericalOffset(slave[0])
-        replay_delay = master_num = CalculateNumericalOffset(slave[1])
-        if receive_delay < 0:
-            print "Slave %s is in front of master" % (slave[2] or "localhost")
-            sys.exit(2)
-        if receive_delay > 0:
-            print "%s is behind by %d" % (slave[2] or "localhost",
-                receive_delay)
-            sys.exit(2)
-
-    print "Slaves OK"
-    sys.exit(0)
+    parser.add_argument('-t', '--timeout', type=int, default=10,
+        help="Connection and statement timeout in seconds")
+    parser.add_argument('-w', '--warning', type=int, default=16*1024*1024,
+        help="Warning level for lag in bytes")
+    parser.add_argument('-c', '--critical', type=int, default=128*1024*1024,
+        help="Critical level for lag in bytes")
+    parser.add_argument('-W', '--warning-seconds', type=float, default=60,
+        help="Warning level for replay lag, or replay held back by "
+        "queries, in seconds")
+    parser.add_argument('-C', '--critical-seconds', type=float, default=300,
+        help="Critical level for replay lag, or replay held back by "
+        "queries, in seconds")
+    parser.add_argument('--history-dir', default='/var/cache/siyavula-ha-scripts',
+        help="Where to keep the position history of each standby")
+    parser.add_argument('--samples', type=int, default=10,
+        help="Number of samples of history to keep")
+    parser.add_argument('--eta-warning', type=float, default=600,
+        help="Warning level for time to catch up in seconds")
+    parser.add_argument('--eta-critical', type=float, default=1800,
+        help="Critical level for time to catch up in seconds")
+    parser.add_argument('-m', '--mode', choices=('lag', 'conflicts'),
+        default='lag', help="Check replication lag, or conflicts on hot "
+        "standbys")
+    parser.add_argument('--conflict-warning', type=float, default=1,
+        help="Warning level for cancelled queries per minute")
+    parser.add_argument('--conflict-critical', type=float, default=10,
+        help="Critical level for cancelled queries per minute")
+    return parser.parse_args(argv)
+
+def main():
+    # The runner may already have the answer
+    result = from_runner('check_pg_slave')
+    if result is None:
+        result = check(parse_args())
+    status, output = result
+    print output
+    sys.exit(status)
 
 
 if __name__ == '__main__':
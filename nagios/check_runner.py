@@ -0,0 +1,496 @@
+#!/usr/bin/python
+#
+# This needs python-argparse, if used with python2.6.
+#
+# Resident runner for the nagios checks. Every check started by nrpe pays
+# for starting python, importing its modules and connecting to databases
+# from scratch. The runner loads each check once, runs them on a schedule in
+# a pool of threads, keeps database connections open between runs, and
+# answers for the latest results on a unix socket.
+#
+#   check_runner serve [-f config]
+#   check_runner query service [-m max-age]
+#
+# The second form prints the result of the service and exits with its status,
+# like the check itself would. If the result is older than max-age seconds
+# (by default the service's interval), the check is run again first.
+#
+# The nrpe commands don't have to change to use the runner. When the runner
+# is listening on its default socket, a check first asks it for the result
+# of a service running the same check with exactly the same arguments, and
+# only does the work itself if there is no such service or no runner. So
+# give each service the args of the nrpe command line it stands in for.
+#
+# The package ships a systemd unit for the runner, siyavula-check-runner,
+# which is not enabled. Copy the example configuration (in the package's
+# examples) to /etc/siyavula-ha-scripts/check_runner.conf, adjust it, and:
+#
+#   systemctl enable --now siyavula-check-runner
+#
+#   check_runner passive [-f config] (-c command-file | -d spool-dir)
+#
+# For passive checks, run from cron, this runs every service once, all at
+# the same time, and writes the results in one go as
+# PROCESS_SERVICE_CHECK_RESULT commands to the nagios command file, or to a
+# new file in a spool directory for something else to pass on. A service
+# whose status hasn't changed is only sent again after --resend seconds. If
+# nagios doesn't take the commands within --timeout seconds, the run fails
+# and everything is sent again next time. The service description is the
+# section name, unless the section has a description.
+#
+# The configuration has a section for every service, naming the check and
+# giving it the arguments it would get on the command line:
+#
+#   [runner]
+#   socket = /var/cache/siyavula-ha-scripts/check_runner.sock
+#   threads = 4
+#
+#   [replication]
+#   check = check_pg_slave
+#   args = -d "host=10.0.0.11 user=nagios" -d "host=10.0.0.12 user=nagios"
+#   interval = 60
+
+import sys
+import os
+import imp
+import time
+import errno
+import tempfile
+import shlex
+import socket
+import select
+import threading
+import traceback
+import json
+import argparse
+import SocketServer
+import ConfigParser
+from Queue import Queue
+
+from checklib import RUNNER_SOCKET, State
+
+CONFIG = '/etc/siyavula-ha-scripts/check_runner.conf'
+SOCKET = RUNNER_SOCKET
+STATE_DIR = '/var/cache/siyavula-ha-scripts'
+UNKNOWN = 3
+
+# Writes to a fifo of up to this many bytes are atomic, and are not
+# interleaved with those of other writers. POSIX guarantees at least 512.
+PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+class ConfigError(Exception):
+    pass
+
+class Connections(object):
+    """ Database connections kept open between runs, keyed on DSN. They are
+        in autocommit, so the statistics views are not frozen in a
+        transaction. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pool = {}
+
+    def get(self, dsn, connect):
+        self.lock.acquire()
+        try:
+            db = self.pool.get(dsn)
+            if db is not None and not db.closed:
+                return db
+        finally:
+            self.lock.release()
+        db = connect(dsn)
+        db.autocommit = True
+        self.lock.acquire()
+        try:
+            self.pool[dsn] = db
+        finally:
+            self.lock.release()
+        return db
+
+    def discard(self, db):
+        """ Forget a connection that failed, the next get reconnects. """
+        self.lock.acquire()
+        try:
+            for dsn, d in self.pool.items():
+                if d is db:
+                    del self.pool[dsn]
+        finally:
+            self.lock.release()
+        try:
+            db.close()
+        except Exception:
+            pass
+
+class Service(object):
+    def __init__(self, name, module, args, interval, description=None,
+            command=None):
+        self.name = name
+        self.description = description or name
+        self.module = module
+        self.args = args
+        self.command = command # (check, arguments), as on the command line
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.busy = False
+        self.next_run = 0
+        self.result = None # (time, status, output)
+
+    def run(self, max_age=0):
+        """ Run the check unless the result is younger than max_age, and
+            return the result. Only one run of a service happens at a
+            time. """
+        self.lock.acquire()
+        try:
+            if self.result is not None and \
+                    time.time() - self.result[0] < max_age:
+                return self.result
+            self.busy = True
+            try:
+                status, output = self.module.check(self.args)
+            except Exception, e:
+                traceback.print_exc()
+                status, output = UNKNOWN, "%s failed: %s" % (self.name, e)
+            self.result = (time.time(), status, output)
+            self.next_run = self.result[0] + self.interval
+            return self.result
+        finally:
+            self.busy = False
+            self.lock.release()
+
+def load_check(name, modules, connections):
+    """ Load a check once, from next to the runner. Installed checks don't
+        have a .py extension. """
+    if name not in modules:
+        here = os.path.dirname(os.path.realpath(__file__))
+        for path in (os.path.join(here, name),
+                os.path.join(here, name + '.py')):
+            if os.path.isfile(path):
+                break
+        else:
+            raise ConfigError("No check called %s" % name)
+        module = imp.load_source(name, path)
+        if hasattr(module, 'connections'):
+            module.connections = connections
+        modules[name] = module
+    return modules[name]
+
+def load_config(path):
+    """ Returns the runner options and the services in the configuration
+        file. """
+    config = ConfigParser.RawConfigParser()
+    if not config.read(path):
+        raise ConfigError("Cannot read %s" % path)
+    options = {'socket': SOCKET, 'threads': 4}
+    if config.has_section('runner'):
+        options.update(config.items('runner'))
+    options['threads'] = int(options['threads'])
+
+    modules = {}
+    connections = Connections()
+    services = []
+    for name in config.sections():
+        if name == 'runner':
+            continue
+        items = dict(config.items(name))
+        if 'check' not in items:
+            raise ConfigError("[%s] has no check" % name)
+        module = load_check(items['check'], modules, connections)
+        argv = shlex.split(items.get('args', ''))
+        try:
+            args = module.parse_args(argv)
+        except SystemExit:
+            raise ConfigError("[%s] has bad args" % name)
+        services.append(Service(name, module, args,
+            int(items.get('interval', 300)), items.get('description'),
+            (items['check'], tuple(argv))))
+    return options, services
+
+class Runner(object):
+    def __init__(self, services, threads):
+        self.services = dict([(s.name, s) for s in services])
+        self.commands = dict([(s.command, s) for s in services
+            if s.command is not None])
+        self.queue = Queue()
+        self.threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self.work)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+
+    def work(self):
+        while True:
+            service = self.queue.get()
+            try:
+                if service is None:
+                    return
+                service.run()
+            finally:
+                self.queue.task_done()
+
+    def run_all(self):
+        """ Run every service now, and wait for all of them. """
+        for service in self.services.values():
+            self.queue.put(service)
+        self.queue.join()
+
+    def stop(self):
+        for t in self.threads:
+            self.queue.put(None)
+        for t in self.threads:
+            t.join()
+
+    def schedule(self):
+        """ Queue the services that are due, forever. """
+        while True:
+            now = time.time()
+            for service in self.services.values():
+                if service.next_run <= now and not service.busy:
+                    # Don't queue it again while it waits for a thread
+                    service.next_run = now + service.interval
+                    self.queue.put(service)
+            time.sleep(1)
+
+class QueryHandler(SocketServer.StreamRequestHandler):
+    """ A query is a line with the service name and, optionally, the
+        maximum age in seconds of the result. The answer is the status on
+        a line, followed by the output of the check.
+
+        A check asking on behalf of nrpe sends a JSON list of its name and
+        arguments instead. If no service runs it like that, the connection
+        is closed without an answer, and the check runs itself. """
+
+    def handle(self):
+        line = self.rfile.readline()
+        if line.startswith('['):
+            try:
+                command = [str(f) for f in json.loads(line)]
+                key = (command[0], tuple(command[1:]))
+            except (ValueError, TypeError, UnicodeError, IndexError):
+                return
+            service = self.server.runner.commands.get(key)
+            if service is not None:
+                when, status, output = service.run(service.interval)
+                self.wfile.write("%d\n%s\n" % (status, output))
+            return
+        fields = line.split()
+        service = fields and self.server.runner.services.get(fields[0])
+        if not service:
+            self.wfile.write("%d\nUNKNOWN - no such service\n" % UNKNOWN)
+            return
+        max_age = service.interval
+        if len(fields) > 1:
+            try:
+                max_age = float(fields[1])
+            except ValueError:
+                pass
+        when, status, output = service.run(max_age)
+        self.wfile.write("%d\n%s\n" % (status, output))
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+def serve(args):
+    try:
+        options, services = load_config(args.config)
+    except ConfigError, e:
+        print >>sys.stderr, str(e)
+        return 1
+
+    if os.path.exists(options['socket']):
+        os.unlink(options['socket'])
+    server = QueryServer(options['socket'], QueryHandler)
+    server.runner = Runner(services, options['threads'])
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    server.runner.schedule()
+
+def query(args):
+    """ Ask the runner for the result of a service, print it, and return
+        its status. """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    s.settimeout(args.timeout)
+    try:
+        s.connect(args.socket)
+        if args.max_age is None:
+            s.sendall("%s\n" % args.service)
+        else:
+            s.sendall("%s %s\n" % (args.service, args.max_age))
+        answer = []
+        while True:
+            data = s.recv(4096)
+            if not data:
+                break
+            answer.append(data)
+    except socket.error, e:
+        print "UNKNOWN - check_runner not answering: %s" % e
+        return UNKNOWN
+    finally:
+        s.close()
+    try:
+        status, output = ''.join(answer).split('\n', 1)
+        status = int(status)
+    except ValueError:
+        print "UNKNOWN - check_runner gave no answer"
+        return UNKNOWN
+    sys.stdout.write(output)
+    return status
+
+class Sent(object):
+    """ The status last sent for each service, and when, kept between
+        runs. """
+
+    def __init__(self, directory):
+        self.state = State(directory, 'check_runner.passive')
+        self.sent = {}
+
+    def load(self):
+        self.sent = self.state.load() or {}
+
+    def save(self):
+        # If it can't be written, everything is sent next time
+        self.state.save(self.sent)
+
+    def due(self, name, status, now, resend):
+        """ Whether a result needs sending, and if so note that it was. """
+        last = self.sent.get(name)
+        if last is not None and last[0] == status and now - last[1] < resend:
+            return False
+        self.sent[name] = (status, now)
+        return True
+
+def format_result(host, service, when, status, output):
+    """ An external command submitting a passive result. Nagios turns \\n
+        back into new lines, for long output. Long output is cut short, so
+        that the command can be written to the fifo in one piece. """
+    output = output.strip().replace('\\', '\\\\').replace('\n', '\\n')
+    command = "[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;" % (when, host,
+        service, status)
+    output = output[:max(0, PIPE_BUF - len(command) - 1)]
+    if (len(output) - len(output.rstrip('\\'))) % 2:
+        output = output[:-1] # Don't leave half an escape
+    return command + output + "\n"
+
+def chunks(lines, size):
+    """ Whole lines, joined into chunks of at most size bytes. A line
+        longer than size is a chunk of its own. """
+    chunk = ''
+    for line in lines:
+        if chunk and len(chunk) + len(line) > size:
+            yield chunk
+            chunk = ''
+        chunk += line
+    if chunk:
+        yield chunk
+
+def submit(lines, args):
+    """ Write the commands to a new file in the spool directory, which
+        appears in one go, or to the nagios command file. That is a fifo,
+        and other writers may be writing to it too, so it is written in
+        chunks of whole lines small enough to be written atomically, and
+        a command is never split. """
+    if args.spool_dir:
+        data = ''.join(lines)
+        fd, tmp = tempfile.mkstemp(dir=args.spool_dir, prefix='.check_runner')
+        fp = os.fdopen(fd, 'wb')
+        try:
+            fp.write(data)
+        finally:
+            fp.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, os.path.join(args.spool_dir,
+            'check_runner.%d.%d' % (time.time(), os.getpid())))
+        return
+    # Don't hang if nagios isn't reading the fifo. A non-blocking write of
+    # up to PIPE_BUF bytes either writes all of it, or fails with EAGAIN.
+    deadline = time.time() + args.timeout
+    fd = os.open(args.command_file, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+    try:
+        for chunk in chunks(lines, PIPE_BUF):
+            while True:
+                try:
+                    os.write(fd, chunk)
+                    break
+                except OSError, e:
+                    if e.errno != errno.EAGAIN:
+                        raise
+                if time.time() >= deadline:
+                    raise OSError(errno.ETIMEDOUT, "Nagios is not reading %s"
+                        % args.command_file)
+                time.sleep(0.1) # Fifo is full, wait for nagios to drain it
+    finally:
+        os.close(fd)
+
+def passive(args):
+    try:
+        options, services = load_config(args.config)
+    except ConfigError, e:
+        print >>sys.stderr, str(e)
+        return 1
+
+    runner = Runner(services, options['threads'])
+    runner.run_all()
+    runner.stop()
+
+    sent = Sent(args.state_dir)
+    sent.load()
+    now = time.time()
+    lines = []
+    for service in sorted(services, key=lambda s: s.name):
+        when, status, output = service.result
+        if sent.due(service.name, status, now, args.resend):
+            lines.append(format_result(args.host, service.description, when,
+                status, output))
+    if lines:
+        try:
+            submit(lines, args)
+        except (IOError, OSError), e:
+            print >>sys.stderr, "Cannot submit results: %s" % e
+            return 1
+    sent.save()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers()
+
+    p = commands.add_parser('serve', help="Run the checks")
+    p.add_argument("-f", "--config", default=CONFIG,
+        help="Configuration file")
+    p.set_defaults(command=serve)
+
+    p = commands.add_parser('query', help="Get the result of a service")
+    p.add_argument("service", help="Name of the service")
+    p.add_argument("-m", "--max-age", type=float,
+        help="Run the check if its result is older than this many seconds")
+    p.add_argument("-s", "--socket", default=SOCKET,
+        help="Socket the runner listens on")
+    p.add_argument("-t", "--timeout", type=float, default=60,
+        help="Give up after this many seconds")
+    p.set_defaults(command=query)
+
+    p = commands.add_parser('passive', help="Run the checks once and "
+        "submit the results")
+    p.add_argument("-f", "--config", default=CONFIG,
+        help="Configuration file")
+    target = p.add_mutually_exclusive_group(required=True)
+    target.add_argument("-c", "--command-file",
+        help="Nagios external command file")
+    target.add_argument("-d", "--spool-dir",
+        help="Write the commands to a new file in this directory instead")
+    p.add_argument("-H", "--host", default=socket.gethostname(),
+        help="Host name the services belong to in nagios")
+    p.add_argument("-r", "--resend", type=float, default=900,
+        help="Seconds before an unchanged status is sent again")
+    p.add_argument("-t", "--timeout", type=float, default=30,
+        help="Give up writing to the command file after this many seconds")
+    p.add_argument("--state-dir", default=STATE_DIR,
+        help="Where to remember what was sent")
+    p.set_defaults(command=passive)
+
+    args = parser.parse_args()
+    sys.exit(args.command(args))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/python
+#
+# This needs python-argparse, if used with python2.6.
+#
+# Python nagios plugin that checks how long a ZEO server takes to answer a
+# client. It connects to the storage server, registers with a storage and
+# times a lastTransaction call, using the same probe (in zeoprobe.py) the zeo
+# resource agent uses for its deep monitor.
+
+import sys
+import argparse
+
+from checklib import from_runner
+from zeoprobe import ZEOProbe, ZEOProbeFailed
+
+GOOD = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+status_text = {
+    GOOD: 'OK',
+    WARNING: 'WARNING',
+    CRITICAL: 'CRITICAL',
+    UNKNOWN: 'UNKNOWN'
+}
+
+def parse_args(argv=None):
+    """ Parse the arguments in argv, or on the command line. """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-a", "--address", required=True,
+        help="ZEO server address, host:port or path to unix socket")
+    parser.add_argument("-s", "--storage", default='1',
+        help="Name of storage to probe")
+    parser.add_argument("-w", "--warning", type=float,
+        help="Warning lastTransaction time in seconds", default=1.0)
+    parser.add_argument("-c", "--critical", type=float,
+        help="Critical lastTransaction time in seconds", default=5.0)
+    parser.add_argument("-t", "--timeout", type=float,
+        help="Give up after this many seconds", default=10.0)
+    return parser.parse_args(argv)
+
+def check(args):
+    try:
+        connect, rtt = ZEOProbe(args.address, args.storage,
+            args.timeout).probe()
+    except ZEOProbeFailed, e:
+        return CRITICAL, "ZEO CRITICAL - %s: %s" % (args.address, e)
+
+    perfdata = "connect=%.6fs;;;0 lastTransaction=%.6fs;%s;%s;0" % (
+        connect, rtt, args.warning, args.critical)
+    if rtt > args.critical:
+        status = CRITICAL
+    elif rtt > args.warning:
+        status = WARNING
+    else:
+        status = GOOD
+    return status, "ZEO %s - lastTransaction took %.3fs | %s" % (
+        status_text[status], rtt, perfdata)
+
+def main():
+    # The runner may already have the answer
+    result = from_runner('check_zeo')
+    if result is None:
+        result = check(parse_args())
+    status, output = result
+    print output
+    sys.exit(status)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+# Things the nagios checks have in common: judging a value against warning
+# and critical levels, keeping samples between runs so that counters can be
+# turned into deltas and rates, or trends worked out from a history, and
+# asking check_runner for a result instead of doing the work again.
+#
+# Samples are pickled in a state directory, by default the package's cache
+# directory. They are written to the side and renamed into place, so a check
+# never reads a half written file. This lives next to the checks and is
+# imported by them, like pglsn.
+
+import sys
+import os
+import re
+import json
+import socket
+import tempfile
+import cPickle
+
+GOOD = 0
+WARNING = 1
+CRITICAL = 2
+UNKNOWN = 3
+
+RUNNER_SOCKET = '/var/cache/siyavula-ha-scripts/check_runner.sock'
+
+def evaluate(value, warning, critical):
+    """ Status of a value where higher is worse. """
+    if value >= critical:
+        return CRITICAL
+    if value >= warning:
+        return WARNING
+    return GOOD
+
+def deltas(previous, current, keys=None):
+    """ How much each counter in current (or only those in keys) went up
+        since the (time, counters) sample before it, and the seconds in
+        between. None if there is no usable sample. """
+    if previous is None:
+        return None
+    (t0, c0), (t1, c1) = previous, current
+    if t1 <= t0:
+        return None
+    result = {}
+    for k in keys or c1.keys():
+        if k not in c0 or k not in c1 or c1[k] < c0[k]:
+            return None # Rebooted, reset or recreated since
+        result[k] = c1[k] - c0[k]
+    return t1 - t0, result
+
+def rates(previous, current, keys=None):
+    """ Per second rates of the counters in current, given the (time,
+        counters) sample before it. None if there is no usable sample. """
+    d = deltas(previous, current, keys)
+    if d is None:
+        return None
+    elapsed, counts = d
+    return dict([(k, v / float(elapsed)) for k, v in counts.items()])
+
+def _load(path):
+    """ The object pickled in path, None if there isn't a usable one. """
+    try:
+        fp = open(path, 'rb')
+        try:
+            return cPickle.load(fp)
+        finally:
+            fp.close()
+    except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+        return None
+
+def _save(path, ob):
+    """ Pickle ob to path. Returns False if the directory isn't writable. """
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path),
+            prefix='.' + os.path.basename(path))
+    except (IOError, OSError):
+        return False
+    fp = os.fdopen(fd, 'wb')
+    try:
+        cPickle.dump(ob, fp, 2)
+    finally:
+        fp.close()
+    os.rename(tmp, path)
+    return True
+
+class State(object):
+    """ The previous sample of counters, pickled between runs. """
+
+    def __init__(self, directory, name):
+        self.directory = directory
+        self.path = os.path.join(directory, name + '.pickle')
+
+    def load(self):
+        """ The stored sample, None if there isn't one. """
+        return _load(self.path)
+
+    def save(self, sample):
+        """ Store sample. Returns False if the state can't be written. """
+        return _save(self.path, sample)
+
+    def swap(self, sample):
+        """ Store sample, and return the one stored before it. If the state
+            can't be written, do without. """
+        previous = self.load()
+        self.save(sample)
+        return previous
+
+class History(object):
+    """ A ring buffer of the last size samples of something, pickled to
+        disk between runs. Checks subclass it to work out trends. """
+
+    def __init__(self, directory, name, size, kind):
+        self.directory = directory
+        self.size = size
+        self.path = os.path.join(directory, '%s-%s.pickle' % (kind,
+            re.sub('[^A-Za-z0-9]+', '_', name).strip('_') or 'root'))
+        self.samples = []
+
+    def load(self):
+        self.samples = _load(self.path) or []
+
+    def save(self):
+        _save(self.path, self.samples) # If it can't be written, do without
+
+    def add(self, sample):
+        self.samples.append(sample)
+        self.samples = self.samples[-self.size:]
+
+def from_runner(check, argv=None, path=None, timeout=60):
+    """ Ask check_runner for the result of check, run with argv (by default
+        our own arguments). Returns (status, output), or None if there is
+        no runner, or it doesn't run the check with those arguments, in
+        which case the caller runs the check itself. """
+    path = path or RUNNER_SOCKET
+    if argv is None:
+        argv = sys.argv[1:]
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    answer = []
+    try:
+        try:
+            sock.settimeout(timeout)
+            sock.connect(path)
+            sock.sendall(json.dumps([check] + list(argv)) + "\n")
+            while True:
+                data = sock.recv(4096)
+                if not data:
+                    break
+                answer.append(data)
+        except socket.error:
+            return None
+    finally:
+        sock.close()
+    try:
+        status, output = ''.join(answer).split('\n', 1)
+        return int(status), output.rstrip('\n')
+    except ValueError:
+        return None
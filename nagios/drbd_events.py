@@ -0,0 +1,316 @@
+#!/usr/bin/python
+#
+# This needs python-argparse, if used with python2.6.
+#
+# Resident watcher that follows "drbdsetup events2" and keeps the current
+# state of every drbd device in a state file, so check_drbd_status can read
+# it instead of parsing /proc/drbd, and so state changes that happen between
+# nagios polls are not lost. Every transition is kept in a history, and a
+# connection that goes away and comes back within --flap-window seconds is
+# counted as a brief disconnect.
+#
+# The event stream only has statistics when something changes, so when it
+# has been quiet for --interval seconds a snapshot is taken with
+# "drbdsetup events2 --now" to keep the counters fresh.
+#
+# The state file is a pickled dict that is replaced atomically:
+#
+#   pid      pid of the watcher, None for a replay with --input
+#   updated  time of the last write
+#   interval the --interval the watcher runs with
+#   devices  dict of minor to a dict with cs, ro, ds, counters (named as in
+#            /proc/drbd), synced, flaps and since (time of last change)
+#   history  list of (time, name, what, old, new), oldest first
+#
+# Run it as root, from something that restarts it, eg. an inittab respawn
+# entry or a pacemaker clone. With --input it replays events from a file
+# and exits at the end of it, which is useful for testing. check_drbd_status
+# reads a replayed state file for as long as it is fresh, 3 times
+# --interval, even though the watcher is gone. There is a fixture in
+# tests/fixtures/drbd_events2.txt.
+
+import sys
+import os
+import time
+import select
+import signal
+import calendar
+import tempfile
+import cPickle
+import subprocess
+import argparse
+
+STATE = '/var/cache/siyavula-ha-scripts/drbd_events.pickle'
+DRBDSETUP = 'drbdsetup'
+
+# Statistics in events2 and the /proc/drbd counters they correspond to
+DEVICE_COUNTERS = {
+    'written': 'dw',
+    'read': 'dr',
+    'al-writes': 'al',
+    'bm-writes': 'bm',
+    'lower-pending': 'lo',
+    'upper-pending': 'ap',
+}
+PEER_DEVICE_COUNTERS = {
+    'sent': 'ns',
+    'received': 'nr',
+    'pending': 'pe',
+    'unacked': 'ua',
+    'out-of-sync': 'oos',
+}
+
+def parse_timestamp(ts):
+    """ Seconds since the epoch of a --timestamps time, which looks like
+        2016-02-19T16:52:57.123456+01:00 """
+    base, offset = ts[:26], ts[26:]
+    t = time.strptime(base.split('.')[0], '%Y-%m-%dT%H:%M:%S')
+    seconds = calendar.timegm(t) + float('0.' + base.split('.')[1])
+    if offset and offset != 'Z':
+        sign = offset[0] == '-' and -1 or 1
+        hours, minutes = offset[1:].split(':')
+        seconds -= sign * (int(hours) * 3600 + int(minutes) * 60)
+    return seconds
+
+def parse_event(line):
+    """ Split an events2 line into time (None without --timestamps), event
+        (exists, create, change, destroy, call, response), object type and a
+        dict of its fields. Returns None for lines that are not events. """
+    fields = line.split()
+    when = None
+    if fields and fields[0][:1].isdigit() and 'T' in fields[0]:
+        try:
+            when = parse_timestamp(fields.pop(0))
+        except ValueError:
+            return None
+    if len(fields) < 2:
+        return None # Like "exists -", the end of the initial state
+    values = {}
+    for field in fields[2:]:
+        if ':' in field:
+            k, v = field.split(':', 1)
+            values[k] = v
+    return when, fields[0], fields[1], values
+
+class Watcher(object):
+    def __init__(self, flap_window, history_size):
+        self.flap_window = flap_window
+        self.history_size = history_size
+        self.resources = {}     # name: role
+        self.connections = {}   # (name, peer): dict(connection, role)
+        self.volumes = {}       # (name, volume): dict(minor, disk, counters)
+        self.peer_devices = {}  # (name, peer, volume): dict
+        self.disconnected = {}  # (name, peer): time the connection went away
+        self.flaps = {}         # name: count
+        self.since = {}         # name: time of last transition
+        self.history = []
+
+    def record(self, when, name, what, old, new):
+        if old == new:
+            return
+        self.since[name] = when
+        self.history.append((when, name, what, old, new))
+        del self.history[:-self.history_size]
+
+    def event(self, when, event, kind, values):
+        """ Apply one event to the state. Returns True if something the
+            state file holds changed. """
+        if event not in ('exists', 'create', 'change', 'destroy'):
+            return False
+        name = values.get('name')
+        if name is None:
+            return False
+        peer = values.get('peer-node-id')
+        volume = values.get('volume')
+
+        if kind == 'resource':
+            if event == 'destroy':
+                self.resources.pop(name, None)
+            elif 'role' in values:
+                self.record(when, name, 'role', self.resources.get(name),
+                    values['role'])
+                self.resources[name] = values['role']
+        elif kind == 'connection':
+            key = (name, peer)
+            if event == 'destroy':
+                self.connections.pop(key, None)
+                return True
+            conn = self.connections.setdefault(key, {})
+            if 'connection' in values:
+                old, new = conn.get('connection'), values['connection']
+                self.record(when, name, 'connection', old, new)
+                if old == 'Connected' and new != 'Connected':
+                    self.disconnected[key] = when
+                elif new == 'Connected' and key in self.disconnected:
+                    if when - self.disconnected.pop(key) <= self.flap_window:
+                        self.flaps[name] = self.flaps.get(name, 0) + 1
+            conn.update(values)
+        elif kind == 'device':
+            key = (name, volume)
+            if event == 'destroy':
+                self.volumes.pop(key, None)
+                return True
+            vol = self.volumes.setdefault(key, {'counters': {}})
+            if 'disk' in values:
+                self.record(when, name, 'disk', vol.get('disk'),
+                    values['disk'])
+            for k, v in values.items():
+                if k in DEVICE_COUNTERS:
+                    vol['counters'][DEVICE_COUNTERS[k]] = int(v)
+                else:
+                    vol[k] = v
+        elif kind == 'peer-device':
+            key = (name, peer, volume)
+            if event == 'destroy':
+                self.peer_devices.pop(key, None)
+                return True
+            pd = self.peer_devices.setdefault(key, {'counters': {}})
+            for what in ('replication', 'peer-disk'):
+                if what in values:
+                    self.record(when, name, what, pd.get(what), values[what])
+            for k, v in values.items():
+                if k in PEER_DEVICE_COUNTERS:
+                    pd['counters'][PEER_DEVICE_COUNTERS[k]] = int(v)
+                else:
+                    pd[k] = v
+        else:
+            return False
+        return True
+
+    def devices(self):
+        """ The state of every device, in the terms of /proc/drbd. """
+        result = {}
+        for (name, volume), vol in self.volumes.items():
+            if 'minor' not in vol:
+                continue
+            # A pair has one peer, with more take the first
+            peers = sorted([k for k in self.peer_devices
+                if k[0] == name and k[2] == volume])
+            pd = peers and self.peer_devices[peers[0]] or {}
+            conn = peers and self.connections.get(peers[0][:2]) or {}
+
+            cs = conn.get('connection', 'StandAlone')
+            if cs == 'Connected' and pd.get('replication') not in (None,
+                    'Established', 'Off'):
+                cs = pd['replication']
+            counters = dict(vol['counters'])
+            counters.update(pd.get('counters', {}))
+            synced = None
+            if 'done' in pd and cs.startswith('Sync'):
+                synced = float(pd['done'])
+            result[vol['minor']] = {
+                'name': name,
+                'cs': cs,
+                'ro': '%s/%s' % (self.resources.get(name, 'Unknown'),
+                    conn.get('role', 'Unknown')),
+                'ds': '%s/%s' % (vol.get('disk', 'DUnknown'),
+                    pd.get('peer-disk', 'DUnknown')),
+                'counters': counters,
+                'synced': synced,
+                'flaps': self.flaps.get(name, 0),
+                'since': self.since.get(name),
+            }
+        return result
+
+    def save(self, path, interval, replay=False):
+        state = {
+            'pid': not replay and os.getpid() or None,
+            'updated': time.time(),
+            'interval': interval,
+            'devices': self.devices(),
+            'history': self.history,
+        }
+        directory = os.path.dirname(path)
+        fd, tmp = tempfile.mkstemp(dir=directory,
+            prefix='.' + os.path.basename(path))
+        fp = os.fdopen(fd, 'wb')
+        try:
+            cPickle.dump(state, fp, 2)
+        finally:
+            fp.close()
+        os.chmod(tmp, 0644) # mkstemp makes it private, nagios has to read it
+        os.rename(tmp, path)
+
+    def feed(self, lines):
+        """ Apply events from lines. Returns True if the state changed. """
+        changed = False
+        for line in lines:
+            e = parse_event(line)
+            if e is None:
+                continue
+            when, event, kind, values = e
+            if when is None:
+                when = time.time()
+            changed = self.event(when, event, kind, values) or changed
+        return changed
+
+def snapshot(watcher):
+    """ Feed the current state with statistics into watcher. """
+    p = subprocess.Popen([DRBDSETUP, 'events2', '--now', '--statistics',
+        'all'], stdout=subprocess.PIPE, close_fds=True)
+    out = p.communicate()[0]
+    return watcher.feed(out.splitlines())
+
+def follow(watcher, args):
+    """ Follow the event stream until drbdsetup exits, writing the state
+        file whenever something changed. """
+    p = subprocess.Popen([DRBDSETUP, 'events2', '--timestamps',
+        '--statistics', 'all'], stdout=subprocess.PIPE, close_fds=True)
+    try:
+        last = 0
+        while True:
+            ready = select.select([p.stdout], [], [], args.interval)[0]
+            if ready:
+                line = p.stdout.readline()
+                if not line:
+                    break
+                if watcher.feed([line]):
+                    watcher.save(args.state, args.interval)
+                    last = time.time()
+            if time.time() - last >= args.interval:
+                snapshot(watcher)
+                watcher.save(args.state, args.interval)
+                last = time.time()
+    finally:
+        if p.poll() is None:
+            os.kill(p.pid, signal.SIGTERM)
+        p.wait()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-s", "--state", default=STATE,
+        help="State file to write")
+    parser.add_argument("-i", "--interval", type=int, default=10,
+        help="Refresh the statistics after this many quiet seconds")
+    parser.add_argument("-f", "--flap-window", type=float, default=30,
+        help="A disconnect shorter than this many seconds is brief")
+    parser.add_argument("-n", "--history", type=int, default=100,
+        help="Number of transitions to keep")
+    parser.add_argument("--input",
+        help="Replay events from this file instead of drbdsetup")
+    args = parser.parse_args()
+
+    watcher = Watcher(args.flap_window, args.history)
+
+    if args.input:
+        fp = open(args.input, 'r')
+        try:
+            watcher.feed(fp)
+        finally:
+            fp.close()
+        watcher.save(args.state, args.interval, replay=True)
+        return 0
+
+    while True:
+        try:
+            follow(watcher, args)
+        except OSError, e:
+            print >>sys.stderr, "Cannot run %s: %s" % (DRBDSETUP, e)
+        # drbdsetup went away, eg. drbd was reloaded. Try again shortly.
+        time.sleep(1)
+
+if __name__ == '__main__':
+    try:
+        sys.exit(main())
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,79 @@
+# Log sequence number (LSN) arithmetic for the postgresql checks.
+#
+# An LSN is shown by postgresql as two hexadecimal numbers, X/Y, which are
+# the high and low 32 bits of a 64-bit byte position in the WAL stream. The
+# difference between two positions is the number of bytes of WAL between
+# them.
+#
+# Postgresql 10 renamed the xlog functions to wal and location to lsn, the
+# names to use for a server are in functions(). This lives next to the
+# checks and is imported by them, and by the munin plugin.
+
+import re
+
+# server_version as reported by psycopg2, the first version using wal names
+WAL_RENAME = 100000
+
+LSN_RE = re.compile(r'^([0-9A-Fa-f]{1,8})/([0-9A-Fa-f]{1,8})$')
+
+def parse(lsn):
+    """ Turn an LSN like 16/B374D848 into a byte position. """
+    m = LSN_RE.match(lsn.strip())
+    if m is None:
+        raise ValueError("Invalid LSN %r" % (lsn,))
+    return (int(m.group(1), 16) << 32) | int(m.group(2), 16)
+
+def format_lsn(position):
+    """ The reverse of parse. """
+    if position < 0 or position >= 1 << 64:
+        raise ValueError("LSN out of range: %r" % (position,))
+    return '%X/%X' % (position >> 32, position & 0xffffffff)
+
+def diff(a, b):
+    """ Bytes from b to a, negative if b is in front of a. """
+    return parse(a) - parse(b)
+
+def compare(a, b):
+    return cmp(parse(a), parse(b))
+
+def lags(master, positions):
+    """ Bytes each of positions is behind master. master is either one
+        LSN that all positions are compared to, or a sequence of LSNs of
+        the same length as positions, so many standbys or many samples can
+        be done at once. Each distinct LSN is only parsed once. None in
+        positions (a standby that isn't streaming) gives None. """
+    if isinstance(master, basestring):
+        master = [master] * len(positions)
+    elif len(master) != len(positions):
+        raise ValueError("Need a master position for each position")
+    parsed = {}
+    def _parse(lsn):
+        if lsn not in parsed:
+            parsed[lsn] = parse(lsn)
+        return parsed[lsn]
+    result = []
+    for m, p in zip(master, positions):
+        if p is None:
+            result.append(None)
+        else:
+            result.append(_parse(m) - _parse(p))
+    return result
+
+def functions(server_version):
+    """ Names of the position functions for a server, keyed on current,
+        receive and replay, and of the replay pause check, keyed on paused.
+        server_version is an integer like 90105, as found on a psycopg2
+        connection. """
+    if server_version >= WAL_RENAME:
+        return {
+            'current': 'pg_current_wal_lsn',
+            'receive': 'pg_last_wal_receive_lsn',
+            'replay': 'pg_last_wal_replay_lsn',
+            'paused': 'pg_is_wal_replay_paused',
+        }
+    return {
+        'current': 'pg_current_xlog_location',
+        'receive': 'pg_last_xlog_receive_location',
+        'replay': 'pg_last_xlog_replay_location',
+        'paused': 'pg_is_xlog_replay_paused',
+    }
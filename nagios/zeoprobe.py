@@ -0,0 +1,120 @@
+# A minimal ZEO client that times how long a storage server takes to answer.
+#
+# It connects to the storage server, registers with a storage and times a
+# lastTransaction call, which catches a server that is still running but
+# stuck packing or blocked on disk. This is used by check_zeo and by the deep
+# monitor of the zeo resource agent, so it lives next to the checks and is
+# also installed next to the agent.
+
+import socket
+import struct
+import time
+import cPickle
+from cStringIO import StringIO
+
+class ZEOProbeFailed(Exception):
+    pass
+
+def parse_zeo_address(address):
+    """ Turn host:port into an inet address, anything else is taken to be
+        the path to a unix socket. """
+    if not address.startswith('/') and ':' in address:
+        host, port = address.rsplit(':', 1)
+        return socket.AF_INET, (host, int(port))
+    return socket.AF_UNIX, address
+
+class ZEOGlobal(object):
+    """ Stands in for classes referenced by the server's pickles. We don't
+        have (or want) the ZODB classes around. """
+    def __init__(self, module, name):
+        self.module = module
+        self.name = name
+        self.args = ()
+
+    def __call__(self, *args):
+        ob = ZEOGlobal(self.module, self.name)
+        ob.args = args
+        return ob
+
+    def __str__(self):
+        return "%s.%s%r" % (self.module, self.name, self.args)
+
+class ZEOProbe(object):
+    """ A minimal ZEO client. It speaks just enough of the zrpc protocol
+        (length prefixed pickles) to register with a storage and call
+        lastTransaction, without pulling in ZODB and a client cache. """
+
+    def __init__(self, address, storage='1', timeout=10):
+        self.family, self.address = parse_zeo_address(address)
+        self.storage = storage
+        self.timeout = timeout
+        self.msgid = 0
+        self.sock = None
+
+    def _remaining(self):
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise ZEOProbeFailed("timed out after %ss" % self.timeout)
+        return remaining
+
+    def _recvall(self, size):
+        chunks = []
+        while size > 0:
+            self.sock.settimeout(self._remaining())
+            data = self.sock.recv(min(size, 65536))
+            if not data:
+                raise ZEOProbeFailed("connection closed by server")
+            chunks.append(data)
+            size -= len(data)
+        return ''.join(chunks)
+
+    def _send(self, msg):
+        self.sock.settimeout(self._remaining())
+        self.sock.sendall(struct.pack(">I", len(msg)) + msg)
+
+    def _recv(self):
+        size, = struct.unpack(">I", self._recvall(4))
+        return self._recvall(size)
+
+    def call(self, method, *args):
+        self.msgid += 1
+        self._send(cPickle.dumps((self.msgid, 0, method, args), 1))
+        while True:
+            unpickler = cPickle.Unpickler(StringIO(self._recv()))
+            unpickler.find_global = ZEOGlobal
+            msgid, flags, name, result = unpickler.load()
+            # The server may send us invalidations and other async
+            # messages, we are only interested in our reply.
+            if name == '.reply' and msgid == self.msgid:
+                break
+        # Errors come back as an (exception class, instance) pair
+        if isinstance(result, tuple) and len(result) == 2 and \
+                isinstance(result[0], ZEOGlobal):
+            raise ZEOProbeFailed("%s raised %s" % (method, result[1]))
+        return result
+
+    def probe(self):
+        """ Returns a tuple with the time taken to connect and register,
+            and the time taken for a lastTransaction round-trip. Raises
+            ZEOProbeFailed if the server is not answering properly. """
+        self.deadline = time.time() + self.timeout
+        start = time.time()
+        self.sock = socket.socket(self.family, socket.SOCK_STREAM)
+        try:
+            try:
+                self.sock.settimeout(self._remaining())
+                self.sock.connect(self.address)
+                # The server announces its protocol, answer with the same
+                self._send(self._recv())
+                self.call('register', self.storage, True)
+                connected = time.time()
+                self.call('lastTransaction')
+                done = time.time()
+            except socket.timeout:
+                raise ZEOProbeFailed("timed out after %ss" % self.timeout)
+            except (socket.error, struct.error, cPickle.UnpicklingError,
+                    EOFError, ValueError, TypeError), e:
+                raise ZEOProbeFailed(str(e))
+        finally:
+            self.sock.close()
+        return connected - start, done - connected
@@ -0,0 +1,74 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import check_cache
+
+class CgroupTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.root = os.path.join(self.directory, 'cgroup')
+        self.cgroup = os.path.join(self.root, 'system.slice', 'app.service')
+        os.makedirs(self.cgroup)
+        open(os.path.join(self.root, 'cgroup.controllers'), 'w').close()
+        self.write('memory.stat', file=600, anon=400, active_file=300,
+            inactive_file=300)
+        self.original = check_cache.CGROUP_ROOT
+        check_cache.CGROUP_ROOT = self.root
+        self.args = check_cache.parse_args(['-g', 'app.service',
+            '--state-dir', self.directory])
+
+    def tearDown(self):
+        check_cache.CGROUP_ROOT = self.original
+        shutil.rmtree(self.directory)
+
+    def write(self, name, **values):
+        fp = open(os.path.join(self.cgroup, name), 'w')
+        for k, v in sorted(values.items()):
+            fp.write('%s %d\n' % (k, v))
+        fp.close()
+
+    def check(self):
+        return check_cache.check_cgroup(self.args.cgroup[0], self.args)
+
+    def test_cached(self):
+        self.write('memory.events', low=0, high=0, max=0, oom=0, oom_kill=0)
+        status, message, perfdata = self.check()
+        self.assertEqual(status, check_cache.GOOD)
+        self.assertEqual(message, 'app.service cached: 60%')
+
+    def test_no_page_cache(self):
+        self.write('memory.stat', file=0, anon=400, active_file=0,
+            inactive_file=0)
+        self.write('memory.events', low=0, high=0, max=0, oom=0, oom_kill=0)
+        status, message, perfdata = self.check()
+        self.assertEqual(status, check_cache.CRITICAL)
+        self.assertEqual(message, 'app.service cached: 0%')
+
+    def test_oom_kill_counted_once(self):
+        self.write('memory.events', high=0, max=0, oom=0, oom_kill=0)
+        self.check()
+        # One OOM kill shows up as both an oom and an oom_kill event
+        self.write('memory.events', high=0, max=1, oom=1, oom_kill=1)
+        status, message, perfdata = self.check()
+        self.assertEqual(status, check_cache.CRITICAL)
+        self.assertTrue(message.endswith(', 1 OOM since last check'),
+            message)
+
+    def test_oom_without_oom_kill(self):
+        # Kernels before 4.13 don't have oom_kill
+        self.write('memory.events', high=0, max=0, oom=0)
+        self.check()
+        self.write('memory.events', high=0, max=2, oom=2)
+        status, message, perfdata = self.check()
+        self.assertEqual(status, check_cache.CRITICAL)
+        self.assertTrue(message.endswith(', 2 OOM since last check'),
+            message)
+
+if __name__ == '__main__':
+    unittest.main()
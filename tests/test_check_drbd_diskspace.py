@@ -0,0 +1,35 @@
+import os
+import sys
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import check_drbd_diskspace
+
+class DiskspaceTests(unittest.TestCase):
+    def history(self, samples):
+        history = check_drbd_diskspace.SpaceHistory('/nonexistent', '/srv',
+            10)
+        for sample in samples:
+            history.add(sample)
+        return history
+
+    def test_time_to_full(self):
+        self.assertEqual(self.history([]).time_to_full(), None)
+        # 100 bytes a second with 3600 left, inodes not running out
+        self.assertEqual(self.history([(0, 7200, 50), (36, 3600, 50)])
+            .time_to_full(), 36.0)
+        # Inodes run out first
+        self.assertEqual(self.history([(0, 7200, 20), (10, 7200, 10)])
+            .time_to_full(), 10.0)
+        # Freeing space is never full
+        self.assertEqual(self.history([(0, 100, 10), (10, 200, 10)])
+            .time_to_full(), None)
+
+    def test_median(self):
+        self.assertEqual(check_drbd_diskspace.median([3, 1, 2]), 2)
+        self.assertEqual(check_drbd_diskspace.median([4, 1, 2, 3]), 2.5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+import os
+import sys
+import time
+import fcntl
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import check_haproxy
+
+STATS = """\
+# pxname,svname,qcur,qmax,scur,smax,slim,stot,status,rate,qtime,ctime,rtime,
+app,FRONTEND,,,3,10,2000,100,OPEN,5,,,,
+app,web1,0,0,1,5,100,50,UP,2,0,1,20,
+app,web2,0,0,2,5,100,50,UP,3,0,1,30,
+app,BACKEND,0,0,3,10,200,100,UP,5,0,1,25,
+"""
+
+class HangUp(threading.Thread):
+    """ An http server that closes every connection without answering. """
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.url = 'http://127.0.0.1:%d/stats' % self.sock.getsockname()[1]
+
+    def run(self):
+        while True:
+            conn = self.sock.accept()[0]
+            conn.recv(4096)
+            conn.close()
+
+def collect(argv):
+    """ The report on STATS with the arguments in argv. """
+    args = check_haproxy.parse_args(['-s', 'unused'] + argv)
+    target = check_haproxy.Target(socket='unused')
+    target.fetch = lambda args: STATS.splitlines()
+    target.collect(args)
+    return check_haproxy.report(target.data)
+
+class CheckHaproxyTests(unittest.TestCase):
+    def test_stats(self):
+        args = check_haproxy.parse_args(['-s', 'unused'])
+        target = check_haproxy.Target(socket='unused')
+        target.fetch = lambda args: STATS.splitlines()
+        target.collect(args)
+        self.assertEqual(target.error, None)
+        status, text, perfdata = check_haproxy.report(target.data)
+        self.assertEqual(status, check_haproxy.GOOD)
+        self.assertEqual(text, 'app: OK 2/2')
+
+    def test_bad_status_line(self):
+        server = HangUp()
+        server.start()
+        status, output = check_haproxy.check(check_haproxy.parse_args(['-u',
+            server.url, '-t', '2']))
+        self.assertEqual(status, check_haproxy.UNKNOWN, output)
+        self.assertTrue(output.startswith('HAPROXY UNKNOWN - 127.0.0.1:'))
+
+    def test_unexpected_error(self):
+        """ An error nobody thought of fails that target, not the check. """
+        def get_socket_csv(path, timeout):
+            if path == 'broken':
+                raise RuntimeError("unexpected")
+            return STATS.splitlines()
+        original = check_haproxy.get_socket_csv
+        check_haproxy.get_socket_csv = get_socket_csv
+        try:
+            status, output = check_haproxy.check(check_haproxy.parse_args(
+                ['-s', 'broken']))
+            self.assertEqual(status, check_haproxy.UNKNOWN)
+            self.assertEqual(output, 'HAPROXY UNKNOWN - broken: '
+                'RuntimeError: unexpected')
+
+            status, output = check_haproxy.check(check_haproxy.parse_args(
+                ['-s', 'broken', '-s', 'good', '-n', '1']))
+            self.assertEqual(status, check_haproxy.WARNING)
+            self.assertTrue(output.startswith('app: OK 1/2, '
+                'broken: RuntimeError: unexpected'), output)
+        finally:
+            check_haproxy.get_socket_csv = original
+
+    def test_thresholds(self):
+        status, text, perfdata = collect(['-T', 'app:rtime=25,28',
+            '-T', 'ap*:rtime=1,2', '-T', '*:qcur=1,2'])
+        self.assertEqual(status, check_haproxy.CRITICAL)
+        # The first pattern for a metric wins, and the levels apply to the
+        # servers as well as to the backend
+        self.assertEqual(text, 'app: CRITICAL 2/2 (web2 rtime 30ms, '
+            'BACKEND rtime 25ms)')
+
+        status, text, perfdata = collect(['-T', 'other:rtime=1,2'])
+        self.assertEqual(status, check_haproxy.GOOD)
+
+    def test_perfdata(self):
+        status, text, perfdata = collect(['-T', '*:sessions=80,95'])
+        self.assertTrue("'app.BACKEND.sessions'=1.5%;80.0;95.0;0" in perfdata)
+        self.assertTrue("'app.BACKEND.rtime'=25ms;;;0" in perfdata)
+        self.assertTrue("'app.FRONTEND.rate'=5;;;0" in perfdata)
+        # Only the proxies, unless asked for the servers too
+        self.assertFalse([p for p in perfdata if '.web1.' in p])
+        status, text, perfdata = collect(['--server-perfdata'])
+        self.assertTrue("'app.web1.rtime'=20ms;;;0" in perfdata)
+
+    def test_bad_threshold(self):
+        stderr, sys.stderr = sys.stderr, StringIO() # Keep the usage quiet
+        try:
+            for spec in ('app:rtime', 'app:rtime=1', 'app:bogus=1,2'):
+                self.assertRaises(SystemExit, check_haproxy.parse_args,
+                    ['-s', 'unused', '-T', spec])
+        finally:
+            sys.stderr = stderr
+
+class Fetch(object):
+    """ Stands in for fetching the stats, counting the fetches. """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.fetches = 0
+
+    def __call__(self):
+        self.fetches += 1
+        return self.stats
+
+class StatsCacheTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache = check_haproxy.StatsCache(self.directory,
+            '/var/run/haproxy.sock', 60)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def age(self, seconds):
+        t = time.time() - seconds
+        os.utime(self.cache.path, (t, t))
+
+    def test_fresh(self):
+        fetch = Fetch('stats')
+        self.assertEqual(self.cache.get(fetch), 'stats')
+        self.assertEqual(self.cache.get(Fetch('other')), 'stats')
+        self.assertEqual(fetch.fetches, 1)
+
+    def test_stale(self):
+        self.cache.get(Fetch('old'))
+        self.age(120)
+        fetch = Fetch('new')
+        self.assertEqual(self.cache.get(fetch), 'new')
+        self.assertEqual(fetch.fetches, 1)
+        self.assertEqual(self.cache.get(Fetch('other')), 'new')
+
+    def test_stale_locked(self):
+        """ A check that finds the cache stale while another is fetching
+            waits for it, and uses what it fetched. """
+        self.cache.get(Fetch('old'))
+        self.age(120)
+        lock = open(self.cache.path + '.lock', 'a')
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        fetch = Fetch('mine')
+        result = []
+        waiter = threading.Thread(target=lambda:
+            result.append(self.cache.get(fetch)))
+        waiter.start()
+        time.sleep(0.2)
+        self.assertEqual(result, []) # Still waiting for the lock
+        self.cache.save('theirs')
+        lock.close()
+        waiter.join()
+        self.assertEqual(result, ['theirs'])
+        self.assertEqual(fetch.fetches, 0)
+
+    def test_not_writable(self):
+        cache = check_haproxy.StatsCache(os.path.join(self.directory,
+            'missing'), 'haproxy', 60)
+        fetch = Fetch('stats')
+        self.assertEqual(cache.get(fetch), 'stats')
+        self.assertEqual(cache.get(fetch), 'stats')
+        self.assertEqual(fetch.fetches, 2)
+
+    def test_check(self):
+        """ --cache-ttl shares one fetch between checks. """
+        fetches = []
+        def get_socket_csv(path, timeout):
+            fetches.append(path)
+            return STATS.splitlines()
+        original = check_haproxy.get_socket_csv
+        check_haproxy.get_socket_csv = get_socket_csv
+        try:
+            for i in range(2):
+                status, output = check_haproxy.check(check_haproxy.parse_args(
+                    ['-s', 'haproxy.sock', '--cache-ttl', '60',
+                    '--cache-dir', self.directory]))
+                self.assertEqual(status, check_haproxy.GOOD, output)
+        finally:
+            check_haproxy.get_socket_csv = original
+        self.assertEqual(fetches, ['haproxy.sock'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,91 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import check_pg_master
+
+class Cursor(object):
+    def __init__(self, row):
+        self.row = row
+
+    def execute(self, sql):
+        pass
+
+    def fetchone(self):
+        return self.row
+
+class Connection(object):
+    """ A master with 10 of 100 connections in use, nothing waiting, and
+        the checkpoint and buffer counters in counters. """
+
+    def __init__(self, counters):
+        self.counters = counters
+
+    def cursor(self):
+        timed, requested, hit, read = self.counters
+        return Cursor((False, 10, 100, 1.0, 0, timed, requested, hit, read))
+
+class Connections(object):
+    """ Stands in for check_runner's pool. """
+
+    def __init__(self):
+        self.counters = None
+
+    def get(self, dsn, connect):
+        return Connection(self.counters)
+
+    def discard(self, db):
+        pass
+
+class ExtendedTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.args = check_pg_master.parse_args(['-u', 'nagios', '-P', 'x',
+            '-e', '--state-dir', self.directory])
+        self.connections = check_pg_master.connections = Connections()
+
+    def tearDown(self):
+        check_pg_master.connections = None
+        shutil.rmtree(self.directory)
+
+    def check(self, timed, requested, hit, read):
+        self.connections.counters = (timed, requested, hit, read)
+        return check_pg_master.check(self.args)
+
+    def test_never_hits(self):
+        status, output = self.check(10, 0, 0, 5000)
+        self.assertEqual(status, check_pg_master.CRITICAL, output)
+        self.assertTrue('cache hit ratio 0.0%' in output, output)
+
+    def test_idle(self):
+        status, output = self.check(0, 0, 0, 0)
+        self.assertEqual(status, check_pg_master.GOOD, output)
+        self.assertTrue('cache hit ratio 100.0%' in output, output)
+
+    def test_since_last_run(self):
+        # Totals since the reset look fine
+        status, output = self.check(1000, 10, 990000, 10000)
+        self.assertEqual(status, check_pg_master.GOOD, output)
+        self.assertTrue('1% of checkpoints requested' in output, output)
+        self.assertTrue('cache hit ratio 99.0%' in output, output)
+
+        # But since the last run, only requested checkpoints and misses
+        status, output = self.check(1000, 15, 990100, 10900)
+        self.assertEqual(status, check_pg_master.CRITICAL, output)
+        self.assertTrue('100% of checkpoints requested' in output, output)
+        self.assertTrue('cache hit ratio 10.0%' in output, output)
+
+    def test_reset(self):
+        """ After a statistics reset the totals are used again. """
+        self.check(1000, 10, 990000, 10000)
+        status, output = self.check(10, 0, 9900, 100)
+        self.assertEqual(status, check_pg_master.GOOD, output)
+        self.assertTrue('cache hit ratio 99.0%' in output, output)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import pglsn
+import check_pg_slave
+
+def trend(samples):
+    """ What check_lag makes of a history of (time, master, replay). """
+    history = check_pg_slave.LagHistory('/nonexistent', 'standby', 10)
+    for t, master, replay in samples:
+        history.add((t, master, replay, replay))
+    wal_rate, replay_rate = history.rates()
+    lag = samples[-1][1] - samples[-1][2]
+    if check_pg_slave.catch_up_time(lag, wal_rate, replay_rate) is not None:
+        return 'catching up'
+    if check_pg_slave.falling_behind(wal_rate, replay_rate,
+            history.lag_growth()):
+        return 'falling behind'
+    return 'steady'
+
+class LagTrendTests(unittest.TestCase):
+    def test_steady(self):
+        # Replay keeps up, 4KB behind all the time
+        self.assertEqual(trend([(t, 10 ** 6 * t + 4096, 10 ** 6 * t)
+            for t in range(6)]), 'steady')
+
+    def test_idle(self):
+        self.assertEqual(trend([(t, 8192, 4096) for t in range(6)]),
+            'steady')
+
+    def test_falling_behind(self):
+        self.assertEqual(trend([(t, 10 ** 6 * t, 5 * 10 ** 5 * t)
+            for t in range(6)]), 'falling behind')
+
+    def test_noise(self):
+        # Replay a hair slower than the master is not falling behind
+        self.assertEqual(trend([(t, 1000000 * t + 4096, 999000 * t)
+            for t in range(6)]), 'steady')
+
+    def test_catching_up(self):
+        self.assertEqual(trend([(t, 10 ** 6 * t + 10 ** 7,
+            2 * 10 ** 6 * t) for t in range(6)]), 'catching up')
+        self.assertEqual(check_pg_slave.catch_up_time(10 ** 7, 10 ** 6,
+            2 * 10 ** 6), 10.0)
+
+class HistoryTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_save_load(self):
+        history = check_pg_slave.LagHistory(self.directory, 'host=a', 2)
+        for i in range(3):
+            history.add((i, i, i, i))
+        history.save()
+        history = check_pg_slave.LagHistory(self.directory, 'host=a', 2)
+        history.load()
+        self.assertEqual(history.samples, [(1, 1, 1, 1), (2, 2, 2, 2)])
+
+class Cursor(object):
+    def __init__(self, row):
+        self.row = row
+
+    def execute(self, sql):
+        self.sql = sql
+
+    def fetchone(self):
+        return self.row(self.sql)
+
+class Connection(object):
+    """ A node that answers the queries of check_lag from positions. """
+    server_version = 100000
+
+    def __init__(self, name, positions):
+        self.name = name
+        self.positions = positions
+
+    def cursor(self):
+        return Cursor(self.row)
+
+    def row(self, sql):
+        master, replay = [pglsn.format_lsn(int(p)) for p in self.positions]
+        if self.name == 'master':
+            if 'pg_current_wal_lsn' in sql:
+                return (master,)
+            return (False, 'master', None, None, None)
+        return (True, self.name, replay, replay, 1.0)
+
+class Connections(object):
+    """ Stands in for check_runner's pool, handing out fake nodes. """
+
+    def __init__(self, positions):
+        self.positions = positions
+
+    def get(self, dsn, connect):
+        return Connection(dsn.split()[0].split('=')[1], self.positions)
+
+    def discard(self, db):
+        pass
+
+class CheckLagTests(unittest.TestCase):
+    """ check_lag over a history where the master writes 100KB/s. """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.args = check_pg_slave.parse_args(['-d', 'host=master',
+            '-d', 'host=standby', '--history-dir', self.directory])
+
+    def tearDown(self):
+        check_pg_slave.connections = None
+        shutil.rmtree(self.directory)
+
+    def check(self, replay_rate):
+        """ Check a standby 4KB behind that replays at replay_rate, 40
+            seconds into the history. """
+        now = time.time()
+        history = check_pg_slave.LagHistory(self.directory, 'standby', 10)
+        base = 10 ** 9
+        for t in range(0, 40, 10):
+            replay = base - 4096 + replay_rate * t
+            history.add((now - 40 + t, base + 100000 * t, replay, replay))
+        history.save()
+        check_pg_slave.connections = Connections((base + 100000 * 40,
+            base - 4096 + replay_rate * 40))
+        return check_pg_slave.check(self.args)
+
+    def test_keeping_up(self):
+        status, output = self.check(100000)
+        self.assertEqual(status, check_pg_slave.GOOD, output)
+        self.assertTrue(' steady' in output, output)
+
+    def test_falling_behind(self):
+        # 2MB behind, under the byte levels, but getting further behind
+        status, output = self.check(50000)
+        self.assertEqual(status, check_pg_slave.WARNING, output)
+        self.assertTrue('standby WARNING receive 2004096B replay 2004096B '
+            '1s falling behind' in output, output)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,222 @@
+import os
+import sys
+import shutil
+import time
+import tempfile
+import threading
+import unittest
+from StringIO import StringIO
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import checklib
+import check_runner
+
+class FakeCheck(object):
+    """ Stands in for a check module, counting how often it runs. """
+
+    def __init__(self):
+        self.runs = 0
+
+    def check(self, args):
+        self.runs += 1
+        return checklib.WARNING, "FAKE WARNING - run %d\nmore output" % \
+            self.runs
+
+class RunnerTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket = os.path.join(self.directory, 'runner.sock')
+        self.module = FakeCheck()
+        service = check_runner.Service('fake', self.module, None, 60,
+            command=('check_fake', ('-w', '1', '-c', 'a b')))
+        self.server = check_runner.QueryServer(self.socket,
+            check_runner.QueryHandler)
+        self.server.runner = check_runner.Runner([service], 1)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.runner.stop()
+        shutil.rmtree(self.directory)
+
+    def ask(self, check, argv):
+        return checklib.from_runner(check, argv, self.socket, 5)
+
+    def test_from_runner(self):
+        result = self.ask('check_fake', ['-w', '1', '-c', 'a b'])
+        self.assertEqual(result, (checklib.WARNING,
+            "FAKE WARNING - run 1\nmore output"))
+        # A second ask within the interval gets the same result
+        self.assertEqual(self.ask('check_fake', ['-w', '1', '-c', 'a b']),
+            result)
+        self.assertEqual(self.module.runs, 1)
+
+    def test_not_configured(self):
+        """ Other arguments, or another check, are left to the check. """
+        self.assertEqual(self.ask('check_fake', ['-w', '1']), None)
+        self.assertEqual(self.ask('check_other', ['-w', '1', '-c', 'a b']),
+            None)
+        self.assertEqual(self.ask('check_fake', []), None)
+        self.assertEqual(self.module.runs, 0)
+
+    def test_no_runner(self):
+        self.assertEqual(checklib.from_runner('check_fake', [],
+            os.path.join(self.directory, 'missing.sock')), None)
+
+# The warning and critical levels of each check, and whether a value is
+# worse when it is higher or lower
+LEVELS = {
+    'check_pg_slave': [('warning', 'critical', 'high'),
+        ('warning_seconds', 'critical_seconds', 'high'),
+        ('eta_warning', 'eta_critical', 'high'),
+        ('conflict_warning', 'conflict_critical', 'high')],
+    'check_pg_master': [('connections_warning', 'connections_critical', 'high'),
+        ('xact_warning', 'xact_critical', 'high'),
+        ('waiting_warning', 'waiting_critical', 'high'),
+        ('checkpoint_warning', 'checkpoint_critical', 'high'),
+        ('hit_warning', 'hit_critical', 'low')],
+    'check_drbd_status': [],
+    'check_drbd_diskspace': [('warning', 'critical', 'low'),
+        ('inode_warning', 'inode_critical', 'low'),
+        ('full_warning', 'full_critical', 'low'),
+        ('latency_warning', 'latency_critical', 'high')],
+    'check_haproxy': [('warning', 'critical', 'low')],
+    'check_zeo': [('warning', 'critical', 'high')],
+}
+
+class ConfigTests(unittest.TestCase):
+    def test_example(self):
+        """ The example configuration loads, and every service is found by
+            the command line nrpe would run. """
+        options, services = check_runner.load_config(os.path.join(HERE, '..',
+            'nagios', 'examples', 'check_runner.conf'))
+        self.assertEqual(options['socket'], checklib.RUNNER_SOCKET)
+        runner = check_runner.Runner(services, 0)
+        service = runner.commands[('check_pg_slave', ('-d',
+            'host=10.0.0.11 user=nagios', '-d', 'host=10.0.0.12 user=nagios'))]
+        self.assertEqual(service.name, 'replication')
+        self.assertEqual(runner.commands[('check_drbd_status', ())].name,
+            'drbd')
+
+    def test_example_levels(self):
+        """ Critical comes after warning in every example service. """
+        options, services = check_runner.load_config(os.path.join(HERE, '..',
+            'nagios', 'examples', 'check_runner.conf'))
+        for service in services:
+            check, argv = service.command
+            args = service.module.parse_args(list(argv))
+            levels = [(getattr(args, warning), getattr(args, critical), worse)
+                for warning, critical, worse in LEVELS[check]]
+            for queue in ('pe', 'ua', 'ap'):
+                if hasattr(args, queue + '_levels'):
+                    levels.append(getattr(args, queue + '_levels') + ('high',))
+            for threshold in getattr(args, 'threshold', []):
+                levels.append((threshold.warning, threshold.critical, 'high'))
+            for warning, critical, worse in levels:
+                if worse == 'high':
+                    self.assertTrue(warning < critical, service.name)
+                else:
+                    self.assertTrue(warning > critical, service.name)
+
+class Args(object):
+    def __init__(self, **kw):
+        self.__dict__.update(kw)
+
+class SubmitTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_chunks(self):
+        lines = ['a' * 5 + '\n', 'b' * 3 + '\n', 'c' * 9 + '\n', 'd\n']
+        result = list(check_runner.chunks(lines, 10))
+        self.assertEqual(result, [lines[0] + lines[1], lines[2], lines[3]])
+        self.assertEqual(list(check_runner.chunks(['x' * 12 + '\n'], 10)),
+            ['x' * 12 + '\n'])
+
+    def test_format_result(self):
+        line = check_runner.format_result('host', 'svc', 1000, 2,
+            'CRITICAL - bad\nC:\\ ' + '\\' * check_runner.PIPE_BUF)
+        self.assertTrue(line.startswith('[1000] PROCESS_SERVICE_CHECK_RESULT;'
+            'host;svc;2;CRITICAL - bad\\nC:\\\\ \\\\'), line)
+        self.assertTrue(len(line) <= check_runner.PIPE_BUF)
+        self.assertEqual(line.count('\n'), 1)
+        # Cut between escapes, not inside one
+        self.assertFalse(line[:-1].replace('\\\\', '').endswith('\\'))
+
+    def test_fifo(self):
+        """ Many commands, more than the fifo holds, arrive whole while
+            nagios is slow to read them. """
+        path = os.path.join(self.directory, 'nagios.cmd')
+        os.mkfifo(path)
+        received = []
+        def read():
+            fp = open(path, 'rb')
+            try:
+                time.sleep(0.3) # Let the fifo fill up
+                received.append(fp.read())
+            finally:
+                fp.close()
+        reader = threading.Thread(target=read)
+        reader.start()
+        time.sleep(0.1) # Opening without a reader fails
+        lines = [check_runner.format_result('host', 'svc%d' % i, 1000, 0,
+            'OK - ' + 'x' * (i % 300)) for i in range(2000)]
+        check_runner.submit(lines, Args(spool_dir=None, command_file=path,
+            timeout=30))
+        reader.join()
+        self.assertEqual(received, [''.join(lines)])
+
+    def stalled(self):
+        """ A fifo nagios opened, but doesn't read. """
+        path = os.path.join(self.directory, 'nagios.cmd')
+        os.mkfifo(path)
+        fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.addCleanup(os.close, fd)
+        return path
+
+    def test_fifo_stalled(self):
+        path = self.stalled()
+        lines = [check_runner.format_result('host', 'svc%d' % i, 1000, 0,
+            'OK - ' + 'x' * 300) for i in range(1000)]
+        started = time.time()
+        self.assertRaises(OSError, check_runner.submit, lines,
+            Args(spool_dir=None, command_file=path, timeout=0.5))
+        self.assertTrue(time.time() - started < 2)
+
+    def test_passive_stalled(self):
+        """ Results nagios didn't take are not remembered as sent. """
+        path = self.stalled()
+        # Fill the fifo up, so that not even one result fits
+        fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
+        try:
+            while True:
+                os.write(fd, 'x' * 4096)
+        except OSError:
+            pass
+        os.close(fd)
+        config = os.path.join(self.directory, 'check_runner.conf')
+        fp = open(config, 'w')
+        fp.write('[drbd]\ncheck = check_drbd_status\n')
+        fp.close()
+        stderr, sys.stderr = sys.stderr, StringIO()
+        try:
+            status = check_runner.passive(Args(config=config,
+                spool_dir=None, command_file=path, host='host', resend=900,
+                timeout=0.3, state_dir=self.directory))
+        finally:
+            sys.stderr = stderr
+        self.assertEqual(status, 1)
+        sent = check_runner.Sent(self.directory)
+        sent.load()
+        self.assertEqual(sent.sent, {})
+
+if __name__ == '__main__':
+    unittest.main()
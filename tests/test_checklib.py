@@ -0,0 +1,79 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import checklib
+
+class ChecklibTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_evaluate(self):
+        self.assertEqual(checklib.evaluate(1, 10, 20), checklib.GOOD)
+        self.assertEqual(checklib.evaluate(10, 10, 20), checklib.WARNING)
+        self.assertEqual(checklib.evaluate(25, 10, 20), checklib.CRITICAL)
+
+    def test_deltas(self):
+        previous = (100, {'a': 10, 'b': 50})
+        self.assertEqual(checklib.deltas(previous, (110, {'a': 15, 'b': 50})),
+            (10, {'a': 5, 'b': 0}))
+        self.assertEqual(checklib.deltas(None, previous), None)
+        # Clock went backwards, a counter went down or is new
+        self.assertEqual(checklib.deltas(previous, (90, {'a': 15})), None)
+        self.assertEqual(checklib.deltas(previous, (110, {'a': 5})), None)
+        self.assertEqual(checklib.deltas(previous, (110, {'c': 5})), None)
+        # Only the counters asked for
+        self.assertEqual(checklib.deltas(previous, (110, {'a': 15, 'b': 1,
+            'c': 5}), ('a',)), (10, {'a': 5}))
+
+    def test_rates(self):
+        self.assertEqual(checklib.rates((100, {'a': 10}), (104, {'a': 12})),
+            {'a': 0.5})
+        self.assertEqual(checklib.rates((100, {'a': 10}), (104, {'a': 3})),
+            None)
+
+    def test_state(self):
+        state = checklib.State(self.directory, 'test')
+        self.assertEqual(state.swap((1, {'a': 1})), None)
+        self.assertEqual(state.swap((2, {'a': 5})), (1, {'a': 1}))
+        self.assertEqual(checklib.State(self.directory, 'test').swap(None),
+            (2, {'a': 5}))
+        # Nothing is left lying around
+        self.assertEqual(os.listdir(self.directory), ['test.pickle'])
+
+    def test_state_not_writable(self):
+        state = checklib.State(os.path.join(self.directory, 'missing'), 'test')
+        self.assertEqual(state.swap((1, {})), None)
+        self.assertEqual(state.swap((2, {})), None)
+
+    def test_state_corrupt(self):
+        fp = open(os.path.join(self.directory, 'test.pickle'), 'w')
+        fp.write('garbage')
+        fp.close()
+        state = checklib.State(self.directory, 'test')
+        self.assertEqual(state.swap((1, {})), None)
+        self.assertEqual(state.swap((2, {})), (1, {}))
+
+    def test_history(self):
+        history = checklib.History(self.directory, '/', 2, 'diskspace')
+        self.assertEqual(os.path.basename(history.path),
+            'diskspace-root.pickle')
+        history.load()
+        self.assertEqual(history.samples, [])
+        for i in range(3):
+            history.add((i, i))
+        history.save()
+        history = checklib.History(self.directory, '/', 2, 'diskspace')
+        history.load()
+        self.assertEqual(history.samples, [(1, 1), (2, 2)])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import checklib
+import drbd_events
+import check_drbd_status
+
+# r0 briefly loses its connection at 10:05 and resyncs, r1 loses its
+# connection at 10:20 and doesn't get it back.
+FIXTURE = os.path.join(HERE, 'fixtures', 'drbd_events2.txt')
+
+def events(until=None):
+    """ The lines of the fixture, up to the first one containing until. """
+    lines = []
+    for line in open(FIXTURE):
+        lines.append(line)
+        if until is not None and until in line:
+            break
+    return lines
+
+class WatcherTests(unittest.TestCase):
+    def test_initial_state(self):
+        watcher = drbd_events.Watcher(30, 100)
+        self.assertTrue(watcher.feed(events('exists -')))
+        devices = watcher.devices()
+        self.assertEqual(sorted(devices), ['0', '1'])
+        self.assertEqual(devices['0']['cs'], 'Connected')
+        self.assertEqual(devices['0']['ro'], 'Primary/Secondary')
+        self.assertEqual(devices['0']['ds'], 'UpToDate/UpToDate')
+        self.assertEqual(devices['0']['counters']['ns'], 1048576)
+        self.assertEqual(devices['0']['counters']['dr'], 1049600)
+        self.assertEqual(devices['1']['ro'], 'Secondary/Primary')
+
+    def test_replay(self):
+        watcher = drbd_events.Watcher(30, 100)
+        watcher.feed(events())
+        devices = watcher.devices()
+
+        r0 = devices['0']
+        self.assertEqual(r0['cs'], 'SyncSource')
+        self.assertEqual(r0['ds'], 'UpToDate/Inconsistent')
+        self.assertEqual(r0['synced'], 40.0)
+        self.assertEqual(r0['counters']['oos'], 273066)
+        self.assertEqual(r0['flaps'], 1) # Back within 4s
+
+        r1 = devices['1']
+        self.assertEqual(r1['cs'], 'Connecting')
+        self.assertEqual(r1['ds'], 'UpToDate/DUnknown')
+        self.assertEqual(r1['flaps'], 0) # Not back yet
+
+        self.assertTrue(('r0', 'connection', 'Connected', 'NetworkFailure')
+            in [h[1:] for h in watcher.history])
+
+    def test_flap_window(self):
+        watcher = drbd_events.Watcher(2, 100)
+        watcher.feed(events())
+        self.assertEqual(watcher.devices()['0']['flaps'], 0)
+
+    def test_history_size(self):
+        watcher = drbd_events.Watcher(30, 5)
+        watcher.feed(events())
+        self.assertEqual(len(watcher.history), 5)
+        self.assertEqual(watcher.history[-1][1:],
+            ('r1', 'connection', 'Unconnected', 'Connecting'))
+
+class CheckDrbdStatusTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.state = os.path.join(self.directory, 'drbd_events.pickle')
+        self.args = check_drbd_status.parse_args(['--events-state',
+            self.state, '--state-dir', self.directory])
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def replay(self, until=None):
+        watcher = drbd_events.Watcher(30, 100)
+        watcher.feed(events(until))
+        watcher.save(self.state, 10, replay=True)
+        return check_drbd_status.check(self.args)
+
+    def test_replay(self):
+        status, output = self.replay('exists -')
+        self.assertEqual(status, check_drbd_status.GOOD, output)
+        self.assertTrue(output.startswith('DRBD OK - 0: OK, 1: OK |'))
+
+        # Pretend the check ran 30s before the resync got to 40%
+        status, output = self.replay('done:10.00')
+        path = os.path.join(self.directory, 'check_drbd_status.pickle')
+        samples = checklib._load(path)
+        for minor, (t, counters) in samples.items():
+            samples[minor] = (t - 30, counters)
+        checklib._save(path, samples)
+
+        status, output = self.replay()
+        self.assertEqual(status, check_drbd_status.CRITICAL, output)
+        messages = output.split(' | ')[0]
+        self.assertTrue(messages.startswith('DRBD CRITICAL - 0: SyncSource '
+            '40.0% done, 0:01:00 left at 45'), messages)
+        self.assertTrue(messages.endswith('(WARNING), 1: Connecting '
+            '(CRITICAL)'), messages)
+        self.assertTrue("'drbd0 flaps'=1c" in output)
+
+    def test_brief_disconnect(self):
+        self.replay('exists -')
+        status, output = self.replay('T10:05:04.000000')
+        self.assertEqual(status, check_drbd_status.WARNING, output)
+        self.assertTrue('1 brief disconnects' in output, output)
+
+    def test_stale(self):
+        """ An old replay is ignored, and /proc/drbd is read instead. """
+        watcher = drbd_events.Watcher(30, 100)
+        watcher.feed(events())
+        watcher.save(self.state, 10, replay=True)
+        state = checklib._load(self.state)
+        state['updated'] -= 60
+        checklib._save(self.state, state)
+        self.assertEqual(check_drbd_status.read_events_state(self.state),
+            None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,90 @@
+# Property tests for the LSN arithmetic. Rather than depend on a property
+# testing library, each property is checked over a few thousand random values
+# from a seeded generator, plus the edge cases.
+
+import os
+import sys
+import random
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import pglsn
+
+EDGES = [0, 1, 0xffffffff, 1 << 32, (1 << 32) + 1, (1 << 64) - 1]
+
+def positions(rnd, count=2000):
+    """ Edge cases, then random 64-bit positions of every size. """
+    for p in EDGES:
+        yield p
+    for i in range(count):
+        yield rnd.getrandbits(rnd.randint(1, 64))
+
+class LSNPropertyTests(unittest.TestCase):
+    def setUp(self):
+        self.rnd = random.Random(36)
+
+    def test_round_trip(self):
+        for p in positions(self.rnd):
+            lsn = pglsn.format_lsn(p)
+            self.assertEqual(pglsn.parse(lsn), p)
+            # Postgresql doesn't zero pad, and either case parses the same
+            self.assertEqual(pglsn.parse(lsn.lower()), p)
+            self.assertEqual(pglsn.format_lsn(pglsn.parse(lsn)), lsn)
+
+    def test_out_of_range(self):
+        for p in (-1, 1 << 64):
+            self.assertRaises(ValueError, pglsn.format_lsn, p)
+        for lsn in ('', '16', '16/', '/B374D848', '1/123456789', 'G/0',
+                '1/2/3'):
+            self.assertRaises(ValueError, pglsn.parse, lsn)
+
+    def test_diff_antisymmetric(self):
+        values = list(positions(self.rnd))
+        for a, b in zip(values, reversed(values)):
+            a, b = pglsn.format_lsn(a), pglsn.format_lsn(b)
+            self.assertEqual(pglsn.diff(a, b), -pglsn.diff(b, a))
+            self.assertEqual(pglsn.diff(a, a), 0)
+            self.assertEqual(cmp(pglsn.diff(a, b), 0), pglsn.compare(a, b))
+
+    def test_lags(self):
+        """ lags is diff against each position, and None for a standby
+            that isn't streaming, which is not the same as no lag. """
+        def expected(masters, standbys):
+            result = []
+            for m, p in zip(masters, standbys):
+                if p is None:
+                    result.append(None)
+                else:
+                    result.append(pglsn.diff(m, p))
+            return result
+
+        values = [pglsn.format_lsn(p) for p in positions(self.rnd, 500)]
+        master = values[0]
+        standbys = values + [None, None]
+        self.rnd.shuffle(standbys)
+        self.assertEqual(pglsn.lags(master, standbys),
+            expected([master] * len(standbys), standbys))
+
+        masters = list(reversed(values)) + [master, master]
+        self.assertEqual(pglsn.lags(masters, standbys),
+            expected(masters, standbys))
+        self.assertRaises(ValueError, pglsn.lags, masters[1:], standbys)
+
+    def test_functions(self):
+        for version in (80400, 90105, 90600, 99999):
+            names = pglsn.functions(version)
+            self.assertEqual(names['current'], 'pg_current_xlog_location')
+            self.assertEqual(names['paused'], 'pg_is_xlog_replay_paused')
+        for version in (100000, 100001, 110005, 160002):
+            names = pglsn.functions(version)
+            self.assertEqual(names['current'], 'pg_current_wal_lsn')
+            self.assertEqual(names['replay'], 'pg_last_wal_replay_lsn')
+            self.assertEqual(names['paused'], 'pg_is_wal_replay_paused')
+        for version in (90600, 100000):
+            self.assertEqual(sorted(pglsn.functions(version)),
+                ['current', 'paused', 'receive', 'replay'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,140 @@
+import os
+import sys
+import imp
+import pwd
+import time
+import shutil
+import socket
+import tempfile
+import threading
+import subprocess
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+
+zeo = imp.load_source('zeo_agent', os.path.join(HERE, '..', 'heartbeat',
+    'zeo.py'))
+
+class Settings(object):
+    zeostorage = '1'
+    zeolatency = 0.5
+    zdruntimeout = 0.3
+    optimeout = 5
+    checklevel = 0
+    zeouser = 'zope'
+
+class ZdrunTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.sockname = os.path.join(self.directory, 'zdsock')
+        self.instance = zeo.ZEOInstance('zeoctl', self.sockname, '',
+            Settings())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def listen(self):
+        """ A zdrun that accepts connections but never answers. """
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(self.sockname)
+        self.sock.listen(5)
+        self.addCleanup(self.sock.close)
+
+    def test_parse_status(self):
+        status = zeo.parse_zdrun_status("application=1234\n"
+            "should_be_up=1\nlasttime=100.0\nnow=160.0\n")
+        self.assertEqual(status.pid, 1234)
+        self.assertEqual(status.uptime, 60)
+        self.assertFalse(status.restarting)
+        status = zeo.parse_zdrun_status("application=0\nshould_be_up=1\n"
+            "backoff=3\n")
+        self.assertTrue(status.restarting)
+
+    def test_no_socket(self):
+        self.assertEqual(self.instance.status(), None)
+        self.assertEqual(self.instance.monitor(), 7)
+
+    def test_refused(self):
+        self.listen()
+        self.sock.close() # Leaves the socket file behind
+        self.assertEqual(self.instance.status(), None)
+        self.assertEqual(self.instance.monitor(), 7)
+
+    def test_wedged(self):
+        self.listen()
+        self.assertRaises(zeo.ZdrunError, self.instance.status)
+        self.assertEqual(self.instance.monitor(), 1)
+        self.assertEqual(self.instance.start(), 1)
+
+    def test_stop(self):
+        # Stopping something that isn't running succeeds, but if zdrun
+        # doesn't answer we don't know, and the stop fails.
+        self.assertEqual(self.instance.stop(), 0)
+        self.listen()
+        self.assertEqual(self.instance.stop(), 1)
+
+class Agent(zeo.ResourceAgent):
+    """ Three instances, one at a time, with a three second op timeout. """
+
+    def __init__(self, directory):
+        super(Agent, self).__init__()
+        self.parallel = 1
+        self.optimeout = 3.0
+        self.zdruntimeout = 0.3
+        self.zeouser = pwd.getpwuid(os.getuid())[0]
+        zeoctl = os.path.join(directory, 'zeoctl')
+        fp = open(zeoctl, 'w')
+        fp.write('#!/bin/sh\nexec sleep 30\n') # Never gets anywhere
+        fp.close()
+        os.chmod(zeoctl, 0755)
+        self.instances = [zeo.ZEOInstance(zeoctl,
+            os.path.join(directory, 'zdsock%d' % i), '', self)
+            for i in range(3)]
+
+class DeadlineTests(unittest.TestCase):
+    """ However many instances wait for a worker, the action is done
+        within the op timeout. """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.agent = Agent(self.directory)
+        self.children = []
+        self.reaping = True
+        self.reaper = threading.Thread(target=self.reap)
+        self.reaper.start()
+
+    def tearDown(self):
+        self.reaping = False
+        self.reaper.join()
+        for p in self.children:
+            if p.poll() is None:
+                p.kill()
+                p.wait()
+        shutil.rmtree(self.directory)
+
+    def reap(self):
+        """ Killed children are waited for, like init would. """
+        while self.reaping:
+            for p in self.children:
+                p.poll()
+            time.sleep(0.02)
+
+    def test_stop(self):
+        # ZEO servers that ignore the stop and have to be killed
+        for instance in self.agent.instances:
+            p = subprocess.Popen(['sleep', '30'])
+            self.children.append(p)
+            instance.status = lambda pid=p.pid: zeo.DataObject(pid=pid)
+            instance._zeoctl = lambda action, deadline=None: 0
+        started = time.time()
+        self.assertEqual(self.agent.stop(), 0)
+        self.assertTrue(time.time() - started < self.agent.optimeout)
+        self.assertEqual([p.returncode for p in self.children], [-9] * 3)
+
+    def test_start(self):
+        started = time.time()
+        self.assertEqual(self.agent.start(), 1)
+        self.assertTrue(time.time() - started < self.agent.optimeout)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,86 @@
+import os
+import sys
+import imp
+import shutil
+import tempfile
+import unittest
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'nagios'))
+
+import zeoprobe
+import check_zeo
+from zeostub import ZEOStub
+
+zeo = imp.load_source('zeo_agent', os.path.join(HERE, '..', 'heartbeat',
+    'zeo.py'))
+
+class Settings(object):
+    zeostorage = '1'
+    zeolatency = 0.5
+    zdruntimeout = 1
+    optimeout = 5
+    checklevel = 10
+    zeouser = 'zope'
+
+class ZEOProbeTests(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, 'zeo.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def serve(self, **kw):
+        ZEOStub(self.address, **kw).start()
+
+    def test_parse_zeo_address(self):
+        self.assertEqual(zeoprobe.parse_zeo_address('127.0.0.1:8100')[1],
+            ('127.0.0.1', 8100))
+        self.assertEqual(zeoprobe.parse_zeo_address('/var/zeo.sock')[1],
+            '/var/zeo.sock')
+
+    def test_probe(self):
+        self.serve()
+        connect, rtt = zeoprobe.ZEOProbe(self.address).probe()
+        self.assertTrue(0 <= rtt < 0.5)
+
+    def test_slow(self):
+        self.serve(delay=1)
+        probe = zeoprobe.ZEOProbe(self.address, timeout=0.3)
+        self.assertRaises(zeoprobe.ZEOProbeFailed, probe.probe)
+
+    def test_error(self):
+        self.serve(error=KeyError('1'))
+        try:
+            zeoprobe.ZEOProbe(self.address).probe()
+        except zeoprobe.ZEOProbeFailed, e:
+            self.assertTrue('KeyError' in str(e))
+        else:
+            self.fail("Error reply not raised")
+
+    def test_not_listening(self):
+        probe = zeoprobe.ZEOProbe(self.address)
+        self.assertRaises(zeoprobe.ZEOProbeFailed, probe.probe)
+
+    def test_check_zeo(self):
+        self.serve(delay=0.2)
+        status, output = check_zeo.check(check_zeo.parse_args(['-a',
+            self.address, '-w', '0.1', '-c', '5']))
+        self.assertEqual(status, check_zeo.WARNING, output)
+        self.assertTrue('lastTransaction=' in output)
+
+        os.unlink(self.address)
+        status, output = check_zeo.check(check_zeo.parse_args(['-a',
+            self.address]))
+        self.assertEqual(status, check_zeo.CRITICAL)
+
+    def test_agent_deep_monitor(self):
+        instance = zeo.ZEOInstance('zeoctl', 'zdsock', self.address,
+            Settings())
+        self.assertFalse(instance._probe())
+        self.serve()
+        self.assertTrue(instance._probe())
+
+if __name__ == '__main__':
+    unittest.main()
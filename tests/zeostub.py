@@ -0,0 +1,65 @@
+#!/usr/bin/python
+#
+# A stub ZEO storage server, just enough of it for the storage probe. It
+# speaks the zrpc handshake, answers register and lastTransaction, and can be
+# told to answer slowly, or with an error, to test how the probe copes.
+#
+#   python tests/zeostub.py /tmp/zeo.sock [delay]
+
+import sys
+import os
+import time
+import struct
+import socket
+import cPickle
+import threading
+
+class ZEOStub(threading.Thread):
+    def __init__(self, path, delay=0, error=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.delay = delay
+        self.error = error
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+
+    def send(self, conn, msg):
+        conn.sendall(struct.pack(">I", len(msg)) + msg)
+
+    def recv(self, conn):
+        size, = struct.unpack(">I", conn.recv(4, socket.MSG_WAITALL))
+        return conn.recv(size, socket.MSG_WAITALL)
+
+    def serve(self, conn):
+        self.send(conn, 'Z3101')
+        self.recv(conn) # The protocol the client picked
+        while True:
+            msgid, flags, method, args = cPickle.loads(self.recv(conn))
+            result = None
+            if method == 'lastTransaction':
+                time.sleep(self.delay)
+                result = '\x03\xc4\x1c\x2e\x21\x0f\x5a\x66'
+                if self.error is not None:
+                    result = (self.error.__class__, self.error)
+                # Clients get invalidations in between, ignore those
+                self.send(conn, cPickle.dumps((0, 1, 'invalidateTransaction',
+                    (result, [])), 1))
+            self.send(conn, cPickle.dumps((msgid, 0, '.reply', result), 1))
+
+    def run(self):
+        while True:
+            conn = self.sock.accept()[0]
+            try:
+                self.serve(conn)
+            except (socket.error, struct.error, EOFError):
+                pass
+            conn.close()
+
+if __name__ == '__main__':
+    delay = len(sys.argv) > 2 and float(sys.argv[2]) or 0
+    stub = ZEOStub(sys.argv[1], delay)
+    try:
+        stub.run()
+    finally:
+        os.unlink(sys.argv[1])